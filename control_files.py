@@ -7,7 +7,11 @@ from __future__ import division, print_function
 import os
 import sys
 import re
-from collections import OrderedDict, defaultdict
+import time
+import json
+import hashlib
+from collections import OrderedDict, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
 
@@ -19,6 +23,64 @@ def read_file(path):
         return f.read()
 
 
+PARTIAL_SIZE = 4096         # bytes hashed to tell apart files of the same size
+BLOCK_SIZE = 1024 * 1024    # bytes read at a time for full hashes
+
+
+def file_hash(path, n=None):
+    """Returns: hash of the first `n` bytes of file `path`, or of the whole file if n is None"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if n is not None:
+            h.update(f.read(n))
+        else:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                h.update(block)
+    return h.digest()
+
+
+class DuplicateFinder(object):
+    """Finds files whose contents are identical to an earlier file without keeping any file
+        contents in memory. Files are grouped by size, then compared by a hash of their first
+        PARTIAL_SIZE bytes and only then by a hash of their whole contents.
+        sizes: {size: {partial hash: {full hash: path}}}. Each level holds the path of the only
+            file seen so far instead of a dict, so a file is only hashed once another file
+            matches it at that level. Files no longer than PARTIAL_SIZE stop at the partial level
+    """
+
+    def __init__(self):
+        self.sizes = {}
+        self.counts = defaultdict(int)
+
+    def original(self, path, size):
+        """Returns: path of an earlier file with the same contents as file `path` of `size`
+            bytes, or None if `path` is the first file with its contents
+        """
+        partials = self.sizes.get(size)
+        if partials is None:
+            self.sizes[size] = path
+            return None
+        if not isinstance(partials, dict):
+            partials = self.sizes[size] = {file_hash(partials, PARTIAL_SIZE): partials}
+        self.counts['partial'] += 1
+        partial = file_hash(path, PARTIAL_SIZE)
+        fulls = partials.get(partial)
+        if fulls is None:
+            partials[partial] = path
+            return None
+        # Files no longer than PARTIAL_SIZE are fully compared by their partial hash
+        if size <= PARTIAL_SIZE:
+            return fulls
+        if not isinstance(fulls, dict):
+            fulls = partials[partial] = {file_hash(fulls): fulls}
+        self.counts['full'] += 1
+        full = file_hash(path)
+        original = fulls.get(full)
+        if original is None:
+            fulls[full] = path
+        return original
+
+
 def split_all(path):
     parts = []
     d0 = path
@@ -51,44 +113,99 @@ def get_issue(parts):
     return None
 
 
-def recursive_glob(dir_name, mask):
+WALK_THREADS = 8
+WALK_AHEAD = 4          # directory listings outstanding per walk thread
+
+
+def name_key(s):
+    return (s.lower(), s)
+
+
+def scan_dir(path):
+    """Returns: files, dirs
+            files: sorted names of the non-directories in directory `path`
+            dirs: sorted names of the subdirectories of `path` that are not symlinks
+        Errors are ignored, as os.walk() does
+    """
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.name)
+    except OSError as e:
+        if DEBUG:
+            print('scan_dir: path="%s",e=%s' % (path, e))
+    files.sort(key=name_key)
+    dirs.sort(key=name_key)
+    return files, dirs
+
+
+def walk(dir_name, threads=WALK_THREADS, ahead=WALK_AHEAD):
+    """Like os.walk() except that directories are listed concurrently with os.scandir() in
+        `threads` threads and that files and subdirectories are sorted so the order is
+        deterministic. Listings are submitted for the directories that will be visited next, up
+        to `threads` * `ahead` at a time, so a slow consumer doesn't queue the whole tree.
+        Pending listings are cancelled when the generator is closed.
+        Generator returning (root, dirs, files)
+    """
+    executor = ThreadPoolExecutor(threads)
+    limit = threads * ahead
+    stack = [[dir_name, executor.submit(scan_dir, dir_name)]]  # [path, future or None]
+    pending = 1                     # entries in `stack` with a future
+    try:
+        while stack:
+            root, future = stack.pop()
+            pending -= 1
+            files, dirs = future.result()
+            stack.extend([os.path.join(root, d), None] for d in reversed(dirs))
+            # Submit the next directories to visit. Stops within 2 * limit entries of the top
+            for entry in reversed(stack):
+                if pending >= limit:
+                    break
+                if entry[1] is None:
+                    entry[1] = executor.submit(scan_dir, entry[0])
+                    pending += 1
+            yield root, dirs, files
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def recursive_glob(dir_name, mask, threads=WALK_THREADS):
     """Like glob.glob() except that it sorts directories and
         recurses through subdirectories.
+        Generator returning (full_path, issue, filename) for the files that match regex `mask`
     """
-    # assert False
     print('_recursive_glob', dir_name, mask)
     RE_MASK = re.compile(mask)
-    recursive_list = os.walk(dir_name)
-    print('recursive_list=%s' % recursive_list)
     sys.stdout.flush()
-    # assert False
-    # out = []
-    for i, (root, dirs, files) in enumerate(recursive_list):
+    for i, (root, dirs, files) in enumerate(walk(dir_name, threads)):
         if DEBUG:
             print('root=%d:%d:%s' % (i, len(files), root))
         path_list = [path for path in files if RE_MASK.search(path)]
-        # print('!%d,' % len(path_list), end='')
-        path_list.sort(key=lambda s: (s.lower(), s))
-        # print('#%d,' % len(path_list), end='')
-        # path_list = sorted(fnmatch.filter(files, mask), key=lambda s: (s.lower(), s))
+        if not path_list:
+            continue
+        # The issue depends only on the directory
+        parts = split_all(root)
+        issue = get_issue(parts)
+        if issue is None and parts:
+            issue = parts[-1]
+        if issue is None:
+            for filename in path_list:
+                print('*** no issue: %s' % os.path.join(root, filename))
+            continue
         for filename in path_list:
-            # pass
             full_path = os.path.join(root, filename)
-            parts = split_all(root)
-            issue = get_issue(parts)
-            if issue is None and parts:
-                issue = parts[-1]
-            if issue is None:
-                print('*** no issue: %s' % full_path)
-                continue
-            print('!!!', full_path)
-            print('   ', parts, filename)
-            print('   ', issue)
+            if DEBUG:
+                print('!!!', full_path, issue)
             yield(full_path, issue, filename)
-            # out.append((full_path, issue, filename))
-        # print('$%d' % len(path_list))
-    # return out
-
 
 
 def glob(dir_name, mask):
@@ -103,20 +220,20 @@ def glob(dir_name, mask):
             include_dirs: return directories as well as plain files?
             do_reverse: return paths in reverse order/
         Returns:
-            Generator returning paths
+            OrderedDict {path: (issue, index, filename, size)} of files whose contents differ from
+            all earlier files
     """
     print('glob', dir_name, mask)
-    text_path = {}
-    path_text = {}
+    finder = DuplicateFinder()
+    path_size = {}
     isfn_paths = defaultdict(list)
     isfn_list = []
 
     for path, issue, filename in recursive_glob(dir_name, mask):
-        text = read_file(path)
-        if text in text_path:
+        size = os.path.getsize(path)
+        if finder.original(path, size) is not None:
             continue
-        text_path[text] = path
-        path_text[path] = text
+        path_size[path] = size
         isfn = tuple((issue, filename))
         # assert isfn not in isfn_dict, '\n'.join((str(isfn), path, isfn_dict[isfn]))
 
@@ -127,9 +244,9 @@ def glob(dir_name, mask):
     for isfn in isfn_list:
         issue, filename = isfn
         for i, path in enumerate(isfn_paths[isfn]):
-            text = path_text[path]
-            path_dict[path] = tuple((issue, i, filename, text))
+            path_dict[path] = tuple((issue, i, filename, path_size[path]))
 
+    print('duplicates: %s' % dict(finder.counts))
     print('5555')
     return path_dict
 
@@ -142,32 +259,272 @@ def mkdir(path):
 
 CONTROL = 'control.files'
 
+COPY_MODES = ('copy', 'hardlink', 'reflink')
+COPY_THREADS = 8
+FICLONE = 0x40049409    # Linux ioctl that makes `dst` a copy-on-write clone of `src`
 
-def find_control_files(root):
+
+def copy_data(src, dst, size):
+    """Copy `size` bytes from open file `src` to open file `dst` in the kernel with
+        os.copy_file_range() where it is available, otherwise through user space
+    """
     import shutil
-    mask = r'^c\d{3,10}$'
+    if hasattr(os, 'copy_file_range'):
+        try:
+            n = size
+            while n > 0:
+                m = os.copy_file_range(src.fileno(), dst.fileno(), n)
+                if m == 0:
+                    break
+                n -= m
+            if n <= 0 or size == 0:
+                return
+        except OSError:
+            # e.g. EXDEV on old kernels or ENOSYS. Copy what is left in user space
+            pass
+    shutil.copyfileobj(src, dst)
+
+
+def copy_file(src_path, dst_path, size, mode='copy'):
+    """Copy file `src_path` of `size` bytes to `dst_path`, replacing any existing file
+        mode: 'copy': copy the data
+              'hardlink': make `dst_path` a hard link to `src_path`
+              'reflink': make `dst_path` a copy-on-write clone of `src_path`
+        Hard links and reflinks fall back to copying where the filesystem does not support them
+        The copy is made in a temporary file next to `dst_path` that then replaces it, so a
+        `dst_path` that is a hard link to `src_path` from an earlier 'hardlink' run is replaced
+        rather than written through, which would truncate the source
+        Returns: mode actually used
+    """
+    import shutil
+    if mode == 'hardlink' and os.path.exists(dst_path) and os.path.samefile(src_path, dst_path):
+        return mode
+    temp_path = '%s.tmp' % dst_path
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        if mode == 'hardlink':
+            try:
+                os.link(src_path, temp_path)
+            except OSError:
+                mode = 'copy'
+        if mode != 'hardlink':
+            with open(src_path, 'rb') as src, open(temp_path, 'wb') as dst:
+                if mode == 'reflink':
+                    try:
+                        import fcntl
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    except (ImportError, OSError):
+                        mode = 'copy'
+                if mode == 'copy':
+                    copy_data(src, dst, size)
+            shutil.copymode(src_path, temp_path)
+        os.replace(temp_path, dst_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return mode
+
+
+def copy_files(copies, mode='copy', threads=COPY_THREADS):
+    """Copy files in a thread pool
+        copies: list of (src_path, dst_path, size)
+        Destination directories are created once each before copying starts
+        Returns: Counter of modes used
+    """
+    for dest_dir in sorted({os.path.dirname(dst_path) for _, dst_path, _ in copies}):
+        os.makedirs(dest_dir, exist_ok=True)
+
+    def copy_one(copy):
+        src_path, dst_path, size = copy
+        try:
+            return copy_file(src_path, dst_path, size, mode)
+        except Exception as e:
+            print('==> copy "%s"->"%s" failed %r' % (src_path, dst_path, e))
+            raise
+
+    t0 = time.time()
+    with ThreadPoolExecutor(threads) as executor:
+        modes = Counter(executor.map(copy_one, copies))
+    dt = max(time.time() - t0, 1e-6)
+    n_bytes = sum(size for _, _, size in copies)
+    print('copied %d files %.1f MB in %.2f s: %.0f files/s %.1f MB/s %s' % (
+          len(copies), n_bytes / 1e6, dt, len(copies) / dt, n_bytes / 1e6 / dt, dict(modes)))
+    return modes
+
+
+CONTROL_MASK = r'^c\d{3,10}$'
+
+
+def dest_path_for(issue, filename, j):
+    return os.path.join(CONTROL, issue, '%s_%02d' % (filename, j))
+
+
+def find_control_files(root, mode='copy', threads=COPY_THREADS):
+    mask = CONTROL_MASK
     print('mask=%s' % mask)
     path_dict = glob(root, mask)
     print('@' * 80)
-    lengths = [len(text) for _, _, _, text in path_dict.values()]
+    lengths = [size for _, _, _, size in path_dict.values()]
     print('%d files,min=%d,max=%d' % (len(path_dict), min(lengths), max(lengths)))
-    # for i, (path, (issue, j, filename, text)) in enumerate(path_dict.items()):
-    #     print('%4d: %5d %s %s' % (i, len(text), [issue, j, filename], path))
-
-    mkdir(CONTROL)
-    for i, (path, (issue, j, filename, text)) in enumerate(path_dict.items()):
-        dest_dir = os.path.join(CONTROL, issue)
-        dest_name = '%s_%02d' % (filename, j)
-        dest_path = os.path.join(dest_dir, dest_name)
-        mkdir(dest_dir)
-        print('%4d: %5d %s %s' % (i, len(text), [issue, j, filename], path))
-        try:
-            shutil.copy(path, dest_path)
-        except Exception as e:
-            print('==> copy "%s"->"%s" failed %r' % (path, dest_path, e))
-            raise
+    # for i, (path, (issue, j, filename, size)) in enumerate(path_dict.items()):
+    #     print('%4d: %5d %s %s' % (i, size, [issue, j, filename], path))
+
+    copies = []
+    for i, (path, (issue, j, filename, size)) in enumerate(path_dict.items()):
+        dest_path = dest_path_for(issue, filename, j)
+        print('%4d: %5d %s %s' % (i, size, [issue, j, filename], path))
+        copies.append((path, dest_path, size))
+    copy_files(copies, mode, threads)
+
+
+MANIFEST = os.path.join(CONTROL, '.manifest.json')
+MANIFEST_VERSION = 1
+
+
+def load_manifest(path=MANIFEST):
+    """Returns: {source path: entry} from manifest `path`, where entry is a dict of
+            size, mtime_ns: of the source file when it was last seen
+            hash: hex hash of its contents
+            issue, filename, index: its (issue, index, filename) grouping
+            dest: where it was copied, or None if it duplicates an earlier file
+            original: for duplicates, the source path of the earlier file
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    assert manifest['version'] == MANIFEST_VERSION, (path, manifest['version'])
+    return manifest['files']
+
+
+def save_manifest(files, path=MANIFEST):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '%s.tmp' % path
+    with open(temp_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f, indent=0, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def update_control_files(root, mode='copy', threads=COPY_THREADS, manifest_path=MANIFEST):
+    """Incremental find_control_files(). Only source files that are not in the manifest, or whose
+        size or mtime has changed, are read and copied. Files keep the (issue, index, filename)
+        they were given on earlier runs and new files in an (issue, filename) group get the next
+        index, so the copies in CONTROL stay consistent from run to run.
+        When a copied file changes or disappears, its duplicates are re-checked and one of them
+        is copied in its place if no other file has their contents. Files that are no longer
+        found are dropped from the manifest and their copies removed.
+    """
+    mask = CONTROL_MASK
+    print('mask=%s' % mask)
+    files = load_manifest(manifest_path)
+    hash_original = {}
+    next_index = Counter()
+    for src_path, entry in files.items():
+        if entry['dest'] is not None:
+            hash_original[entry['hash']] = src_path
+            isfn = entry['issue'], entry['filename']
+            next_index[isfn] = max(next_index[isfn], entry['index'] + 1)
+
+    def add_copy(path, entry):
+        """Make `entry` for source file `path` an original and queue its copy"""
+        issue, filename = entry['issue'], entry['filename']
+        if entry['index'] is None:
+            entry['index'] = next_index[(issue, filename)]
+            next_index[(issue, filename)] += 1
+        entry['dest'] = dest_path_for(issue, filename, entry['index'])
+        entry['original'] = None
+        hash_original[entry['hash']] = path
+        print('%4d: %5d %s %s' % (len(copies), entry['size'], [issue, entry['index'], filename],
+                                  path))
+        copies.append((path, entry['dest'], entry['size']))
+
+    counts = Counter()
+    copies = []
+    walked = set()
+    lost = set()        # originals whose contents changed or that were not found
+    stale = []          # copies of files that are no longer originals
+    for path, issue, filename in recursive_glob(root, mask):
+        walked.add(path)
+        st = os.stat(path)
+        entry = files.get(path)
+        if entry is not None and (entry['size'], entry['mtime_ns']) == (st.st_size,
+                                                                       st.st_mtime_ns):
+            counts['unchanged'] += 1
+            continue
+        counts['changed' if entry is not None else 'new'] += 1
+        h = file_hash(path).hex()
+        new_entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': h,
+                     'issue': issue, 'filename': filename, 'index': None, 'dest': None,
+                     'original': None}
+        if (entry is not None and entry['hash'] == h and entry['dest'] is not None and
+                os.path.exists(entry['dest'])):
+            # Touched but not changed
+            entry['size'], entry['mtime_ns'] = st.st_size, st.st_mtime_ns
+            counts['same'] += 1
+            continue
+        if entry is not None and entry['dest'] is not None:
+            if hash_original.get(entry['hash']) == path:
+                del hash_original[entry['hash']]
+            if entry['hash'] != h:
+                lost.add(path)
+        original = hash_original.get(h)
+        if original is not None and original != path:
+            new_entry['original'] = original
+            counts['duplicate'] += 1
+            if entry is not None and entry['dest'] is not None:
+                stale.append(entry['dest'])
+        else:
+            if entry is not None and entry['dest'] is not None:
+                # Changed contents: keep its place in CONTROL
+                new_entry['index'] = entry['index']
+            add_copy(path, new_entry)
+        files[path] = new_entry
+
+    for path in [path for path in files if path not in walked]:
+        entry = files.pop(path)
+        counts['removed'] += 1
+        if entry['dest'] is not None:
+            if hash_original.get(entry['hash']) == path:
+                del hash_original[entry['hash']]
+            lost.add(path)
+            stale.append(entry['dest'])
+
+    if lost:
+        for path, entry in files.items():
+            if entry['original'] not in lost:
+                continue
+            counts['rechecked'] += 1
+            original = hash_original.get(entry['hash'])
+            if original is not None:
+                entry['original'] = original
+            else:
+                add_copy(path, entry)
+                counts['promoted'] += 1
+
+    print('@' * 80)
+    print('manifest: %d files %s' % (len(files), dict(counts)))
+    for dest in stale:
+        if os.path.exists(dest):
+            os.remove(dest)
+    copy_files(copies, mode, threads)
+    save_manifest(files, manifest_path)
 
 
 if __name__ == '__main__':
-    assert len(sys.argv) > 1, 'Usage: python %s <root>' % sys.argv[0]
-    find_control_files(sys.argv[1])
+    import argparse
+    parser = argparse.ArgumentParser(description='Copy CUPS control files to %s' % CONTROL)
+    parser.add_argument('root', help='directory tree to search')
+    parser.add_argument('--mode', choices=COPY_MODES, default='copy',
+                        help='how to copy files')
+    parser.add_argument('--threads', type=int, default=COPY_THREADS,
+                        help='number of copy threads')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only copy files that are new or changed since the last '
+                             '--incremental run, as recorded in %s' % MANIFEST)
+    args = parser.parse_args()
+    if args.incremental:
+        update_control_files(args.root, args.mode, args.threads)
+    else:
+        find_control_files(args.root, args.mode, args.threads)
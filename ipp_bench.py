@@ -0,0 +1,600 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for ipp_reader
+
+    python ipp_bench.py [-n <repeats>]      # micro benchmarks of value decoding and round trips
+
+    Stage benchmarks run parse_top, parse_group, decode_message, save_attribute_dict and
+    control_files.glob on synthetic messages from ipp_synth and report throughput, latency
+    percentiles and peak traced memory for each stage.
+
+    python ipp_bench.py --stages [<stage>...] [--messages N] [--depth N] ...
+    python ipp_bench.py --stages --save baseline.json       # record a baseline
+    python ipp_bench.py --stages --baseline baseline.json   # compare against it
+
+    python ipp_bench.py --memory [--messages N] ...    # memory of held dicts vs AttributeTables
+"""
+from __future__ import division, print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from ipp_reader import (IPP_TAG_INTEGER, IPP_TAG_BOOLEAN, IPP_TAG_ENUM, IPP_TAG_DATE,
+                        IPP_TAG_RESOLUTION, IPP_TAG_RANGE, IPP_TAG_TEXT, IPP_TAG_NAME,
+                        IPP_TAG_KEYWORD, IPP_TAG_URI, IPP_TAG_URISCHEME, IPP_TAG_CHARSET,
+                        IPP_TAG_LANGUAGE, IPP_TAG_MIMETYPE, IPP_TAG_MEMBERNAME, IPP, T,
+                        IPP_TAG_OPERATION, IPP_TAG_JOB, IPP_TAG_PRINTER,
+                        IPP_TAG_BEGIN_COLLECTION, IPP_TAG_END_COLLECTION, GROUP_TAGS, HEADER,
+                        be2, be4, dprint, tag_describe,
+                        decode_datetime, parse_value, parse_top, parse_group, decode_message,
+                        save_attribute_dict)
+from ipp_encoder import IPPEncoder
+import ipp_synth
+import control_files
+
+
+def parse_value_chain(ipp, depth, tag, value):
+    """parse_value() as it was before VALUE_DECODERS: an if/elif chain on `tag` with a dprint()
+        format on every call. Kept as the baseline for bench_values().
+    """
+    n = len(value) if value is not None else None
+    assert isinstance(depth, int), depth
+    dprint('parse_value: d=%d,i=%d,tag=%s' % (depth, ipp.i_tag, tag_describe(tag)))
+
+    if tag in (IPP_TAG_INTEGER, IPP_TAG_ENUM):
+        assert n == 4, (tag, n)
+        return be4(value)
+
+    elif tag == IPP_TAG_BOOLEAN:
+        assert n == 1, (tag, n)
+        return bool(value[0])
+
+    if tag in (IPP_TAG_TEXT,
+               IPP_TAG_NAME,
+               IPP_TAG_KEYWORD,
+               IPP_TAG_URI,
+               IPP_TAG_URISCHEME,
+               IPP_TAG_CHARSET,
+               IPP_TAG_LANGUAGE,
+               IPP_TAG_MIMETYPE):
+        return T(value)
+
+    elif tag == IPP_TAG_DATE:
+        assert n == 11, (tag, n)
+        return decode_datetime(value)
+
+    elif tag == IPP_TAG_RESOLUTION:
+        assert n == 9, (tag, n)
+        xres = be4(value[:4])
+        yres = be4(value[4:8])
+        units = value[8]
+        return tuple((xres, yres, units))
+
+    elif tag == IPP_TAG_RANGE:
+        assert n == 8, (tag, n)
+        lower = be4(value[:4])
+        upper = be4(value[4:])
+        return tuple((lower, upper))
+
+    elif tag == IPP_TAG_MEMBERNAME:
+        return T(value)
+
+    assert False, 'Unsupported'
+
+
+def parse_group_three_pass(ipp, depth):
+    """parse_group() as it was before it assembled attributes in a single pass: it read all
+        (tag, name, value) triples, copied them to fold in collection member names, then made a
+        third pass to merge additional values into 1setOf lists. Kept as the baseline for
+        bench_parse_group().
+    """
+    group = {}
+    truples = []
+    for cnt in range(10 ** 6):
+        tag = ipp.peek_tag()
+        if tag is None or tag in GROUP_TAGS:
+            assert depth == 0, (depth, tag_describe(tag))
+            break
+        ipp.read_tag()
+        if tag == IPP_TAG_END_COLLECTION:
+            ipp.read(4)
+            break
+        n = be2(ipp.read(2))
+        name = T(ipp.read(n)) if n > 0 else None
+        v = be2(ipp.read(2))
+        if tag == IPP_TAG_BEGIN_COLLECTION:
+            if v > 0:
+                ipp.read(v)
+            value = parse_group_three_pass(ipp, depth + 1)
+        elif v > 0:
+            value = parse_value(ipp, depth, tag, ipp.read(v))
+        else:
+            value = None
+        truples.append((tag, name, value))
+
+    assert truples
+
+    truples2 = []
+    i = 0
+    while i < len(truples):
+        tag0, name0, value0 = truples[i]
+        if tag0 == IPP_TAG_MEMBERNAME:
+            tag, name, value = truples[i + 1]
+            assert name0 is None, name0
+            assert name is None, name
+            assert isinstance(value0, str), value0
+            truples2.append((tag, value0, value))
+            i += 2
+        else:
+            truples2.append((tag0, name0, value0))
+            i += 1
+    truples = truples2
+
+    i = 0
+    accumulating = False
+    while i < len(truples):
+        tag, name, value = truples[i]
+        if not accumulating:
+            if name is None:
+                tag0, name0, value0 = truples[i - 1]
+                values = [value0, value]
+                accumulating = True
+        else:
+            if name is None:
+                values.append(value)
+            else:
+                accumulating = False
+                group[name0] = values
+        if accumulating:
+            assert tag == tag0
+        else:
+            group[name] = value
+        i += 1
+
+    if accumulating and values:
+        group[name0] = values
+
+    assert group, cnt
+    return group
+
+
+def B(text):
+    """List of ints for `text`, the form parse_value() is passed values in"""
+    return [int(c) for c in text]
+
+
+# (tag, value) pairs in roughly the mix found in job control files
+SAMPLE_VALUES = [
+    (IPP_TAG_CHARSET, B(b'utf-8')),
+    (IPP_TAG_LANGUAGE, B(b'en-us')),
+    (IPP_TAG_URI, B(b'ipp://localhost/printers/Office_Printer')),
+    (IPP_TAG_NAME, B(b'Microsoft Word - quarterly report.docx')),
+    (IPP_TAG_NAME, B(b'jsmith')),
+    (IPP_TAG_KEYWORD, B(b'one-sided')),
+    (IPP_TAG_KEYWORD, B(b'none')),
+    (IPP_TAG_MIMETYPE, B(b'application/pdf')),
+    (IPP_TAG_INTEGER, B(b'\x00\x00\x00\x07')),
+    (IPP_TAG_INTEGER, B(b'\x5e\x4f\x1a\x22')),
+    (IPP_TAG_INTEGER, B(b'\x00\x00\x01\x2c')),
+    (IPP_TAG_ENUM, B(b'\x00\x00\x00\x09')),
+    (IPP_TAG_ENUM, B(b'\x00\x00\x00\x04')),
+    (IPP_TAG_BOOLEAN, B(b'\x01')),
+    (IPP_TAG_DATE, B(b'\x07\xe4\x05\x06\x07\x08\x09\x00+\x0a\x00')),
+    (IPP_TAG_RESOLUTION, B(b'\x00\x00\x02\x58\x00\x00\x02\x58\x03')),
+    (IPP_TAG_RANGE, B(b'\x00\x00\x00\x01\x00\x00\x00\x05')),
+    (IPP_TAG_MEMBERNAME, B(b'media-size')),
+]
+
+
+def bench_values(func, repeats):
+    """Decode SAMPLE_VALUES `repeats` times with parse_value() like function `func`
+        Returns: attributes decoded per second
+    """
+    ipp = IPP([])
+    values = SAMPLE_VALUES
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for tag, value in values:
+            func(ipp, 0, tag, value)
+    dt = time.perf_counter() - t0
+    return len(values) * repeats / dt
+
+
+# A job control file with 1setOf values, nested collections and extension values
+SAMPLE_MESSAGE = {
+    IPP_TAG_OPERATION: {
+        'attributes-charset': 'utf-8',
+        'attributes-natural-language': 'en-us',
+        'printer-uri': 'ipp://localhost/printers/Office_Printer',
+    },
+    IPP_TAG_JOB: {
+        'job-name': 'Microsoft Word - quarterly report.docx',
+        'job-originating-user-name': 'jsmith',
+        'job-originating-host-name': 'workstation-17.example.com',
+        'job-id': 1234,
+        'job-state': 9,
+        'job-k-octets': 300,
+        'job-priority': 50,
+        'copies': 2,
+        'job-sheets': ['none', 'none'],
+        'sides': 'two-sided-long-edge',
+        'document-format': 'application/pdf',
+        'time-at-creation': 1582242338,
+        'time-at-processing': 1582242339,
+        'time-at-completed': 1582242347,
+        'date-time-at-creation': '2020-02-21 10:45:38',
+        'page-ranges': [(1, 5), (7, 9)],
+        'printer-resolution': (600, 600, 3),
+        'job-hold-until': 'no-hold',
+        'fit-to-page': False,
+        'media-col': {
+            'media-color': 'white',
+            'media-type': 'stationery',
+            'media-size': {'x-dimension': 21000, 'y-dimension': 29700},
+            'media-source': 'tray-1',
+            'x-vendor-media': (0x40000001, b'\x00\x01'),
+        },
+        'finishings': [3, 4],
+        'x-vendor-data': (0x40000000, b'vendor octets'),
+        'x-vendor-cols': [{'x-vendor-data': (0x40000002, b'')}, {'copies': 1}],
+    },
+}
+
+
+def bench_round_trip(repeats):
+    """Encode SAMPLE_MESSAGE and decode the result `repeats` times each
+        Returns: size, encode_rate, decode_rate
+            size: message size in bytes
+            encode_rate, decode_rate: messages per second
+    """
+    encoder = IPPEncoder()
+    text = bytes(encoder.encode(SAMPLE_MESSAGE))
+    assert decode_message(text)[1] == SAMPLE_MESSAGE
+
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        encoder.encode(SAMPLE_MESSAGE)
+    t1 = time.perf_counter()
+    for _ in range(repeats):
+        decode_message(text)
+    t2 = time.perf_counter()
+    return len(text), repeats / (t1 - t0), repeats / (t2 - t1)
+
+
+def printer_attributes(n_media=2000, n_media_col=200):
+    """Returns: {group_tag: {name: value}} like a Get-Printer-Attributes response, with 1setOf
+        attributes of thousands of values
+    """
+    media = ['custom_%d_%dx%dmm' % (k, 100 + k % 200, 150 + k % 300) for k in range(n_media)]
+    media_col = [{'media-size': {'x-dimension': 10000 + k, 'y-dimension': 20000 + k},
+                  'media-type': ['stationery', 'photographic'][k % 2],
+                  'media-source': 'tray-%d' % (k % 4 + 1)}
+                 for k in range(n_media_col)]
+    return {
+        IPP_TAG_OPERATION: {
+            'attributes-charset': 'utf-8',
+            'attributes-natural-language': 'en-us',
+        },
+        IPP_TAG_PRINTER: {
+            'printer-name': 'Office_Printer',
+            'printer-state': 3,
+            'operations-supported': list(range(2, 60)),
+            'media-supported': media,
+            'media-col-database': media_col,
+            'printer-resolution-supported': [(300, 300, 3), (600, 600, 3), (1200, 1200, 3)],
+            'copies-supported': (1, 999),
+        },
+    }
+
+
+def bench_parse_group(func, messages, repeats):
+    """Parse the groups of `messages`, lists of ints, `repeats` times with parse_group() like
+        function `func`
+        Returns: groups per second, peak traced bytes of one pass, last result
+    """
+    def parse_all():
+        """Returns: number of groups parsed, groups of the last message"""
+        n = 0
+        for ints in messages:
+            ipp = IPP(ints)
+            ipp.read(HEADER.size)
+            top = {}
+            while True:
+                tag = ipp.read_tag()
+                if tag is None:
+                    break
+                top[tag] = func(ipp, 0)
+            n += len(top)
+        return n, top
+
+    n_groups = 0
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        n_groups += parse_all()[0]
+    dt = time.perf_counter() - t0
+    tracemalloc.start()
+    try:
+        _, top = parse_all()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return n_groups / dt, peak, top
+
+
+def percentile(ordered, p):
+    """Returns: the `p`th percentile of sorted list `ordered`, by the nearest-rank method"""
+    if not ordered:
+        return 0.0
+    k = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(k, len(ordered) - 1)]
+
+
+def measure(func, calls, repeats):
+    """Call `func`(*args) for each args in `calls` `repeats` times, then once more with
+        tracemalloc tracing
+        Returns: total seconds, sorted per-call latencies in seconds, peak traced bytes
+    """
+    latencies = []
+    clock = time.perf_counter
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(repeats):
+            for args in calls:
+                t0 = clock()
+                func(*args)
+                latencies.append(clock() - t0)
+        tracemalloc.start()
+        try:
+            for args in calls:
+                func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    latencies.sort()
+    return sum(latencies), latencies, peak
+
+
+def stage_parse_top(ints):
+    ipp = IPP(ints)
+    ipp.read(HEADER.size)
+    parse_top(ipp)
+
+
+def stage_parse_group(ints, i):
+    ipp = IPP(ints)
+    ipp.i = i
+    parse_group(ipp, 0)
+
+
+def group_offsets(ints):
+    """Returns: offsets in `ints` of the first attribute of each group, where parse_group()
+        starts
+    """
+    offsets = []
+    ipp = IPP(ints)
+    ipp.read(HEADER.size)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        while ipp.read_tag() is not None:
+            offsets.append(ipp.i)
+            parse_group(ipp, 0)
+    return offsets
+
+
+def stage_decode_message(text):
+    decode_message(text)
+
+
+def stage_glob(root):
+    control_files.glob(root, control_files.CONTROL_MASK)
+
+
+STAGES = ['parse_top', 'parse_group', 'decode_message', 'save_attribute_dict',
+          'control_files.glob']
+
+
+def bench_stages(messages, stages=STAGES, repeats=3):
+    """Benchmark `stages` on IPP `messages`
+        Returns: {stage: result dict} with calls, units (messages or groups), bytes, seconds,
+            units_per_s, mb_per_s, p50_us, p90_us, p99_us, max_us, peak_kb
+    """
+    ints = [[int(c) for c in text] for text in messages]
+    n_bytes = sum(len(text) for text in messages)
+    work_dir = tempfile.mkdtemp(prefix='ipp_bench.')
+    cwd = os.getcwd()
+    results = {}
+    try:
+        os.chdir(work_dir)  # save_attribute_dict() writes relative to the working directory
+        for stage in stages:
+            if stage == 'parse_top':
+                func, calls, units = stage_parse_top, [(x,) for x in ints], len(ints)
+            elif stage == 'parse_group':
+                calls = [(x, i) for x in ints for i in group_offsets(x)]
+                func, units = stage_parse_group, len(calls)
+            elif stage == 'decode_message':
+                func, calls, units = stage_decode_message, [(m,) for m in messages], len(messages)
+            elif stage == 'save_attribute_dict':
+                func = save_attribute_dict
+                calls = [('c%05d' % k, decode_message(m)[1]) for k, m in enumerate(messages)]
+                units = len(calls)
+            elif stage == 'control_files.glob':
+                root = os.path.join(work_dir, 'spool')
+                if not os.path.exists(root):
+                    ipp_synth.make_tree(root, messages)
+                func, calls, units = stage_glob, [(root,)], len(messages)
+            else:
+                assert False, 'Unknown stage %s. Stages: %s' % (stage, STAGES)
+
+            seconds, latencies, peak = measure(func, calls, repeats)
+            rate = units * repeats / seconds
+            results[stage] = {
+                'calls': len(calls),
+                'units': units,
+                'bytes': n_bytes,
+                'seconds': seconds,
+                'units_per_s': rate,
+                'mb_per_s': n_bytes * repeats / seconds / 1e6,
+                'p50_us': percentile(latencies, 50) * 1e6,
+                'p90_us': percentile(latencies, 90) * 1e6,
+                'p99_us': percentile(latencies, 99) * 1e6,
+                'max_us': latencies[-1] * 1e6,
+                'peak_kb': peak / 1024,
+            }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def print_stages(results, baseline=None):
+    """Print `results` from bench_stages() and their ratios to `baseline` results, if any"""
+    print('%-20s %8s %12s %8s %10s %10s %10s %10s' % (
+          'stage', 'calls', 'units/s', 'MB/s', 'p50 us', 'p90 us', 'p99 us', 'peak KB'))
+    for stage, r in results.items():
+        print('%-20s %8d %12.0f %8.2f %10.1f %10.1f %10.1f %10.0f' % (
+              stage, r['calls'], r['units_per_s'], r['mb_per_s'], r['p50_us'], r['p90_us'],
+              r['p99_us'], r['peak_kb']))
+        b = baseline.get(stage) if baseline else None
+        if b:
+            print('%-20s %8s %11.2fx %8s %9.2fx %9.2fx %9.2fx %9.2fx' % (
+                  '  vs baseline', '', r['units_per_s'] / b['units_per_s'], '',
+                  r['p50_us'] / b['p50_us'], r['p90_us'] / b['p90_us'],
+                  r['p99_us'] / b['p99_us'], r['peak_kb'] / max(b['peak_kb'], 1e-9)))
+
+
+def save_baseline(path, config, results):
+    with open(path, 'w') as f:
+        json.dump({'config': config, 'python': platform.python_version(),
+                   'platform': platform.platform(), 'stages': results}, f, indent=4,
+                  sort_keys=True)
+
+
+def load_baseline(path, config):
+    """Returns: stage results saved in baseline `path`. Warns if they were measured on
+        different synthetic messages than `config` describes
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline['config'] != config:
+        print('Warning: baseline %s was measured with %s' % (path, baseline['config']),
+              file=sys.stderr)
+    return baseline['stages']
+
+
+def bench_memory(messages):
+    """Hold `messages` decoded as parse_top() style dicts and as ipp_table.AttributeTables, as a
+        cross-file analysis would
+        Returns: {form: (bytes held per message, seconds to build all, seconds for to_dict of
+                 all or None)}
+    """
+    from ipp_table import AttributeTable, NameTable
+
+    def held(build):
+        """Returns: objects built, traced bytes still allocated after building them, seconds
+            to build them untraced
+        """
+        t0 = time.perf_counter()
+        objects = [build(text) for text in messages]
+        dt = time.perf_counter() - t0
+        del objects
+        tracemalloc.start()
+        try:
+            # Copy the input so each form pays for the bytes it keeps
+            objects = [build(bytes(memoryview(text))) for text in messages]
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        return objects, size, dt
+
+    n = len(messages)
+    dicts, dict_size, dict_seconds = held(lambda text: decode_message(text)[1])
+    names = NameTable()
+    tables, table_size, table_seconds = held(lambda text: AttributeTable(text, names))
+    t0 = time.perf_counter()
+    assert [table.to_dict() for table in tables] == dicts
+    to_dict_seconds = time.perf_counter() - t0
+    return {'dict': (dict_size / n, dict_seconds, None),
+            'AttributeTable': (table_size / n, table_seconds, to_dict_seconds)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ipp_reader benchmarks')
+    parser.add_argument('-n', '--repeats', type=int, default=20000,
+                        help='number of times each sample is decoded')
+    parser.add_argument('--stages', nargs='*', default=None,
+                        help='run stage benchmarks instead, of these stages or all of %s' %
+                             STAGES)
+    parser.add_argument('--stage-repeats', type=int, default=3,
+                        help='number of times each stage is run over the messages')
+    parser.add_argument('--save', default=None, help='save stage results as a baseline')
+    parser.add_argument('--baseline', default=None, help='compare stage results to a baseline')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure the memory of holding decoded messages as dicts and as '
+                             'AttributeTables instead')
+    ipp_synth.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.stages is not None:
+        config = {k: getattr(args, k) for k in ('messages', 'attributes', 'value_size',
+                                                 'set_length', 'depth', 'duplicates', 'seed')}
+        messages = ipp_synth.messages_for(args)
+        print('stages: %d messages, %d bytes %s' % (len(messages), sum(map(len, messages)),
+                                                    config))
+        results = bench_stages(messages, args.stages or STAGES, args.stage_repeats)
+        baseline = load_baseline(args.baseline, config) if args.baseline else None
+        print_stages(results, baseline)
+        if args.save:
+            save_baseline(args.save, config, results)
+            print('saved baseline %s' % args.save)
+        return
+
+    if args.memory:
+        messages = ipp_synth.messages_for(args)
+        print('memory: %d messages, %d bytes' % (len(messages), sum(map(len, messages))))
+        results = bench_memory(messages)
+        dict_size = results['dict'][0]
+        for form, (size, seconds, to_dict_seconds) in results.items():
+            print('  %-16s %9.0f bytes/message %5.2fx  build %8.0f messages/s%s' % (
+                  form, size, dict_size / size, len(messages) / seconds,
+                  '  to_dict %8.0f messages/s' % (len(messages) / to_dict_seconds)
+                  if to_dict_seconds else ''))
+        return
+
+    ipp = IPP([])
+    assert [parse_value_chain(ipp, 0, tag, value) for tag, value in SAMPLE_VALUES] == \
+        [parse_value(ipp, 0, tag, value) for tag, value in SAMPLE_VALUES]
+
+    print('parse_value: %d attributes x %d' % (len(SAMPLE_VALUES), args.repeats))
+    before = bench_values(parse_value_chain, args.repeats)
+    after = bench_values(parse_value, args.repeats)
+    print('  before (if/elif chain): %10.0f attributes/s' % before)
+    print('  after  (VALUE_DECODERS): %10.0f attributes/s  %.2fx' % (after, after / before))
+
+    printer = bytes(IPPEncoder().encode(printer_attributes()))
+    for label, text in (('job', bytes(IPPEncoder().encode(SAMPLE_MESSAGE))),
+                        ('printer attributes', printer)):
+        messages = [B(text)]
+        repeats = max(args.repeats * 1000 // len(text) // 20, 1)
+        before, before_peak, before_top = bench_parse_group(parse_group_three_pass, messages,
+                                                            repeats)
+        after, after_peak, after_top = bench_parse_group(parse_group, messages, repeats)
+        assert before_top == after_top == decode_message(text)[1], label
+        print('parse_group: %s, %d bytes x %d' % (label, len(text), repeats))
+        print('  before (three passes): %10.0f groups/s  peak %7.0f KB' % (
+              before, before_peak / 1024))
+        print('  after  (single pass):  %10.0f groups/s  peak %7.0f KB  %.2fx' % (
+              after, after_peak / 1024, after / before))
+
+    repeats = max(args.repeats // 4, 1)
+    size, encode_rate, decode_rate = bench_round_trip(repeats)
+    print('round trip: %d byte message x %d' % (size, repeats))
+    for label, rate in (('encode', encode_rate), ('decode', decode_rate)):
+        print('  %s: %10.0f messages/s %7.1f MB/s' % (label, rate, rate * size / 1e6))
+
+
+if __name__ == '__main__':
+    main()
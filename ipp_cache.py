@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+    Parse cache keyed by the hash of a control file's contents
+
+    Byte-identical control files (see control_files.glob) and files that have not changed since
+    the last run are decoded once. Decoded attribute dicts are kept as pickles in an in-memory
+    LRU and, optionally, in an on-disk directory whose total size is capped. When the disk tier
+    goes over its cap the least recently used entries are deleted.
+
+    Keys hash the file contents together with a variant string, ipp_reader's decode mode and
+    DECODER_VERSION, so the fast and slow decoders and older decoder versions don't share
+    entries. get() unpickles a new dict each time, so callers can modify what it returns.
+"""
+from __future__ import division, print_function
+import os
+import pickle
+import hashlib
+from collections import OrderedDict, Counter
+
+
+CACHE_VERSION = 2     # bump when the key or the pickled layout changes
+MEMORY_ENTRIES = 10000
+DISK_BYTES = 256 * 1024 * 1024
+LOW_WATER = 0.9     # fraction of the disk cap the disk tier is evicted down to
+
+
+def content_key(text, variant=''):
+    """Returns: hex key of bytes `text` decoded the way string `variant` describes"""
+    h = hashlib.blake2b(text, digest_size=16)
+    h.update(b'\0' + variant.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ParseCache(object):
+    """Two tier LRU cache of content hash -> pickled decoded attribute dict
+        cache_dir: directory of the on-disk tier, or None for a memory only cache
+        memory_entries: maximum number of entries in the memory tier
+        disk_bytes: maximum total size of the disk tier
+    """
+
+    def __init__(self, cache_dir=None, memory_entries=MEMORY_ENTRIES, disk_bytes=DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.counts = Counter()
+        self.disk_used = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_used = sum(size for _, _, size in self._disk_entries())
+
+    def __repr__(self):
+        return 'ParseCache{dir=%s,memory=%d/%d,disk=%d/%d}' % (
+            self.cache_dir, len(self.memory), self.memory_entries, self.disk_used,
+            self.disk_bytes)
+
+    def config(self):
+        """Returns: arguments to create a cache with the same configuration, e.g. in a worker"""
+        return self.cache_dir, self.memory_entries, self.disk_bytes
+
+    key = staticmethod(content_key)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.%d.pkl' % (key, CACHE_VERSION))
+
+    def _disk_entries(self):
+        """Returns: list of (path, mtime, size) of the entries in the disk tier"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue    # evicted by another process
+                entries.append((entry.path, st.st_mtime, st.st_size))
+        return entries
+
+    def get(self, key):
+        """Returns: new copy of the cached attribute dict for content hash `key`, or None"""
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+            self.counts['memory_hits'] += 1
+            return pickle.loads(data)
+
+        if self.cache_dir is not None:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                value = pickle.loads(data)
+                os.utime(path)  # mtime is the disk tier's LRU clock
+            except (OSError, EOFError, pickle.UnpicklingError):
+                value = None
+            if value is not None:
+                self.counts['disk_hits'] += 1
+                self._remember(key, data)
+                return value
+
+        self.counts['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        """Cache attribute dict `value` for content hash `key`. Later changes to `value` don't
+            change the cached copy
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self.counts['disk_writes'] += 1
+        self.disk_used += len(data)
+        if self.disk_used > self.disk_bytes:
+            self._evict_disk()
+
+    def _remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+            self.counts['memory_evictions'] += 1
+
+    def _evict_disk(self):
+        """Delete the least recently used disk entries until the disk tier is below LOW_WATER of
+            its cap. Other processes may share the directory so its size is measured, not assumed
+        """
+        entries = sorted(self._disk_entries(), key=lambda e: e[1])
+        used = sum(size for _, _, size in entries)
+        target = self.disk_bytes * LOW_WATER
+        for path, _, size in entries:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+            self.counts['disk_evictions'] += 1
+        self.disk_used = used
+
+    def describe(self):
+        counts = self.counts
+        hits = counts['memory_hits'] + counts['disk_hits']
+        total = hits + counts['misses']
+        return 'cache: hits=%d (memory=%d,disk=%d) misses=%d hit rate=%.1f%% %s' % (
+            hits, counts['memory_hits'], counts['disk_hits'], counts['misses'],
+            100.0 * hits / total if total else 0.0,
+            ' '.join('%s=%d' % (k, counts[k]) for k in
+                     ('memory_evictions', 'disk_writes', 'disk_evictions')))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    Checkpoints of ipp_reader batch runs
+
+    A Checkpoint records which control files have been processed, the files that failed and the
+    partial name_vals aggregate. It is saved every `interval` seconds and when the run ends or
+    is interrupted, so
+
+        python ipp_reader.py <dir> --fast -j 8 --checkpoint run.ckpt
+
+    can be re-run with the same arguments after a crash or Ctrl-C and only processes the files
+    that were not finished.
+
+    Files processed after the last save are processed again on resume, so --segments output can
+    contain their rows twice. The CSV per file output is simply rewritten.
+
+    The name_vals aggregate is a set of sketches, so the files finished before the checkpoint
+    and those after it are summarised separately and merged. The report only uses the parts of
+    the sketches that don't depend on where the input was split (see ipp_sketch), so a resumed
+    run reports the same as a clean one, apart from rare Count-Min overestimates near the most
+    common values threshold.
+"""
+from __future__ import division, print_function
+import os
+import time
+import pickle
+from ipp_sketch import NameValStats
+
+
+CHECKPOINT_VERSION = 2
+CHECKPOINT_INTERVAL = 60.0     # seconds between saves
+
+
+class Checkpoint(object):
+    """Progress of a batch run, loaded from `path` if it exists"""
+
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.done = set()
+        self.bad_paths = {}
+        self.name_vals = NameValStats()
+        self.resumed = 0    # number of files done in earlier runs
+        self.saved_at = time.time()
+        if os.path.exists(path):
+            self.load()
+
+    def __repr__(self):
+        return 'Checkpoint{path=%s,done=%d,bad=%d,resumed=%d}' % (
+            self.path, len(self.done), len(self.bad_paths), self.resumed)
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        assert state['version'] == CHECKPOINT_VERSION, (self.path, state['version'])
+        self.done = state['done']
+        self.bad_paths = state['bad_paths']
+        self.name_vals = state['name_vals']
+        self.resumed = len(self.done)
+
+    def save(self):
+        """Write the checkpoint atomically so a crash while saving leaves the previous one"""
+        state = {'version': CHECKPOINT_VERSION,
+                 'done': self.done,
+                 'bad_paths': self.bad_paths,
+                 'name_vals': self.name_vals}
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.saved_at = time.time()
+
+    def save_if_due(self):
+        if time.time() - self.saved_at >= self.interval:
+            self.save()
+
+    def remaining(self, paths):
+        """Generator that returns the paths in `paths` that are not done"""
+        done = self.done
+        for path in paths:
+            if path not in done:
+                yield path
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    Columnar batch decoding of fixed-width IPP values with NumPy
+
+    integer, enum, boolean, rangeOfInteger, resolution and dateTime values have fixed widths so
+    instead of decoding them one at a time with parse_value(), ColumnGatherer copies their raw
+    bytes from many messages into one contiguous buffer per (attribute name, value tag) and
+    decode_column() decodes each buffer in one step with big-endian NumPy dtypes.
+
+        gatherer = ColumnGatherer(['job-k-octets', 'time-at-completed'])
+        for path in paths:
+            gatherer.add_file(path)
+        rows, values = gatherer.column('job-k-octets')   # rows: indexes into gatherer.paths
+
+    Dates are decoded to seconds since the Unix epoch, corrected by the dateTime's UTC offset.
+    Only top level attributes are gathered, not collection members.
+
+    NumPy is only needed to decode; gathering works without it.
+"""
+from __future__ import division, print_function
+import sys
+from array import array
+from ipp_reader import (IPP_TAG_INTEGER, IPP_TAG_BOOLEAN, IPP_TAG_ENUM, IPP_TAG_DATE,
+                        IPP_TAG_RESOLUTION, IPP_TAG_RANGE, recursive_glob, tag_name)
+from ipp_lazy import IPPMessage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+FIXED_WIDTHS = {
+    IPP_TAG_INTEGER: 4,
+    IPP_TAG_ENUM: 4,
+    IPP_TAG_BOOLEAN: 1,
+    IPP_TAG_RANGE: 8,
+    IPP_TAG_RESOLUTION: 9,
+    IPP_TAG_DATE: 11,
+}
+
+
+class Column(object):
+    """Raw values of one (attribute name, value tag) across many messages"""
+
+    __slots__ = ('tag', 'buf', 'rows')
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.buf = bytearray()
+        self.rows = array('I')  # index of the message each value came from
+
+    def __repr__(self):
+        return 'Column{tag=%s,n=%d}' % (tag_name(self.tag), len(self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ColumnGatherer(object):
+    """Gathers fixed-width values of attributes `names`, or of all attributes if names is None"""
+
+    def __init__(self, names=None):
+        self.names = set(names) if names is not None else None
+        self.paths = []
+        self.columns = {}
+
+    def __repr__(self):
+        return 'ColumnGatherer{messages=%d,columns=%d}' % (len(self.paths), len(self.columns))
+
+    def add(self, path, text):
+        """Gather the fixed-width values in IPP message `text` read from `path`"""
+        msg = IPPMessage(text)
+        buf = msg.buf
+        row = len(self.paths)
+        self.paths.append(path)
+        names = self.names
+        columns = self.columns
+        for group in msg.values():
+            for name in group:
+                if names is not None and name not in names:
+                    continue
+                for tag, i, n in group.span(name):
+                    if FIXED_WIDTHS.get(tag) != n:
+                        continue
+                    column = columns.get((name, tag))
+                    if column is None:
+                        column = columns[(name, tag)] = Column(tag)
+                    column.buf += buf[i:i + n]
+                    column.rows.append(row)
+
+    def add_file(self, path):
+        with open(path, 'rb') as f:
+            self.add(path, f.read())
+
+    def column(self, name, tag=None):
+        """Returns: rows, values
+                rows: NumPy array of indexes into self.paths of the message of each value
+                values: NumPy array of the decoded values of attribute `name`
+            If `tag` is None the tag with the most values is used
+        """
+        if tag is None:
+            candidates = [(len(c), t) for (n, t), c in self.columns.items() if n == name]
+            assert candidates, 'No fixed-width values of %s' % name
+            tag = max(candidates)[1]
+        column = self.columns[(name, tag)]
+        require_numpy()
+        return np.frombuffer(column.rows, dtype=np.uint32), decode_column(column.tag, column.buf)
+
+    def arrays(self):
+        """Returns: {(name, tag): (rows, values)} for all gathered columns"""
+        return {key: self.column(*key) for key in self.columns}
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('NumPy is needed to decode columns: pip install numpy')
+
+
+def days_from_civil(year, month, day):
+    """Vectorized days since 1970-01-01 of proleptic Gregorian dates
+        http://howardhinnant.github.io/date_algorithms.html#days_from_civil
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def decode_dates(raw):
+    """Returns: int64 seconds since the Unix epoch for the RFC 1903 DateAndTime values in `raw`"""
+    dates = np.frombuffer(raw, dtype=DATE_DTYPE)
+    i8 = np.int64
+    days = days_from_civil(dates['year'].astype(i8), dates['month'].astype(i8),
+                           dates['day'].astype(i8))
+    seconds = (days * 86400 + dates['hour'].astype(i8) * 3600 + dates['minute'].astype(i8) * 60 +
+               dates['second'].astype(i8))
+    offset = dates['utc_hours'].astype(i8) * 3600 + dates['utc_minutes'].astype(i8) * 60
+    sign = np.where(dates['direction'] == b'-', -1, 1)
+    return seconds - sign * offset
+
+
+if np is not None:
+    RESOLUTION_DTYPE = np.dtype([('x', '>u4'), ('y', '>u4'), ('units', 'u1')])
+    DATE_DTYPE = np.dtype([('year', '>u2'), ('month', 'u1'), ('day', 'u1'), ('hour', 'u1'),
+                           ('minute', 'u1'), ('second', 'u1'), ('deciseconds', 'u1'),
+                           ('direction', 'S1'), ('utc_hours', 'u1'), ('utc_minutes', 'u1')])
+    assert RESOLUTION_DTYPE.itemsize == FIXED_WIDTHS[IPP_TAG_RESOLUTION]
+    assert DATE_DTYPE.itemsize == FIXED_WIDTHS[IPP_TAG_DATE]
+
+
+def decode_column(tag, raw):
+    """Decode the concatenated fixed-width values of type `tag` in `raw`
+        Returns: NumPy array
+            integer, enum: int64, matching the unsigned values decode_integer() returns
+            boolean: bool
+            rangeOfInteger: int64 array of shape (n, 2) of lower, upper
+            resolution: structured array of x, y, units
+            dateTime: int64 seconds since the Unix epoch
+    """
+    require_numpy()
+    if tag in (IPP_TAG_INTEGER, IPP_TAG_ENUM):
+        return np.frombuffer(raw, dtype='>u4').astype(np.int64)
+    if tag == IPP_TAG_BOOLEAN:
+        return np.frombuffer(raw, dtype=np.uint8) != 0
+    if tag == IPP_TAG_RANGE:
+        return np.frombuffer(raw, dtype='>u4').astype(np.int64).reshape(-1, 2)
+    if tag == IPP_TAG_RESOLUTION:
+        return np.frombuffer(raw, dtype=RESOLUTION_DTYPE)
+    if tag == IPP_TAG_DATE:
+        return decode_dates(raw)
+    assert False, 'Not a fixed-width tag: %s' % tag_name(tag)
+
+
+def main():
+    assert len(sys.argv) > 1, 'Usage: python %s <dir> [attribute name]...' % sys.argv[0]
+    gatherer = ColumnGatherer(sys.argv[2:] or None)
+    for path in recursive_glob(sys.argv[1]):
+        try:
+            gatherer.add_file(path)
+        except Exception as e:
+            print('bad path="%s" %s' % (path, e))
+    print(gatherer)
+    for (name, tag), (rows, values) in sorted(gatherer.arrays().items()):
+        if values.dtype.names:
+            print('%-40s %-22s n=%d' % (name, tag_name(tag), len(values)))
+        else:
+            print('%-40s %-22s n=%d min=%s max=%s' % (name, tag_name(tag), len(values),
+                                                     values.min(), values.max()))
+
+
+if __name__ == '__main__':
+    main()
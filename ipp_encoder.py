@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+    Encode {group_tag: {name: value}} dicts, the shape parse_top() returns, as IPP messages
+
+    https://tools.ietf.org/html/draft-sweet-rfc2910bis-07
+    https://tools.ietf.org/html/rfc3382 (collections)
+
+    The dicts don't record value tags so they are taken from ATTRIBUTE_TAGS or inferred from the
+    Python type of each value:
+
+        bool                        IPP_TAG_BOOLEAN
+        int                         IPP_TAG_INTEGER, or IPP_TAG_ENUM for ENUM_ATTRIBUTES
+        str                         IPP_TAG_NAME for *-name, IPP_TAG_URI for *-uri,
+                                    IPP_TAG_DATE for date-time-*, IPP_TAG_KEYWORD for keyword-like
+                                    strings, otherwise IPP_TAG_TEXT
+        datetime                    IPP_TAG_DATE
+        bytes                       IPP_TAG_STRING
+        (int, bytes)                IPP_TAG_EXTENSION (type tag, octets)
+        (int, int)                  IPP_TAG_RANGE
+        (int, int, int)             IPP_TAG_RESOLUTION
+        (str, str)                  IPP_TAG_TEXTLANG (language, text)
+        dict                        IPP_TAG_BEGIN_COLLECTION
+        list                        1setOf. Empty lists can't be encoded
+        None                        IPP_TAG_NOVALUE
+
+    IPPEncoder writes into a bytearray that is allocated once and reused, growing it only when a
+    message doesn't fit.
+"""
+from __future__ import division, print_function
+import re
+import sys
+from datetime import datetime
+from ipp_reader import (IPP_BUF_SIZE, IPP_TAG_END, IPP_TAG_NOVALUE, IPP_TAG_INTEGER,
+                        IPP_TAG_BOOLEAN, IPP_TAG_ENUM, IPP_TAG_STRING, IPP_TAG_DATE,
+                        IPP_TAG_RESOLUTION, IPP_TAG_RANGE, IPP_TAG_BEGIN_COLLECTION,
+                        IPP_TAG_TEXTLANG, IPP_TAG_NAMELANG, IPP_TAG_END_COLLECTION, IPP_TAG_TEXT,
+                        IPP_TAG_NAME, IPP_TAG_KEYWORD, IPP_TAG_URI, IPP_TAG_CHARSET,
+                        IPP_TAG_LANGUAGE, IPP_TAG_MIMETYPE, IPP_TAG_MEMBERNAME, IPP_TAG_EXTENSION,
+                        OUT_OF_BAND_TAGS, STRING_TAGS, HEADER, BE2, BE4, RANGE, RESOLUTION, DATE,
+                        decode_message)
+
+
+ATTRIBUTE_TAGS = {
+    'attributes-charset': IPP_TAG_CHARSET,
+    'attributes-natural-language': IPP_TAG_LANGUAGE,
+    'charset-configured': IPP_TAG_CHARSET,
+    'charset-supported': IPP_TAG_CHARSET,
+    'natural-language-configured': IPP_TAG_LANGUAGE,
+    'generated-natural-language-supported': IPP_TAG_LANGUAGE,
+    'document-format': IPP_TAG_MIMETYPE,
+    'document-format-default': IPP_TAG_MIMETYPE,
+    'document-format-supported': IPP_TAG_MIMETYPE,
+}
+
+ENUM_ATTRIBUTES = {
+    'job-state',
+    'printer-state',
+    'operations-supported',
+    'finishings',
+    'finishings-default',
+    'finishings-supported',
+    'orientation-requested',
+    'orientation-requested-default',
+    'orientation-requested-supported',
+    'print-quality',
+    'print-quality-default',
+    'print-quality-supported',
+    'printer-type',
+    'printer-type-mask',
+}
+
+RE_KEYWORD = re.compile(r'^[a-z0-9][a-z0-9._-]*$')
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'    # str(datetime), as decode_date() returns
+U32 = 0xffffffff
+
+
+def value_tag(name, value, tags=ATTRIBUTE_TAGS):
+    """Returns: value tag to encode `value` of attribute `name` with"""
+    tag = tags.get(name)
+    if tag is not None:
+        return tag
+    if isinstance(value, bool):
+        return IPP_TAG_BOOLEAN
+    if isinstance(value, int):
+        return IPP_TAG_ENUM if name in ENUM_ATTRIBUTES else IPP_TAG_INTEGER
+    if isinstance(value, str):
+        if name.startswith('date-time-'):
+            return IPP_TAG_DATE
+        if name.endswith('-uri') or name.endswith('-uri-supported'):
+            return IPP_TAG_URI
+        if name.endswith('-name'):
+            return IPP_TAG_NAME
+        return IPP_TAG_KEYWORD if RE_KEYWORD.match(value) else IPP_TAG_TEXT
+    if isinstance(value, dict):
+        return IPP_TAG_BEGIN_COLLECTION
+    if isinstance(value, tuple):
+        if len(value) == 2 and all(isinstance(v, str) for v in value):
+            return IPP_TAG_TEXTLANG
+        if (len(value) == 2 and isinstance(value[0], int) and
+                isinstance(value[1], (bytes, bytearray, memoryview))):
+            return IPP_TAG_EXTENSION
+        if len(value) == 2:
+            return IPP_TAG_RANGE
+        if len(value) == 3:
+            return IPP_TAG_RESOLUTION
+    if isinstance(value, datetime):
+        return IPP_TAG_DATE
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return IPP_TAG_STRING
+    if value is None:
+        return IPP_TAG_NOVALUE
+    assert False, 'Cannot encode %s=%r' % (name, value)
+
+
+def encode_text(s):
+    """Inverse of decode_string(), which decodes latin-1"""
+    try:
+        return s.encode('latin-1')
+    except UnicodeEncodeError:
+        return s.encode('utf-8')
+
+
+class IPPEncoder(object):
+    """Encodes attribute dicts into a reusable buffer
+        encoder = IPPEncoder()
+        view = encoder.encode(top, request_id=7)   # valid until the next encode()
+    """
+
+    def __init__(self, size=IPP_BUF_SIZE, tags=ATTRIBUTE_TAGS):
+        self.buf = bytearray(size)
+        self.n = 0
+        self.tags = tags
+        self.names = {}     # attribute name: encoded name, as names repeat from message to message
+
+    def __repr__(self):
+        return 'IPPEncoder{size=%d,n=%d}' % (len(self.buf), self.n)
+
+    def reserve(self, k):
+        """Make room for `k` more bytes"""
+        need = self.n + k
+        size = len(self.buf)
+        if need > size:
+            while size < need:
+                size *= 2
+            # A new buffer rather than extend() as views from encode() may still be held
+            buf = bytearray(size)
+            buf[:self.n] = memoryview(self.buf)[:self.n]
+            self.buf = buf
+
+    def write(self, data):
+        n = len(data)
+        self.reserve(n)
+        self.buf[self.n:self.n + n] = data
+        self.n += n
+
+    def write_byte(self, b):
+        self.reserve(1)
+        self.buf[self.n] = b
+        self.n += 1
+
+    def encode_name(self, name):
+        if name is None:
+            return b''
+        encoded = self.names.get(name)
+        if encoded is None:
+            encoded = self.names[name] = encode_text(name)
+        return encoded
+
+    def write_header(self, tag, name, v):
+        """Write value-tag, name-length, name and value-length for a `v` byte value"""
+        encoded = self.encode_name(name)
+        u = len(encoded)
+        self.reserve(5 + u + v)
+        buf = self.buf
+        i = self.n
+        buf[i] = tag
+        BE2.pack_into(buf, i + 1, u)
+        buf[i + 3:i + 3 + u] = encoded
+        BE2.pack_into(buf, i + 3 + u, v)
+        self.n = i + 5 + u
+
+    def write_attribute(self, name, value):
+        """Write attribute `name` (None for collection members) with `value`"""
+        values = value if isinstance(value, list) else [value]
+        assert values, 'Cannot encode empty 1setOf %s' % name
+        self.write_value(name, values[0])
+        for value in values[1:]:
+            # additional values of a 1setOf have no name
+            self.write_value(None, value, name)
+
+    def write_value(self, name, value, tag_name=None):
+        tag = value_tag(tag_name or name or '', value, self.tags)
+        if tag == IPP_TAG_BEGIN_COLLECTION:
+            self.write_header(tag, name, 0)
+            for member_name, member_value in value.items():
+                encoded = self.encode_name(member_name)
+                self.write_header(IPP_TAG_MEMBERNAME, None, len(encoded))
+                self.write(encoded)
+                values = member_value if isinstance(member_value, list) else [member_value]
+                assert values, 'Cannot encode empty 1setOf %s' % member_name
+                for v in values:
+                    self.write_value(None, v, member_name)
+            self.write_header(IPP_TAG_END_COLLECTION, None, 0)
+            return
+
+        if tag in (IPP_TAG_INTEGER, IPP_TAG_ENUM):
+            self.write_header(tag, name, 4)
+            BE4.pack_into(self.buf, self.n, value & U32)
+            self.n += 4
+        elif tag == IPP_TAG_BOOLEAN:
+            self.write_header(tag, name, 1)
+            self.buf[self.n] = 1 if value else 0
+            self.n += 1
+        elif tag in STRING_TAGS:
+            encoded = encode_text(value)
+            self.write_header(tag, name, len(encoded))
+            self.write(encoded)
+        elif tag == IPP_TAG_DATE:
+            if isinstance(value, str):
+                value = datetime.strptime(value, DATE_FORMAT)
+            self.write_header(tag, name, DATE.size)
+            DATE.pack_into(self.buf, self.n, value.year, value.month, value.day, value.hour,
+                           value.minute, value.second, value.microsecond // 100000, b'+', 0, 0)
+            self.n += DATE.size
+        elif tag == IPP_TAG_RESOLUTION:
+            self.write_header(tag, name, RESOLUTION.size)
+            RESOLUTION.pack_into(self.buf, self.n, value[0] & U32, value[1] & U32, value[2])
+            self.n += RESOLUTION.size
+        elif tag == IPP_TAG_RANGE:
+            self.write_header(tag, name, RANGE.size)
+            RANGE.pack_into(self.buf, self.n, value[0] & U32, value[1] & U32)
+            self.n += RANGE.size
+        elif tag in (IPP_TAG_TEXTLANG, IPP_TAG_NAMELANG):
+            language, text = encode_text(value[0]), encode_text(value[1])
+            self.write_header(tag, name, 4 + len(language) + len(text))
+            for s in (language, text):
+                BE2.pack_into(self.buf, self.n, len(s))
+                self.n += 2
+                self.write(s)
+        elif tag in OUT_OF_BAND_TAGS:
+            encoded = encode_text(value) if value is not None else b''
+            self.write_header(tag, name, len(encoded))
+            self.write(encoded)
+        elif tag == IPP_TAG_EXTENSION:
+            ext_tag, data = value
+            self.write_header(tag, name, 4 + len(data))
+            BE4.pack_into(self.buf, self.n, ext_tag)
+            self.n += 4
+            self.write(data)
+        else:
+            # IPP_TAG_STRING and anything else given as bytes
+            self.write_header(tag, name, len(value))
+            self.write(value)
+
+    def encode(self, top, version=(2, 0), op_status=0, request_id=1, data=None):
+        """Encode `top`, a dict {group_tag: {name: value}}, as an IPP message
+            Returns: memoryview of the message in self.buf. It is only valid until the next call
+        """
+        self.n = 0
+        self.reserve(HEADER.size)
+        HEADER.pack_into(self.buf, 0, version[0], version[1], op_status, request_id)
+        self.n = HEADER.size
+        for group_tag, group in top.items():
+            self.write_byte(group_tag)
+            for name, value in group.items():
+                self.write_attribute(name, value)
+        self.write_byte(IPP_TAG_END)
+        if data:
+            self.write(data)
+        return memoryview(self.buf)[:self.n]
+
+
+def encode_message(top, version=(2, 0), op_status=0, request_id=1, data=None):
+    """Returns: IPP message for `top`, a dict {group_tag: {name: value}}, as bytes"""
+    return bytes(IPPEncoder().encode(top, version, op_status, request_id, data))
+
+
+def main():
+    """Re-encode a control file and check that it decodes to the same attributes"""
+    assert len(sys.argv) > 2, 'Usage: python %s <control file> <output file>' % sys.argv[0]
+    with open(sys.argv[1], 'rb') as f:
+        header, top = decode_message(f.read())
+    text = encode_message(top, header['version'], header['op_status'], header['request_id'])
+    assert decode_message(text)[1] == top, sys.argv[1]
+    with open(sys.argv[2], 'wb') as f:
+        f.write(text)
+    print('%s -> %s %d bytes' % (sys.argv[1], sys.argv[2], len(text)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+    Persistent corpus-wide attribute index
+
+    Records, for each (group tag, attribute name), which control files hold the attribute and
+    the decoded value, or for collections the sorted tuple of its member names and the offset and
+    length of the value in the file. Repeat queries are answered from the index instead of
+    re-parsing the corpus. The index is a directory with one pickle of postings per attribute
+    name, so a query reads only the postings of the attribute it asks about.
+
+        python ipp_index.py build <dir>                 # incremental on file size and mtime
+        python ipp_index.py files job-state 9           # files where job-state=9
+        python ipp_index.py files job-name "'123'"      # quoted: the string '123'
+        python ipp_index.py distinct printer-uri        # distinct values of printer-uri
+        python ipp_index.py files media-col "('media-size', 'media-type')"
+"""
+from __future__ import division, print_function
+import os
+import re
+import ast
+import time
+import pickle
+import hashlib
+import argparse
+from ipp_reader import IPP_TAG_BEGIN_COLLECTION, recursive_glob
+from ipp_lazy import IPPMessage, decode_span
+
+
+INDEX_PATH = 'ipp.index'
+INDEX_VERSION = 3
+
+
+def file_entries(path):
+    """Returns: list of (group_tag, name, tag, value, offset, length) for each attribute value in
+        control file `path`. value is the sorted tuple of member names for collections, which are
+        located by offset and length
+    """
+    with open(path, 'rb') as f:
+        msg = IPPMessage(f.read())
+    entries = []
+    for group_tag, group in msg.items():
+        for name in group:
+            for span in group.span(name):
+                tag, offset, length = span
+                value = decode_span(msg.buf, span)
+                if tag == IPP_TAG_BEGIN_COLLECTION:
+                    value = tuple(sorted(value))
+                entries.append((group_tag, name, tag, value, offset, length))
+    return entries
+
+
+class AttributeIndex(object):
+    """Index of attribute values over a corpus of control files, stored in directory
+        `index_path` as
+            files.pkl: `files`, read by update(), locations() and bad_files()
+            names/<hash of name>.pkl: the postings of one attribute name, read by queries on it
+        Both are loaded when first used
+        files: {path: (size, mtime_ns, entries, error)}, None until loaded
+        postings: {name: {group_tag: {value: set of paths}}} of the names loaded
+        Postings are saved before `files`, so a build that is interrupted while saving is
+        redone by the next build. Only files that change again in between can be left with
+        stale postings.
+    """
+
+    def __init__(self, index_path=INDEX_PATH):
+        self.index_path = index_path
+        self.files = None
+        self.postings = {}
+        self.changed = set()    # names whose postings have changed since they were saved
+
+    def __repr__(self):
+        return 'AttributeIndex{path=%s,files=%s,names=%d}' % (
+            self.index_path, len(self.files) if self.files is not None else '-',
+            len(self.postings))
+
+    def _files_path(self):
+        return os.path.join(self.index_path, 'files.pkl')
+
+    def _name_path(self, name):
+        digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(self.index_path, 'names', '%s.pkl' % digest)
+
+    def _load(self, path):
+        """Returns: contents of index pickle `path`, or None if there is none"""
+        assert not os.path.isfile(self.index_path), (
+            '%s is an index from an older version. Delete it and build again' % self.index_path)
+        try:
+            with open(path, 'rb') as f:
+                version, contents = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        assert version == INDEX_VERSION, (path, version)
+        return contents
+
+    def _save(self, path, contents):
+        temp_path = '%s.tmp' % path
+        with open(temp_path, 'wb') as f:
+            pickle.dump((INDEX_VERSION, contents), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def load_files(self):
+        """Returns: `files`, loading it if needed"""
+        if self.files is None:
+            files = self._load(self._files_path())
+            self.files = files if files is not None else {}
+        return self.files
+
+    def name_postings(self, name):
+        """Returns: {group_tag: {value: set of paths}} of attribute `name`, loading it if needed"""
+        postings = self.postings.get(name)
+        if postings is None:
+            contents = self._load(self._name_path(name))
+            if contents is None:
+                postings = {}
+            else:
+                stored_name, postings = contents
+                assert stored_name == name, (stored_name, name)
+            self.postings[name] = postings
+        return postings
+
+    def save(self):
+        os.makedirs(os.path.join(self.index_path, 'names'), exist_ok=True)
+        for name in sorted(self.changed):
+            postings = self.postings[name]
+            path = self._name_path(name)
+            if postings:
+                self._save(path, (name, postings))
+            elif os.path.exists(path):
+                os.remove(path)
+        self.changed.clear()
+        if self.files is not None:
+            self._save(self._files_path(), self.files)
+
+    def _add(self, path, entries):
+        for group_tag, name, tag, value, _, _ in entries:
+            value_paths = self.name_postings(name).setdefault(group_tag, {})
+            try:
+                value_paths.setdefault(value, set()).add(path)
+            except TypeError:
+                # unhashable value
+                value_paths.setdefault(repr(value), set()).add(path)
+            self.changed.add(name)
+
+    def _remove(self, path):
+        _, _, entries, _ = self.files.pop(path)
+        for group_tag, name, tag, value, _, _ in entries:
+            postings = self.name_postings(name)
+            value_paths = postings.get(group_tag, {})
+            try:
+                paths = value_paths.get(value, set())
+            except TypeError:
+                value = repr(value)
+                paths = value_paths.get(value, set())
+            paths.discard(path)
+            if not paths:
+                value_paths.pop(value, None)
+            if not value_paths:
+                postings.pop(group_tag, None)
+            self.changed.add(name)
+
+    def update(self, dir_name):
+        """Index the control files in `dir_name` that are new or whose size or mtime has changed
+            and drop files under `dir_name` that no longer exist
+            Returns: dict of counts of added, updated, removed, unchanged and bad files
+        """
+        self.load_files()
+        counts = dict.fromkeys(['added', 'updated', 'removed', 'unchanged', 'bad'], 0)
+        seen = set()
+        for path in recursive_glob(dir_name):
+            seen.add(path)
+            st = os.stat(path)
+            old = self.files.get(path)
+            if old is not None and old[:2] == (st.st_size, st.st_mtime_ns):
+                counts['unchanged'] += 1
+                continue
+            if old is not None:
+                self._remove(path)
+            try:
+                entries, error = file_entries(path), None
+            except Exception as e:
+                entries, error = [], '%s: %s' % (type(e).__name__, e)
+                counts['bad'] += 1
+            self.files[path] = (st.st_size, st.st_mtime_ns, entries, error)
+            self._add(path, entries)
+            counts['updated' if old is not None else 'added'] += 1
+
+        prefix = os.path.join(dir_name, '')
+        for path in [p for p in self.files if p not in seen and
+                     (p == dir_name or p.startswith(prefix))]:
+            self._remove(path)
+            counts['removed'] += 1
+        return counts
+
+    def _value_paths(self, name, group_tag=None):
+        """Returns: list of the {value: set of paths} of attribute `name` in group `group_tag`,
+            or in every group if group_tag is None
+        """
+        postings = self.name_postings(name)
+        if group_tag is not None:
+            return [postings[group_tag]] if group_tag in postings else []
+        return list(postings.values())
+
+    def files_where(self, name, value, group_tag=None):
+        """Returns: sorted list of files where attribute `name` has value `value`, or for 1setOf
+            attributes where `value` is one of its values
+        """
+        paths = set()
+        for value_paths in self._value_paths(name, group_tag):
+            paths |= value_paths.get(value, set())
+        return sorted(paths)
+
+    def files_with(self, name, group_tag=None):
+        """Returns: sorted list of files that have attribute `name`"""
+        paths = set()
+        for value_paths in self._value_paths(name, group_tag):
+            for value_paths_ in value_paths.values():
+                paths |= value_paths_
+        return sorted(paths)
+
+    def distinct(self, name, group_tag=None):
+        """Returns: sorted list of the distinct values of attribute `name`"""
+        values = set()
+        for value_paths in self._value_paths(name, group_tag):
+            values.update(value_paths)
+        return sorted(values, key=lambda v: (type(v).__name__, repr(v)))
+
+    def locations(self, path, name):
+        """Returns: list of (group_tag, tag, offset, length) of the values of attribute `name` in
+            file `path`
+        """
+        _, _, entries, _ = self.load_files()[path]
+        return [(group_tag, tag, offset, length)
+                for group_tag, name_, tag, _, offset, length in entries if name_ == name]
+
+    def bad_files(self):
+        return {path: error for path, (_, _, _, error) in self.load_files().items() if error}
+
+
+def parse_literal(text):
+    """Returns: `text` as a Python literal if it is a quoted string (e.g. '123') or is written
+        the way Python writes the literal (e.g. 9, None or (1, 5)), otherwise `text`, so strings
+        such as 1e3 or 0x10 are not turned into numbers
+    """
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+    if isinstance(value, (str, bytes)) or (re.sub(r'\s', '', repr(value)) ==
+                                           re.sub(r'\s', '', text)):
+        return value
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Persistent attribute index of control files')
+    parser.add_argument('--index', default=INDEX_PATH, help='index directory')
+    parser.add_argument('--group', type=int, default=None, help='restrict queries to group tag')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('build', help='index new and changed files in a directory')
+    p.add_argument('path')
+    p = subparsers.add_parser('files', help='files with an attribute, or attribute value')
+    p.add_argument('name')
+    p.add_argument('value', nargs='?',
+                   help="Python literal, quoted for strings that look like one, e.g. \"'123'\"")
+    p = subparsers.add_parser('distinct', help='distinct values of an attribute')
+    p.add_argument('name')
+    subparsers.add_parser('bad', help='files that could not be parsed')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('no command')
+
+    t0 = time.time()
+    index = AttributeIndex(args.index)
+    if args.command == 'build':
+        counts = index.update(args.path)
+        index.save()
+        print(counts)
+    elif args.command == 'files':
+        if args.value is None:
+            results = index.files_with(args.name, args.group)
+        else:
+            results = index.files_where(args.name, parse_literal(args.value), args.group)
+        for path in results:
+            print(path)
+    elif args.command == 'distinct':
+        for value in index.distinct(args.name, args.group):
+            print(repr(value))
+    elif args.command == 'bad':
+        for path, error in sorted(index.bad_files().items()):
+            print('%s: %s' % (path, error))
+    print('%s %s=%.1f ms' % (index, args.command, (time.time() - t0) * 1000))
+
+
+if __name__ == '__main__':
+    main()
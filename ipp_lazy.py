@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    Lazily decoded IPP messages
+
+    IPPMessage makes one structural pass over an IPP message that records where each group and
+    attribute value is, without decoding any values. Values are decoded when they are accessed.
+
+        msg = IPPMessage(text)
+        msg[IPP_TAG_JOB]['job-name']
+
+    IPPMessage is a mapping {group_tag: {name: value}} with the same contents as the dict
+    parse_top() returns.
+"""
+from __future__ import division, print_function
+import sys
+from collections.abc import Mapping
+from pprint import pprint
+from ipp_reader import (IPP_TAG_END, IPP_TAG_BEGIN_COLLECTION, IPP_TAG_END_COLLECTION,
+                        GROUP_TAGS, HEADER, BE2, tag_describe, decode_header, decode_value,
+                        decode_group)
+
+
+def index_group(buf, i):
+    """Record the value spans of the attributes in the group starting at offset `i` in `buf`
+        Returns: spans, i
+            spans: {name: [(tag, offset, length), ...]} with one span per value. Collection
+                   spans have tag IPP_TAG_BEGIN_COLLECTION and cover the collection's members
+                   and its end-of-collection attribute
+            i: offset of the next group tag or end-of-attributes tag
+    """
+    unpack_be2 = BE2.unpack_from
+    size = len(buf)
+    spans = {}
+    values = None
+    while i < size:
+        tag = buf[i]
+        if tag in GROUP_TAGS or tag == IPP_TAG_END:
+            break
+        assert i + 3 <= size, 'Truncated attribute at %d' % i
+        n = unpack_be2(buf, i + 1)[0]
+        assert i + 3 + n + 2 <= size, 'Truncated attribute name at %d' % i
+        name = str(buf[i + 3:i + 3 + n], 'latin-1') if n else None
+        i += 3 + n
+        v = unpack_be2(buf, i)[0]
+        i += 2 + v
+        assert i <= size, 'Truncated attribute value at %d' % (i - v)
+        if tag == IPP_TAG_BEGIN_COLLECTION:
+            start = i
+            i = skip_collection(buf, i)
+            span = (tag, start, i - start)
+        else:
+            span = (tag, i - v, v)
+        if name is not None:
+            values = spans[name] = [span]
+        else:
+            # Additional value of a 1setOf attribute
+            assert values is not None, 'Additional value with no attribute at %d' % i
+            values.append(span)
+    return spans, i
+
+
+def skip_collection(buf, i):
+    """Returns: offset of the byte after the end of the collection whose members start at `i`"""
+    unpack_be2 = BE2.unpack_from
+    size = len(buf)
+    depth = 1
+    while depth:
+        assert i + 3 <= size, 'Truncated collection at %d' % i
+        tag = buf[i]
+        n = unpack_be2(buf, i + 1)[0]
+        assert i + 3 + n + 2 <= size, 'Truncated attribute name at %d' % i
+        i += 3 + n
+        v = unpack_be2(buf, i)[0]
+        i += 2 + v
+        assert i <= size, 'Truncated attribute value at %d' % (i - v)
+        if tag == IPP_TAG_BEGIN_COLLECTION:
+            depth += 1
+        elif tag == IPP_TAG_END_COLLECTION:
+            depth -= 1
+    return i
+
+
+def decode_span(buf, span):
+    tag, i, n = span
+    if tag == IPP_TAG_BEGIN_COLLECTION:
+        return decode_group(buf, i, 1)[0]
+    return decode_value(buf, i, tag, n) if n else None
+
+
+class LazyGroup(Mapping):
+    """Mapping {name: value} for one attribute group. Values are decoded on first access"""
+
+    __slots__ = ('buf', 'spans', 'cache')
+
+    def __init__(self, buf, spans):
+        self.buf = buf
+        self.spans = spans
+        self.cache = {}
+
+    def __repr__(self):
+        return 'LazyGroup(%s)' % sorted(self.spans)
+
+    def __getitem__(self, name):
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        spans = self.spans[name]
+        if len(spans) == 1:
+            value = decode_span(self.buf, spans[0])
+        else:
+            value = [decode_span(self.buf, span) for span in spans]
+        self.cache[name] = value
+        return value
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __contains__(self, name):
+        return name in self.spans
+
+    def span(self, name):
+        """Returns: [(tag, offset, length), ...] for the values of attribute `name`"""
+        return self.spans[name]
+
+    def to_dict(self):
+        return {name: self[name] for name in self.spans}
+
+
+class IPPMessage(Mapping):
+    """Mapping {group_tag: LazyGroup} over an IPP message in bytes-like `text`"""
+
+    def __init__(self, text):
+        buf = memoryview(text)
+        self.buf = buf
+        self.header = decode_header(buf)
+        self.groups = {}
+        size = len(buf)
+        i = HEADER.size
+        while i < size:
+            tag = buf[i]
+            if tag == IPP_TAG_END:
+                break
+            assert tag in GROUP_TAGS, tag_describe(tag)
+            spans, i = index_group(buf, i + 1)
+            self.groups[tag] = LazyGroup(buf, spans)
+        self.end_offset = i
+
+    def __repr__(self):
+        return 'IPPMessage{len=%d,groups=%s}' % (len(self.buf), sorted(self.groups))
+
+    def __getitem__(self, group_tag):
+        return self.groups[group_tag]
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def lookup(self, name, default=None):
+        """Returns: value of attribute `name` in the first group that has it"""
+        for group in self.groups.values():
+            if name in group:
+                return group[name]
+        return default
+
+    def to_dict(self):
+        """Returns: dict of top level groups, as parse_top() returns"""
+        return {tag: group.to_dict() for tag, group in self.groups.items()}
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return IPPMessage(f.read())
+
+
+def main():
+    assert len(sys.argv) > 2, 'Usage: python %s <control file> <attribute name>...' % sys.argv[0]
+    msg = load(sys.argv[1])
+    print(msg)
+    pprint({name: msg.lookup(name) for name in sys.argv[2:]})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+    Timers, counters, value tag histograms and trace events for ipp_reader
+
+    ipp_reader only touches a Metrics when one has been installed with set_metrics(), so
+    instrumentation costs a `METRICS is not None` test when it is off.
+
+        python ipp_reader.py <dir> --fast --metrics metrics.json [--trace]
+
+    metrics.json has
+        stages: {stage: {calls, seconds}}
+        counts: files, bytes, groups, attributes, values, collections ...
+        tags: {tag name: values decoded}
+        traceEvents: Chrome trace format complete events, one per stage of each file, with
+                     --trace. metrics.json can be opened in chrome://tracing or Perfetto
+"""
+from __future__ import division, print_function
+import os
+import json
+import time
+import threading
+from collections import Counter, defaultdict
+
+
+MAX_EVENTS = 1000000
+
+
+def tag_label(tag):
+    """Returns: name of value tag `tag`, or its hex value for tags ipp_reader doesn't name"""
+    from ipp_reader import TAG_NAME
+    return TAG_NAME.get(tag, '0x%02x' % tag)
+
+
+def label_tag(label):
+    """Inverse of tag_label()"""
+    from ipp_reader import TAG_DICT
+    return TAG_DICT[label] if label in TAG_DICT else int(label, 16)
+
+
+class StageTimer(object):
+    """Context manager that adds the time spent in its block to stage `name` of `metrics`"""
+
+    __slots__ = ('metrics', 'name', 'path', 't0')
+
+    def __init__(self, metrics, name, path):
+        self.metrics = metrics
+        self.name = name
+        self.path = path
+        self.t0 = None
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, self.t0, time.perf_counter(), self.path)
+        return False
+
+
+class Metrics(object):
+    """Per-stage timers, counters, a value tag histogram and, if `trace` is True, up to
+        `max_events` trace events
+    """
+
+    def __init__(self, trace=False, max_events=MAX_EVENTS):
+        self.trace = trace
+        self.max_events = max_events
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counts = Counter()
+        self.tags = Counter()      # value tag: values decoded
+        self.events = []
+        # Trace timestamps are wall clock microseconds so events from worker processes line up
+        self.offset = time.time() - time.perf_counter()
+
+    def __repr__(self):
+        return 'Metrics{stages=%d,counts=%s,events=%d}' % (len(self.calls), dict(self.counts),
+                                                           len(self.events))
+
+    def config(self):
+        """Returns: arguments to create a Metrics with the same configuration, e.g. in a worker"""
+        return self.trace, self.max_events
+
+    def stage(self, name, path=None):
+        """Returns: context manager that times its block as stage `name`, for file `path`"""
+        return StageTimer(self, name, path)
+
+    def add_time(self, name, t0, t1, path=None):
+        self.seconds[name] += t1 - t0
+        self.calls[name] += 1
+        if self.trace and len(self.events) < self.max_events:
+            event = {'name': name, 'ph': 'X', 'pid': os.getpid(),
+                     'tid': threading.get_ident() & 0xffff,
+                     'ts': (t0 + self.offset) * 1e6, 'dur': (t1 - t0) * 1e6}
+            if path is not None:
+                event['args'] = {'path': path}
+            self.events.append(event)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def to_dict(self):
+        """Returns: JSON serializable dict of everything recorded"""
+        return {
+            'stages': {name: {'calls': self.calls[name], 'seconds': self.seconds[name]}
+                       for name in sorted(self.calls)},
+            'counts': dict(sorted(self.counts.items())),
+            'tags': {tag_label(tag): n for tag, n in self.tags.most_common()},
+            'traceEvents': self.events,
+        }
+
+    def pop(self):
+        """Returns: to_dict() of everything recorded so far, which is then cleared"""
+        d = self.to_dict()
+        self.seconds.clear()
+        self.calls.clear()
+        self.counts.clear()
+        self.tags.clear()
+        self.events = []
+        return d
+
+    def merge(self, other):
+        """Add `other`, a to_dict() from another process, to this Metrics"""
+        for name, stage in other['stages'].items():
+            self.seconds[name] += stage['seconds']
+            self.calls[name] += stage['calls']
+        self.counts.update(other['counts'])
+        self.tags.update({label_tag(label): n for label, n in other['tags'].items()})
+        room = self.max_events - len(self.events)
+        if room > 0:
+            self.events.extend(other['traceEvents'][:room])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def describe(self):
+        """Returns: multi-line summary of stages, counts and the commonest tags"""
+        lines = ['metrics:']
+        for name in sorted(self.calls, key=lambda k: -self.seconds[k]):
+            seconds = self.seconds[name]
+            lines.append('  %-24s %8d calls %9.3f s %9.1f us/call' % (
+                         name, self.calls[name], seconds, seconds / self.calls[name] * 1e6))
+        for name, n in sorted(self.counts.items()):
+            lines.append('  %-24s %12d' % (name, n))
+        if self.tags:
+            lines.append('  tags: %s' % ', '.join('%s=%d' % (tag_label(tag), n)
+                                                  for tag, n in self.tags.most_common(10)))
+        return '\n'.join(lines)
@@ -52,9 +52,19 @@ from __future__ import division, print_function
 import sys
 import os
 import csv
+import io
+import json
+import mmap
+import signal
+import struct
+import argparse
+import traceback
+import multiprocessing
+from contextlib import redirect_stdout, nullcontext
 from datetime import datetime
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict, Counter
 from pprint import pprint
+from ipp_sketch import NameValStats
 
 
 IPP_BUF_SIZE = 32767
@@ -117,6 +127,25 @@ TAG_NAME = {v: k for k, v in TAG_DICT.items()}
 
 DEBUG = False
 
+# Limits on untrusted messages: collection nesting depth and size in bytes of the attribute
+# section. Document data after the end-of-attributes tag does not count towards MAX_SIZE
+MAX_DEPTH = 32
+MAX_SIZE = 64 * 1024 * 1024
+
+# ipp_cache.ParseCache used by process_file(), if any
+CACHE = None
+# Part of CACHE keys. Bump it whenever a change makes parse_body_slow() or parse_body_fast()
+# return something different for the same file, so cached results of the old code are not used
+DECODER_VERSION = 1
+
+# ipp_segments.SegmentWriter used by save_attribute_dict() instead of a CSV per file, if any
+WRITER = None
+
+# ipp_metrics.Metrics that stage timers, counters and the value tag histogram are recorded in,
+# if any. Everything instrumented tests `METRICS is not None` first so it costs nothing when off
+METRICS = None
+NO_STAGE = nullcontext()
+
 
 def tag_name(tag):
     return TAG_NAME.get(tag, 'UNKNOWN')
@@ -129,10 +158,24 @@ def tag_describe(tag):
 
 
 def dprint(msg):
+    """Print `msg` if DEBUG is set. Hot paths test DEBUG before calling dprint() so they don't
+        format messages that won't be printed
+    """
     if DEBUG:
         print(msg)
 
 
+def check_size(n, max_size=MAX_SIZE):
+    assert n <= max_size, 'Attribute section is %d bytes. Limit is %d' % (n, max_size)
+
+
+def stage(name, path=None):
+    """Returns: context manager that times its block as stage `name` in METRICS, if set"""
+    if METRICS is None:
+        return NO_STAGE
+    return METRICS.stage(name, path)
+
+
 def recursive_glob(path):
     """Generator that returns all files in directory `path` if path is a directory, or path itself
         if path is not a directory.
@@ -184,13 +227,15 @@ class IPP:
     def peek(ipp, n, is_read=False):
         assert 0 <= ipp.i, (n, ipp.i, len(ipp.text))
         assert n > 0
-        op = 'read' if is_read else 'peek'
-        dprint('    %s len=%d i=%4d n=%2d data=%s' %
-               (op, len(ipp.text), ipp.i, n, H(ipp.text[ipp.i:], min(n, 20))))
+        if DEBUG:
+            op = 'read' if is_read else 'peek'
+            dprint('    %s len=%d i=%4d n=%2d data=%s' %
+                   (op, len(ipp.text), ipp.i, n, H(ipp.text[ipp.i:], min(n, 20))))
         assert ipp.i + n <= len(ipp.text)
         assert ipp.i < len(ipp.text)
         if ipp.i + n >= len(ipp.text):
-            dprint('Done reading IPP')
+            if DEBUG:
+                dprint('Done reading IPP')
             return None
         return ipp.text[ipp.i:ipp.i + n]
 
@@ -206,8 +251,9 @@ class IPP:
         tag = byts[0]
         assert tag != IPP_TAG_END
         assert tag in TAG_NAME, tag
-        op = 'r' if is_read else 'p'
-        dprint('!@@%s: %s i=%d' % (op, tag_describe(tag), ipp.i))
+        if DEBUG:
+            op = 'r' if is_read else 'p'
+            dprint('!@@%s: %s i=%d' % (op, tag_describe(tag), ipp.i))
         ipp.i_tag = ipp.i
         return tag
 
@@ -248,6 +294,130 @@ def decode_datetime(value):
     return str(datetime(year, month, day, hour, minute, second))
 
 
+# Value decoders. Each takes (buf, i, n) and decodes the `n` byte value at offset `i` of the
+# bytes-like `buf`. VALUE_DECODERS maps every tag in TAG_DICT to its decoder.
+
+HEADER = struct.Struct('>BBHI')       # version major, minor, op_status, request_id
+BE2 = struct.Struct('>H')
+BE4 = struct.Struct('>I')
+RANGE = struct.Struct('>II')
+RESOLUTION = struct.Struct('>IIB')
+DATE = struct.Struct('>HBBBBBBcBB')
+
+OUT_OF_BAND_TAGS = (IPP_TAG_UNSUPPORTED_VALUE,
+                    IPP_TAG_DEFAULT,
+                    IPP_TAG_UNKNOWN,
+                    IPP_TAG_NOVALUE,
+                    IPP_TAG_NOTSETTABLE,
+                    IPP_TAG_DELETEATTR,
+                    IPP_TAG_ADMINDEFINE)
+
+STRING_TAGS = (IPP_TAG_TEXT,
+               IPP_TAG_NAME,
+               IPP_TAG_RESERVED_STRING,
+               IPP_TAG_KEYWORD,
+               IPP_TAG_URI,
+               IPP_TAG_URISCHEME,
+               IPP_TAG_CHARSET,
+               IPP_TAG_LANGUAGE,
+               IPP_TAG_MIMETYPE,
+               IPP_TAG_MEMBERNAME)
+
+
+def decode_integer(buf, i, n):
+    assert n == 4, n
+    return BE4.unpack_from(buf, i)[0]
+
+
+def decode_boolean(buf, i, n):
+    assert n == 1, n
+    return buf[i] != 0
+
+
+def decode_string(buf, i, n):
+    # latin-1 maps each byte to chr(byte) as T() does
+    return str(buf[i:i + n], 'latin-1')
+
+
+def decode_octets(buf, i, n):
+    return bytes(buf[i:i + n])
+
+
+def decode_date(buf, i, n):
+    """See decode_datetime()"""
+    assert n == 11, n
+    year, month, day, hour, minute, second = DATE.unpack_from(buf, i)[:6]
+    return str(datetime(year, month, day, hour, minute, second))
+
+
+def decode_resolution(buf, i, n):
+    assert n == 9, n
+    return RESOLUTION.unpack_from(buf, i)
+
+
+def decode_range(buf, i, n):
+    assert n == 8, n
+    return RANGE.unpack_from(buf, i)
+
+
+def decode_string_with_language(buf, i, n):
+    """text-with-language and name-with-language are composite values:
+            language-length
+            language
+            text-length
+            text
+        Returns: language, text
+    """
+    assert n >= 4, n
+    end = i + n
+    m = BE2.unpack_from(buf, i)[0]
+    i += 2
+    language = str(buf[i:i + m], 'latin-1')
+    i += m
+    m = BE2.unpack_from(buf, i)[0]
+    i += 2
+    assert i + m == end, (i, m, end)
+    return language, str(buf[i:i + m], 'latin-1')
+
+
+def decode_out_of_band(buf, i, n):
+    """These value types are not supposed to have values, however some vendors (Brother) do not
+        implement IPP correctly and so we map non-empty values to text.
+    """
+    return str(buf[i:i + n], 'latin-1') if n else None
+
+
+def decode_extension(buf, i, n):
+    """https://tools.ietf.org/html/rfc8010#section-3.5.2
+        The first 4 bytes of an extension value are the 32-bit type tag
+        Returns: tag, octets
+    """
+    assert n >= 4, n
+    return BE4.unpack_from(buf, i)[0], bytes(buf[i + 4:i + n])
+
+
+def decode_invalid(buf, i, n):
+    assert False, 'Not a value tag: i=%d n=%d' % (i, n)
+
+
+VALUE_DECODERS = {tag: decode_invalid for tag in TAG_NAME}
+VALUE_DECODERS.update({tag: decode_out_of_band for tag in OUT_OF_BAND_TAGS})
+VALUE_DECODERS.update({tag: decode_string for tag in STRING_TAGS})
+VALUE_DECODERS.update({
+    IPP_TAG_INTEGER: decode_integer,
+    IPP_TAG_BOOLEAN: decode_boolean,
+    IPP_TAG_ENUM: decode_integer,
+    IPP_TAG_STRING: decode_octets,
+    IPP_TAG_DATE: decode_date,
+    IPP_TAG_RESOLUTION: decode_resolution,
+    IPP_TAG_RANGE: decode_range,
+    IPP_TAG_TEXTLANG: decode_string_with_language,
+    IPP_TAG_NAMELANG: decode_string_with_language,
+    IPP_TAG_EXTENSION: decode_extension,
+})
+assert set(VALUE_DECODERS) == set(TAG_NAME)
+
+
 class Group(object):
 
     def __init__(self, name,  value):
@@ -321,118 +491,21 @@ def parse_value(ipp, depth, tag, value):
 
         NOTE: 0x40 is reserved for "generic character-string" if it should ever be needed.
     """
-    n = len(value) if value is not None else None
-    assert isinstance(depth, int), depth
-    dprint('parse_value: d=%d,i=%d,tag=%s' % (depth, ipp.i_tag, tag_describe(tag)))
-
-    if tag in (IPP_TAG_INTEGER, IPP_TAG_ENUM):
-        assert n == 4, (tag, n)
-        return be4(value)
-
-    elif tag == IPP_TAG_BOOLEAN:
-        assert n == 1, (tag, n)
-        return bool(value)
-
-    elif tag in (IPP_TAG_NOVALUE,
-                 IPP_TAG_NOTSETTABLE,
-                 IPP_TAG_DELETEATTR,
-                 IPP_TAG_ADMINDEFINE):
-        assert False
-
-        # These value types are not supposed to have values, however
-        # some vendors (Brother) do not implement IPP correctly and so
-        # we need to map non-empty values to text...
-
-        if value.tag == tag:
-            if n == 0:
-                return
-            # !@#$ has no effect
-            attr.value_tag = IPP_TAG_TEXT
-
-    if tag in (IPP_TAG_TEXT,
-               IPP_TAG_NAME,
-               IPP_TAG_KEYWORD,
-               IPP_TAG_URI,
-               IPP_TAG_URISCHEME,
-               IPP_TAG_CHARSET,
-               IPP_TAG_LANGUAGE,
-               IPP_TAG_MIMETYPE):
-        return T(value)
-
-    elif tag == IPP_TAG_DATE:
-        assert n == 11, (tag, n)
-        return decode_datetime(value)
-
-    elif tag == IPP_TAG_RESOLUTION:
-        assert n == 9, (tag, n)
-        xres = be4(value[:4])
-        yres = be4(value[4:8])
-        units = value[8]
-        return tuple((xres, yres, units))
-
-    elif tag == IPP_TAG_RANGE:
-        assert n == 8, (tag, n)
-        lower = be4(value[:4])
-        upper = be4(value[4:])
-        return tuple((lower, upper))
-
-    elif tag in (IPP_TAG_TEXTLANG,
-                 IPP_TAG_NAMELANG):
-        assert n >= 4, (tag, n)
-
-        assert False
-
-        buf = ipp.read(n)
-        s = buf
-
-        # text-with-language and name-with-language are composite values:
-        #     language-length
-        #     language
-        #     text-length
-        #     text
-
-        n = be2[s]
-        value['string.language'] = s[2:2 + n]
-
-        s = buf[2 + n:]
-        n = be2(s)
-        value['string.text'] = s[2:2 + n]
-
-    elif tag == IPP_TAG_BEGIN_COLLECTION:
+    if tag == IPP_TAG_BEGIN_COLLECTION:
         # https://tools.ietf.org/html/rfc3382
-
         assert value is None, (value, T(value))
+        return parse_group(ipp, depth + 1)
 
-        # attr_name_tag = ipp.read_tag()
-        # assert attr_name_tag == IPP_TAG_MEMBERNAME, (tag_describe(attr_name_tag))
-        # print('@@4', tag_describe(attr_name_tag))
-        # n = be2(ipp.read(2))
-        # assert n == 0, n
-        # v = be2(ipp.read(2))
-        # print('@@6', v)
-        # member_name = ipp.read(v)
-        # print('!!!!!**', depth + 1, T(member_name))
-        # assert False
-        group_attributes = parse_group(ipp, depth + 1)
-        return group_attributes
-        assert n == 0, (tag, n)
-
-    elif tag == IPP_TAG_END_COLLECTION:
-
-        assert False
-
-    elif tag == IPP_TAG_MEMBERNAME:
-        return T(value)
-
-    else:  # Other unsupported values
-        assert False, 'Unsupported'
-        pass
-
-    return value
+    return VALUE_DECODERS.get(tag, decode_octets)(bytes(value), 0, len(value))
 
 
-def parse_group(ipp, depth, name=None):
+def parse_group(ipp, depth, name=None, max_depth=MAX_DEPTH, max_size=MAX_SIZE):
     """Parse an attribute group
+        Nested collections are parsed with an explicit stack of the enclosing groups rather
+        than by recursion. Collections nested more than `max_depth` deep are rejected, as are
+        attributes that would take the attribute section past `max_size` bytes. The size is
+        checked before each value is read, so an oversized message is rejected without
+        parsing the rest of the group.
         Returns: tag, group
             where
                 tag: last tag read, not part of group
@@ -457,116 +530,95 @@ def parse_group(ipp, depth, name=None):
         |                     value                   |   v bytes
         -----------------------------------------------
     """
-    dprint('----- parse_group ---- depth=%d' % depth)
-    # group = OrderedDict()
+    if DEBUG:
+        dprint('----- parse_group ---- depth=%d' % depth)
+    tags = METRICS.tags if METRICS is not None else None
+    # Single pass: attributes are added to `group` as they are read
     group = {}
-    tag = None  # if depth == 0 else IPP_TAG_BEGIN_COLLECTION
-    name = None
-    # values = []
-
-    truples = []
-
-    # def add_attribute(tag, name, values):
-    #     if name and values:
-    #         assert isinstance(name, str), name
-    #         value = values[0] if len(values) == 1 else values
-    #         group[name] = tag, value
-
-    for cnt in range(10 ** 6):
+    name = None         # name of the attribute that values without a name are added to
+    name_tag = None     # tag of its first value. All values of a 1setOf have the same tag
+    values = None       # list of its values once it has more than one
+    member_name = None  # collection member name read but not yet given a value
+    stack = []          # (group, name, name_tag, values, member_name, attr_name, cnt) of the
+                        # enclosing groups
+    cnt = 0             # attributes read in `group`
+
+    for _ in range(10 ** 6):
         tag = ipp.peek_tag()
         if tag is None or tag in GROUP_TAGS:
             # assert False, (tag_describe(tag), cnt, ipp)
-            assert depth == 0, (depth, tag_describe(tag))
+            assert depth == 0 and not stack, (depth, tag_describe(tag))
             break
 
         ipp.read_tag()
+        if tags is not None:
+            tags[tag] += 1
 
         if tag == IPP_TAG_END_COLLECTION:
             ipp.read(4)
-            print('### out of here', tag_describe(tag))
-            break
-
-        n = be2(ipp.read(2))
-        if n > 0:
-            name = T(ipp.read(n))
+            check_size(ipp.i, max_size)
+            if DEBUG:
+                dprint('### out of here %s' % tag_describe(tag))
+            if not stack:
+                break
+            assert group, cnt
+            value = group
+            group, name, name_tag, values, member_name, attr_name, cnt = stack.pop()
+            depth -= 1
+            tag = IPP_TAG_BEGIN_COLLECTION
         else:
-            name = None
-
-        assert tag is not None
+            cnt += 1
+            n = be2(ipp.read(2))
+            if n > 0:
+                attr_name = T(ipp.read(n))
+            else:
+                attr_name = None
+
+            v = be2(ipp.read(2))
+            check_size(ipp.i + v, max_size)
+            if DEBUG:
+                dprint('parse_group: d=%d,i=%d,tag=%s,name=%s,v=%d' %
+                       (depth, ipp.i_tag, tag_describe(tag), attr_name, v))
+
+            if tag == IPP_TAG_BEGIN_COLLECTION:
+                # https://tools.ietf.org/html/rfc3382
+                assert len(stack) < max_depth, 'Collections nested more than %d deep' % max_depth
+                if v > 0:
+                    ipp.read(v)
+                stack.append((group, name, name_tag, values, member_name, attr_name, cnt))
+                group = {}
+                name = name_tag = values = member_name = None
+                cnt = 0
+                depth += 1
+                continue
+            if v > 0:
+                value = parse_value(ipp, depth, tag, ipp.read(v))
+            else:
+                value = None
 
-        v = be2(ipp.read(2))
-        dprint('parse_group: d=%d,i=%d,tag=%s,name=%s,v=%d' %
-               (depth, ipp.i_tag, tag_describe(tag), name, v))
+        if DEBUG:
+            dprint('  value=%s %s' % (repr(value), type(value)))
 
-        if v > 0:
-            value = parse_value(ipp, depth, tag, ipp.read(v))
-        elif tag == IPP_TAG_BEGIN_COLLECTION:
-            value = parse_value(ipp, depth, tag, None)
-        else:
-            value = None
+        if tag == IPP_TAG_MEMBERNAME:
+            # The member's value follows with no name
+            assert attr_name is None, attr_name
+            assert isinstance(value, str), value
+            member_name = value
+            continue
+        if member_name is not None:
+            assert attr_name is None, attr_name
+            attr_name, member_name = member_name, None
 
-        dprint('  value=%s %s' % (repr(value), type(value)))
-        truples.append((tag, name, value))
-
-    assert truples
-
-    for i, (tag, name, value) in enumerate(truples):
-        if name is not None:
-            assert isinstance(name, str), (i, (tag, name, value))
-
-    truples2 = []
-    i = 0
-    accumulating = False
-    while i < len(truples):
-        tag0, name0, value0 = truples[i]
-        if tag0 == IPP_TAG_MEMBERNAME:
-            tag, name, value = truples[i + 1]
-            assert name0 is None, name0
-            assert name is None, name
-            assert isinstance(value0, str), value0
-            truples2.append((tag, value0, value))
-            print('^^^', i)
-            i += 2
-        else:
-            truples2.append((tag0, name0, value0))
-            if name0 is not None:
-                assert isinstance(name0, str), (i, (tag0, name0, value0))
-            i += 1
-
-    if len(truples2) != len(truples):
-        print('truples=%d' % len(truples))
-        print('truples2=%d' % len(truples2))
-
-    truples = truples2
-    for i, (tag, name, value) in enumerate(truples):
-        if name is not None:
-            assert isinstance(name, str), (i, (tag, name, value))
-
-    i = 0
-    accumulating = False
-    while i < len(truples):
-        tag, name, value = truples[i]
-        if not accumulating:
-            if name is None:
-                tag0, name0, value0 = truples[i - 1]
-                values = [value0, value]
-                accumulating = True
-        else:
-            if name is None:
-                values.append(value)
-            else:
-                accumulating = False
-                group[name0] = tag0, values
-        if accumulating:
-            assert tag == tag0
-        else:
-            # group[name] = tag, value
+        if attr_name is not None:
+            name, name_tag, values = attr_name, tag, None
             group[name] = value
-        i += 1
-
-    if accumulating and values:
-        # group[name0] = tag0, values
-        group[name0] = values
+        else:
+            # Additional value of a 1setOf attribute
+            assert name is not None, (cnt, tag_describe(tag))
+            assert tag == name_tag, (name, tag_describe(name_tag), tag_describe(tag))
+            if values is None:
+                values = group[name] = [group[name]]
+            values.append(value)
 
     assert isinstance(group, dict), type(group)
     assert cnt
@@ -574,8 +626,10 @@ def parse_group(ipp, depth, name=None):
     return group
 
 
-def parse_top(ipp):
+def parse_top(ipp, max_depth=MAX_DEPTH, max_size=MAX_SIZE):
     """Parse the whole IPP packet
+        Attribute sections longer than `max_size` bytes or with collections nested more than
+        `max_depth` deep are rejected
         Returns: dict of top level groups
     """
     # top = OrderedDict()
@@ -584,16 +638,221 @@ def parse_top(ipp):
         tag = ipp.read_tag()
         if tag is None:
             break
-        group = parse_group(ipp, 0)
+        group = parse_group(ipp, 0, max_depth=max_depth, max_size=max_size)
         assert group, (group_tag, ipp)
         top[tag] = group
+        check_size(ipp.i, max_size)
     return top
 
 
+# Fast path: decode directly from bytes / memoryview with the VALUE_DECODERS table.
+# decode_message() returns the same attribute dicts as parse_top() without
+# converting the input to a list of ints or building strings a char at a time.
+
+def decode_value(buf, i, tag, n):
+    """Decode the `n` byte value of type `tag` at offset `i` in memoryview `buf`"""
+    return VALUE_DECODERS.get(tag, decode_octets)(buf, i, n)
+
+
+def decode_group(buf, i, depth, max_depth=MAX_DEPTH):
+    """Decode the attribute group or collection starting at offset `i` in memoryview `buf`
+        Nested collections are decoded with an explicit stack rather than by recursion so deep
+        nesting costs no Python frames. Collections nested more than `max_depth` deep are
+        rejected.
+        Returns: group, i
+            where
+                group: dict of attribute name: value, as parse_group() returns
+                i: offset of the next group tag or end-of-attributes tag for depth 0, or of the
+                   byte after the end-of-collection attribute for depth > 0
+    """
+    unpack_be2 = BE2.unpack_from
+    tags = METRICS.tags if METRICS is not None else None
+    size = len(buf)
+    group = {}
+    name = None
+    member_name = None
+    stack = []      # (group, name, member_name, attr_name) of the enclosing groups
+    while i < size:
+        tag = buf[i]
+        if depth == 0 and (tag in GROUP_TAGS or tag == IPP_TAG_END):
+            break
+        assert depth > 0 or tag in TAG_NAME, tag
+        if tags is not None:
+            tags[tag] += 1
+        assert i + 3 <= size, 'Truncated attribute at %d' % i
+        n = unpack_be2(buf, i + 1)[0]
+        assert i + 3 + n + 2 <= size, 'Truncated attribute name at %d' % i
+        i += 3
+        attr_name = str(buf[i:i + n], 'latin-1') if n else None
+        i += n
+        v = unpack_be2(buf, i)[0]
+        i += 2
+        assert i + v <= size, 'Truncated attribute value at %d' % i
+
+        if tag == IPP_TAG_BEGIN_COLLECTION:
+            assert len(stack) < max_depth, 'Collections nested more than %d deep at %d' % (
+                max_depth, i)
+            stack.append((group, name, member_name, attr_name))
+            group = {}
+            name = None
+            member_name = None
+            depth += 1
+            i += v
+            continue
+        if tag == IPP_TAG_END_COLLECTION:
+            i += v
+            assert depth > 0, i
+            if not stack:
+                return group, i
+            value = group
+            group, name, member_name, attr_name = stack.pop()
+            depth -= 1
+        elif v > 0:
+            value = decode_value(buf, i, tag, v)
+            i += v
+        else:
+            value = None
+
+        if tag == IPP_TAG_MEMBERNAME:
+            member_name = value
+            continue
+        if attr_name is None and member_name is not None:
+            attr_name, member_name = member_name, None
+
+        if attr_name is not None:
+            name = attr_name
+            group[name] = value
+        else:
+            # Additional value of a 1setOf attribute
+            values = group[name]
+            if isinstance(values, list):
+                values.append(value)
+            else:
+                group[name] = [values, value]
+
+    assert depth == 0 and not stack, (depth, i)
+    return group, i
+
+
+def decode_top(buf, i, max_depth=MAX_DEPTH):
+    """Decode the attribute groups starting at offset `i` in memoryview `buf`
+        Returns: top, i
+            where
+                top: dict of top level groups, as parse_top() returns
+                i: offset of the end-of-attributes tag, or len(buf) if there is none
+    """
+    top = {}
+    size = len(buf)
+    while i < size:
+        tag = buf[i]
+        if tag == IPP_TAG_END:
+            break
+        assert tag in GROUP_TAGS, tag_describe(tag)
+        top[tag], i = decode_group(buf, i + 1, 0, max_depth)
+    return top, i
+
+
+def decode_header(buf):
+    """Decode the 8 byte IPP message header at the start of `buf`"""
+    major, minor, op_status, request_id = HEADER.unpack_from(buf, 0)
+    return {'version': (major, minor),
+            'op_status': op_status,
+            'request_id': request_id}
+
+
+def decode_attributes(buf, max_depth=MAX_DEPTH, max_size=MAX_SIZE):
+    """Decode the attribute groups that follow the header of the message in memoryview `buf`
+        Only the attribute section is scanned and counts towards `max_size`, so any amount of
+        document data may follow it
+        Returns: top, i as decode_top() returns
+    """
+    if len(buf) <= max_size:
+        return decode_top(buf, HEADER.size, max_depth)
+    too_long = 'Attribute section is longer than %d bytes' % max_size
+    with buf[:max_size] as view:
+        try:
+            top, i = decode_top(view, HEADER.size, max_depth)
+        except AssertionError as e:
+            raise AssertionError('%s or invalid: %s' % (too_long, e))
+    assert i < max_size, too_long
+    return top, i
+
+
+def decode_message(text, max_depth=MAX_DEPTH, max_size=MAX_SIZE):
+    """Decode a whole IPP message from bytes-like `text` without copying it
+        Messages whose attribute section is longer than `max_size` bytes or with collections
+        nested more than `max_depth` deep are rejected
+        Returns: header, top
+            header: dict of version, op_status and request_id
+            top: dict of top level groups, as parse_top() returns
+    """
+    buf = memoryview(text)
+    header = decode_header(buf)
+    top, _ = decode_attributes(buf, max_depth, max_size)
+    return header, top
+
+
+class MappedMessage(object):
+    """IPP message in file `path` decoded from a read-only memory map
+        Only the attribute section is decoded. The document data after the end-of-attributes tag
+        is exposed as a memoryview of the map so its pages are not read unless it is used.
+        `max_size` limits the attribute section, as for decode_message().
+            header, top: as decode_message() returns
+            data: memoryview of the document data, valid until close()
+            data_offset, data_length: offset and length of the document data in the file
+    """
+
+    def __init__(self, path, max_depth=MAX_DEPTH, max_size=MAX_SIZE):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            assert size >= HEADER.size, (path, size)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.data = None
+        try:
+            self.header = decode_header(self.view)
+            self.top, i = decode_attributes(self.view, max_depth, max_size)
+            self.data_offset = min(i + 1, size)
+            self.data_length = size - self.data_offset
+            self.data = self.view[self.data_offset:]
+        except BaseException:
+            self.close()
+            raise
+
+    def __repr__(self):
+        return 'MappedMessage{path=%s,data_offset=%d,data_length=%d}' % (
+            self.path, self.data_offset, self.data_length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """Release the views of the map and unmap the file. Raises BufferError if views derived
+            from `data` are still in use
+        """
+        if self.data is not None:
+            self.data.release()
+        self.view.release()
+        self.map.close()
+
+
 RESULTS = 'results.tables'
 
 
 def save_attribute_dict(path_in, attribute_dict):
+    with stage('save', path_in):
+        _save_attribute_dict(path_in, attribute_dict)
+
+
+def _save_attribute_dict(path_in, attribute_dict):
+    if WRITER is not None:
+        WRITER.write_attributes(path_in, attribute_dict)
+        return
 
     path = os.path.join(RESULTS, '%s.csv' % path_in)
     assert path != path_in
@@ -608,12 +867,14 @@ def save_attribute_dict(path_in, attribute_dict):
         w = csv.writer(f)
         w.writerow(['group_tag', 'tag_name', 'name', 'value'])
         for group_tag, attributes in attribute_dict.items():
-            dprint('attributes=%s' % attributes)
+            if DEBUG:
+                dprint('attributes=%s' % attributes)
             # for name, (tag, value) in attributes.items():
             for name, value in attributes.items():
                 # print('!@#', tag_name(group_tag), tag_name(tag), type(value), name, value)
                 # w.writerow([group_tag, name, tag, value])
-                dprint(('!@#', tag_name(group_tag), type(value), name, value))
+                if DEBUG:
+                    dprint(('!@#', tag_name(group_tag), type(value), name, value))
                 w.writerow([group_tag, name, value])
 
 
@@ -631,7 +892,35 @@ def parse_body(path, ipp, parent):
                   }
     print('HEADER', ipp.header)
 
-    attribute_dict = parse_top(ipp)
+    with stage('decode', path):
+        attribute_dict = parse_top(ipp)
+    save_attribute_dict(path, attribute_dict)
+    return attribute_dict
+
+
+def parse_body_fast(path, text):
+    """Same as parse_body() but decodes `text` with decode_message()"""
+    print('parse_body_fast: len=%d' % len(text))
+    with stage('decode', path):
+        header, attribute_dict = decode_message(text)
+    print('HEADER', header)
+    save_attribute_dict(path, attribute_dict)
+    return attribute_dict
+
+
+def parse_body_mapped(path):
+    """Same as parse_body_fast() but decodes only the attribute section of `path` from a memory
+        map with MappedMessage, leaving any document data unread
+    """
+    with stage('decode', path):
+        with MappedMessage(path) as message:
+            header, attribute_dict = message.header, message.top
+            data_offset, data_length = message.data_offset, message.data_length
+    print('parse_body_mapped: data_offset=%d,data_length=%d' % (data_offset, data_length))
+    print('HEADER', header)
+    if METRICS is not None:
+        METRICS.count('bytes', data_offset)
+        METRICS.count('data_bytes', data_length)
     save_attribute_dict(path, attribute_dict)
     return attribute_dict
 
@@ -667,15 +956,58 @@ def dump(text):
     assert False
 
 
-def process_file(path):
+def process_file(path, fast=False, mapped=False):
+    """Decode control file `path` with parse_body_slow(), or parse_body_fast() if `fast`, or
+        parse_body_mapped() if `mapped`. CACHE is not used for mapped files as hashing them
+        would read their document data
+        Returns: dict of top level groups
+    """
+    with stage('file', path):
+        attribute_dict = _process_file(path, fast, mapped)
+    if METRICS is not None:
+        METRICS.count('files')
+        METRICS.count('groups', len(attribute_dict))
+        METRICS.count('attributes', sum(len(group) for group in attribute_dict.values()))
+    return attribute_dict
+
+
+def _process_file(path, fast, mapped):
     print('#' * 80)
     print(path, os.path.getsize(path))
 
-    with open(path, 'rb') as f:
-        text = f.read()
+    if mapped:
+        return parse_body_mapped(path)
+
+    with stage('read', path):
+        with open(path, 'rb') as f:
+            text = f.read()
+    if METRICS is not None:
+        METRICS.count('bytes', len(text))
+
+    key = None
+    if CACHE is not None:
+        with stage('cache', path):
+            key = CACHE.key(text, '%s.%d' % ('fast' if fast else 'slow', DECODER_VERSION))
+            attribute_dict = CACHE.get(key)
+        if attribute_dict is not None:
+            save_attribute_dict(path, attribute_dict)
+            return attribute_dict
+
+    if fast:
+        attribute_dict = parse_body_fast(path, text)
+    else:
+        attribute_dict = parse_body_slow(path, text)
+
+    if key is not None:
+        with stage('cache', path):
+            CACHE.put(key, attribute_dict)
+    return attribute_dict
 
+
+def parse_body_slow(path, text):
     t0 = text[0]
-    dprint('type=%s,val=%s' % (type(t0), t0))
+    if DEBUG:
+        dprint('type=%s,val=%s' % (type(t0), t0))
     assert all(isinstance(c, int) for c in text)
     text = [int(c) for c in text]
     # dump(text)
@@ -694,53 +1026,305 @@ def process_file(path):
     return parse_body(path, ipp, None)
 
 
-def main():
-    assert len(sys.argv) > 1, 'Usage: %s <control file>' % sys.argv[1]
-    dir_name = sys.argv[1]
-
-    path_attributes = {}
-    bad_paths = {}
-    for path in recursive_glob(dir_name):
-        try:
-            path_attributes[path] = process_file(path)
-            print('=' * 80)
-            print(path)
-            pprint(path_attributes[path])
-            print('`' * 80)
-        except Exception as e:
-            bad_paths[path] = e
-            print('bad path="%s"' % path)
-            raise
-
+def print_attributes(path, attribute_dict):
+    print('=' * 80)
+    print(path)
+    pprint(attribute_dict)
+    print('`' * 80)
+
+
+def add_name_vals(name_vals, attribute_dict):
+    """Add the short scalar values in `attribute_dict` to ipp_sketch.NameValStats `name_vals`"""
+    for _, attributes in attribute_dict.items():
+        # for name, (tag, value) in attributes.items():
+        for name, value in attributes.items():
+            assert isinstance(name, str), name
+            values = value if isinstance(value, list) else [value]
+            for val in values:
+                if isinstance(val, str) and len(val) > 20:
+                    continue
+                if isinstance(val, (dict, list)):
+                    continue
+                try:
+                    name_vals.add(name, val)
+                except:
+                    print('$$', val)
+                    # sraise
+
+
+def report(bad_paths, name_vals):
+    """Print the bad paths, the attributes that have a few distinct values and the commonest
+        values of the others
+    """
     print('$' * 80)
     pprint(bad_paths)
     print('%' * 80)
-    name_vals = defaultdict(set)
+    name_vals.report()
+    if CACHE is not None:
+        print(CACHE.describe())
+    if METRICS is not None:
+        print(METRICS.describe())
+
+
+def error_record(e):
+    """Returns: dict describing exception `e` for the bad files report: its type, message and
+        the file and line it was raised at
+    """
+    frames = traceback.extract_tb(e.__traceback__)
+    where = None
+    if frames:
+        where = '%s:%d' % (os.path.basename(frames[-1].filename), frames[-1].lineno)
+    return {'type': type(e).__name__, 'message': str(e), 'where': where}
+
+
+def process_chunk(paths, fast=False, mapped=False):
+    """Process control files `paths`, capturing what process_file() prints for each so the
+        caller can print it in a deterministic order
+        Returns: results, name_vals, cache_counts, metrics
+            results: list of (path, output, error) for each path in `paths`. error is an
+                     error_record() for bad paths and None for good paths
+            name_vals: ipp_sketch.NameValStats for `paths`
+            cache_counts: Counter of CACHE events for `paths`
+            metrics: METRICS.pop() for `paths`, or None if there are no METRICS
+    """
+    results = []
+    name_vals = NameValStats()
+    cache_counts0 = Counter(CACHE.counts) if CACHE is not None else Counter()
+    for path in paths:
+        out = io.StringIO()
+        error = None
+        with redirect_stdout(out):
+            try:
+                attribute_dict = process_file(path, fast, mapped)
+                print_attributes(path, attribute_dict)
+                add_name_vals(name_vals, attribute_dict)
+            except Exception as e:
+                error = error_record(e)
+                print('bad path="%s"' % path)
+        results.append((path, out.getvalue(), error))
+    if WRITER is not None:
+        WRITER.flush()
+    cache_counts = Counter(CACHE.counts) - cache_counts0 if CACHE is not None else Counter()
+    metrics = METRICS.pop() if METRICS is not None else None
+    return results, name_vals, cache_counts, metrics
+
+
+def set_cache(cache):
+    global CACHE
+    CACHE = cache
+
+
+def set_writer(writer):
+    global WRITER
+    WRITER = writer
+
+
+def set_metrics(metrics):
+    global METRICS
+    METRICS = metrics
+
+
+def init_worker(cache_config, writer_config, metrics_config=None):
+    """Pool initializer: give each worker its own memory tier over the shared disk tier, its
+        own segments and its own metrics
+        Workers ignore SIGINT. Ctrl-C interrupts the parent, which saves any checkpoint and
+        terminates the pool. A worker killed by KeyboardInterrupt mid-task can hang
+        Pool.terminate()
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from ipp_cache import ParseCache
+    from ipp_segments import SegmentWriter
+    from ipp_metrics import Metrics
+    set_cache(ParseCache(*cache_config) if cache_config is not None else None)
+    set_writer(SegmentWriter(*writer_config) if writer_config is not None else None)
+    set_metrics(Metrics(*metrics_config) if metrics_config is not None else None)
+
+
+def _process_chunk(args):
+    return process_chunk(*args)
+
+
+def chunked(items, n):
+    """Generator that returns lists of up to `n` consecutive elements of iterable `items`"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_jobs(paths, fast, jobs, chunksize, checkpoint=None, mapped=False):
+    """Process control files `paths` in `jobs` processes, dispatching `chunksize` paths at a time
+        Per-file output is printed and results are merged in the order of `paths` so the output
+        is the same for any number of jobs. name_vals is merged from per-chunk summaries, and
+        its report is the same for any `chunksize` and checkpoint resume apart from the rare
+        exceptions ipp_sketch.NameValStats.most_common() describes. Bad paths are reported
+        rather than raised.
+        Workers' CACHE counts are added to the parent's CACHE and their metrics to METRICS.
+        If `checkpoint`, an ipp_checkpoint.Checkpoint, is given, paths it has done are skipped,
+        its partial results are carried forward and it is saved periodically and at the end,
+        including when the run is interrupted.
+        Returns: bad_paths, name_vals
+    """
+    if checkpoint is not None:
+        bad_paths = checkpoint.bad_paths
+        name_vals = checkpoint.name_vals
+        paths = checkpoint.remaining(paths)
+    else:
+        bad_paths = {}
+        name_vals = NameValStats()
+    work = ((chunk, fast, mapped) for chunk in chunked(paths, chunksize))
+    pool = None
+    if jobs > 1:
+        cache_config = CACHE.config() if CACHE is not None else None
+        writer_config = WRITER.config() if WRITER is not None else None
+        metrics_config = METRICS.config() if METRICS is not None else None
+        pool = multiprocessing.Pool(jobs, init_worker,
+                                    (cache_config, writer_config, metrics_config))
+    try:
+        results_list = pool.imap(_process_chunk, work) if pool else map(_process_chunk, work)
+        for results, chunk_name_vals, cache_counts, metrics in results_list:
+            for path, output, error in results:
+                sys.stdout.write(output)
+                if error is not None:
+                    bad_paths[path] = error
+            name_vals.merge(chunk_name_vals)
+            if pool and CACHE is not None:
+                CACHE.counts.update(cache_counts)
+            if metrics is not None:
+                METRICS.merge(metrics)
+            if checkpoint is not None:
+                checkpoint.done.update(path for path, _, _ in results)
+                checkpoint.save_if_due()
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if checkpoint is not None:
+            checkpoint.save()
+        if pool:
+            pool.close()
+            pool.join()
+    return bad_paths, name_vals
+
+
+def run_serial(paths, fast, mapped=False):
+    """Process control files `paths` in this process, stopping at the first bad file
+        Returns: bad_paths, name_vals
+    """
+    path_attributes = {}
+    bad_paths = {}
+    try:
+        for path in paths:
+            try:
+                path_attributes[path] = process_file(path, fast, mapped)
+                print_attributes(path, path_attributes[path])
+            except Exception as e:
+                bad_paths[path] = e
+                print('bad path="%s"' % path)
+                raise
+    finally:
+        if WRITER is not None:
+            WRITER.flush()
+
+    name_vals = NameValStats()
     for attribute_dict in path_attributes.values():
-        for _, attributes in attribute_dict.items():
-            # for name, (tag, value) in attributes.items():
-            for name, value in attributes.items():
-                assert isinstance(name, str), name
-                values = value if isinstance(value, list) else [value]
-                for val in values:
-                    if isinstance(val, str) and len(val) > 20:
-                        continue
-                    if isinstance(val, (dict, list)):
-                        continue
-                    if isinstance(val, dict):
-                        continue
-                    if isinstance(val, list):
-                        continue
-                    try:
-                        name_vals[name].add(val)
-                    except:
-                        print('$$', val)
-                        # sraise
-
-    for key in sorted(name_vals, key=lambda k: (len(name_vals[k]), k)):
-        vals = name_vals[key]
-        if len(vals) > 20 or len(vals) <= 1:
-            continue
-        print(key, list(vals))
+        add_name_vals(name_vals, attribute_dict)
+    return bad_paths, name_vals
 
-main()
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode IPP control files')
+    parser.add_argument('path', help='control file or directory of control files')
+    parser.add_argument('--fast', action='store_true',
+                        help='decode bytes directly with decode_message()')
+    parser.add_argument('--mmap', action='store_true',
+                        help='decode only the attribute section of each file from a memory map, '
+                             'leaving document data unread. Implies --fast and bypasses --cache')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='decode files in this many processes and report bad files '
+                             'instead of stopping at the first one')
+    parser.add_argument('--batch', action='store_true',
+                        help='report bad files instead of stopping at the first one, as --jobs '
+                             'does, in this process if --jobs is not given')
+    parser.add_argument('--checkpoint', default=None,
+                        help='save progress to this file and resume from it if it exists. '
+                             'Implies --batch')
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        help='seconds between --checkpoint saves')
+    parser.add_argument('--name-vals', default=None,
+                        help='save the attribute value statistics to this file so statistics '
+                             'of several runs can be merged with ipp_sketch.py')
+    parser.add_argument('--errors', default=None,
+                        help='write a JSON report of the bad files to this file. Implies --batch')
+    parser.add_argument('--chunksize', type=int, default=64,
+                        help='number of files dispatched to a --jobs worker at a time')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache decoded files by content hash')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory for the on-disk tier of --cache')
+    parser.add_argument('--cache-entries', type=int, default=10000,
+                        help='number of decoded files in the memory tier of --cache')
+    parser.add_argument('--cache-mb', type=float, default=256,
+                        help='size cap of the on-disk tier of --cache in MB')
+    parser.add_argument('--segments', default=None,
+                        help='write decoded attributes to rotating segment files in this '
+                             'directory instead of a CSV per file under %s' % RESULTS)
+    parser.add_argument('--gzip', action='store_true', help='gzip --segments')
+    parser.add_argument('--segment-rows', type=int, default=1000000,
+                        help='rows per --segments file')
+    parser.add_argument('--metrics', default=None,
+                        help='record stage timers, counts and a value tag histogram and save '
+                             'them to this JSON file')
+    parser.add_argument('--trace', action='store_true',
+                        help='add Chrome trace format events for each stage of each file '
+                             'to --metrics')
+    args = parser.parse_args()
+    dir_name = args.path
+
+    if args.metrics:
+        from ipp_metrics import Metrics
+        set_metrics(Metrics(args.trace))
+
+    if args.segments:
+        from ipp_segments import SegmentWriter
+        set_writer(SegmentWriter(args.segments, args.gzip, args.segment_rows))
+
+    if args.cache or args.cache_dir:
+        from ipp_cache import ParseCache
+        set_cache(ParseCache(args.cache_dir, args.cache_entries,
+                             int(args.cache_mb * 1024 * 1024)))
+
+    checkpoint = None
+    if args.checkpoint:
+        from ipp_checkpoint import Checkpoint
+        checkpoint = Checkpoint(args.checkpoint, args.checkpoint_interval)
+        print('%s: resuming after %d files' % (checkpoint, checkpoint.resumed))
+
+    try:
+        if args.jobs > 0 or args.batch or args.checkpoint or args.errors:
+            bad_paths, name_vals = run_jobs(recursive_glob(dir_name), args.fast,
+                                            max(args.jobs, 1), args.chunksize, checkpoint,
+                                            args.mmap)
+        else:
+            bad_paths, name_vals = run_serial(recursive_glob(dir_name), args.fast, args.mmap)
+        report(bad_paths, name_vals)
+        if args.name_vals:
+            name_vals.save(args.name_vals)
+            print('name vals: %s in %s' % (name_vals, args.name_vals))
+        if args.errors:
+            with open(args.errors, 'w') as f:
+                json.dump(bad_paths, f, indent=4, sort_keys=True)
+            print('errors: %d bad files in %s' % (len(bad_paths), args.errors))
+    finally:
+        if METRICS is not None:
+            METRICS.save(args.metrics)
+            print('metrics: %s' % args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    Segmented bulk output of decoded attributes
+
+    Instead of one CSV per control file (save_attribute_dict() writes a tree of them under
+    results.tables), SegmentWriter buffers rows of
+
+        path, group_tag, tag_name, name, value
+
+    and appends them in large batches to a few segment files that are rotated after
+    `segment_rows` rows. Segments are CSV, optionally gzipped. Each batch is appended as a
+    complete gzip member so a segment is readable even if the writing process is killed.
+
+    Each process writes its own segments so --jobs workers don't interleave rows.
+"""
+from __future__ import division, print_function
+import os
+import csv
+import sys
+import gzip
+import glob
+from ipp_reader import tag_name
+
+
+SEGMENT_PREFIX = 'attributes'
+SEGMENT_ROWS = 1000000
+BATCH_ROWS = 50000
+COLUMNS = ['path', 'group_tag', 'tag_name', 'name', 'value']
+
+
+def open_segment(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', newline='')
+    return open(path, mode, newline='')
+
+
+class SegmentWriter(object):
+    """Buffered writer of attribute rows to rotating segment files in directory `dir_name`"""
+
+    def __init__(self, dir_name, compress=False, segment_rows=SEGMENT_ROWS, batch_rows=BATCH_ROWS):
+        self.dir_name = dir_name
+        self.compress = compress
+        self.segment_rows = segment_rows
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.pid = None
+        self.segment = 0
+        self.segment_path = None
+        self.segment_count = 0     # rows in the current segment
+        os.makedirs(dir_name, exist_ok=True)
+
+    def __repr__(self):
+        return 'SegmentWriter{dir=%s,segment=%s,rows=%d,buffered=%d}' % (
+            self.dir_name, self.segment_path, self.segment_count, len(self.rows))
+
+    def config(self):
+        """Returns: arguments to create a writer with the same configuration, e.g. in a worker"""
+        return self.dir_name, self.compress, self.segment_rows, self.batch_rows
+
+    def write_attributes(self, path, attribute_dict):
+        """Buffer the attributes in `attribute_dict`, decoded from control file `path`"""
+        rows = self.rows
+        for group_tag, attributes in attribute_dict.items():
+            group_name = tag_name(group_tag)
+            for name, value in attributes.items():
+                rows.append((path, group_tag, group_name, name, value))
+        if len(rows) >= self.batch_rows:
+            self.flush()
+
+    def _next_segment(self):
+        """Start a new segment. Names include the pid so processes don't share segments"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.segment = 0
+        while True:
+            path = os.path.join(self.dir_name, '%s-%d-%05d.csv%s' % (
+                SEGMENT_PREFIX, self.pid, self.segment, '.gz' if self.compress else ''))
+            self.segment += 1
+            if not os.path.exists(path):
+                break
+        self.segment_path = path
+        self.segment_count = 0
+        with open_segment(path, 'w') as f:
+            csv.writer(f).writerow(COLUMNS)
+
+    def flush(self):
+        """Append the buffered rows to the current segment, rotating segments as they fill"""
+        rows = self.rows
+        i = 0
+        while i < len(rows):
+            if (self.segment_path is None or self.pid != os.getpid() or
+                    self.segment_count >= self.segment_rows):
+                self._next_segment()
+            n = min(len(rows) - i, self.segment_rows - self.segment_count)
+            with open_segment(self.segment_path, 'a') as f:
+                csv.writer(f).writerows(rows[i:i + n])
+            self.segment_count += n
+            i += n
+        del rows[:]
+
+    close = flush
+
+
+def read_segment(path):
+    """Returns: list of the rows in segment `path` as (path, group_tag, tag_name, name, value)
+        tuples. Values are the strings written to the segment
+    """
+    with open_segment(path, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        assert header == COLUMNS, (path, header)
+        return [(p, int(g), t, n, v) for p, g, t, n, v in reader]
+
+
+def segment_paths(dir_name):
+    return sorted(glob.glob(os.path.join(dir_name, '%s-*.csv*' % SEGMENT_PREFIX)))
+
+
+def read_segments(dir_name):
+    """Generator that returns the rows of all segments in directory `dir_name`"""
+    for path in segment_paths(dir_name):
+        for row in read_segment(path):
+            yield row
+
+
+def main():
+    assert len(sys.argv) > 1, 'Usage: python %s <segment directory>' % sys.argv[0]
+    total = 0
+    for path in segment_paths(sys.argv[1]):
+        rows = read_segment(path)
+        total += len(rows)
+        print('%8d rows %s' % (len(rows), path))
+    print('%8d rows total' % total)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+    Local asyncio IPP ingest service and load generator
+
+    Decodes IPP requests as they arrive instead of sweeping spool directories afterwards.
+
+        python ipp_server.py serve [--port 8631] [--jobs 4] [--queue 256] [--segments <dir>]
+        python ipp_server.py load [--port 8631] [--requests 10000] [--concurrency 32]
+
+    serve listens on localhost for HTTP/1.1 POSTs of Content-Type application/ipp. Bodies are
+    put on a bounded queue; when it is full connection handlers wait, so clients are slowed
+    down by TCP flow control rather than the server buffering without limit. Bodies are only
+    read while the bodies already held, queued or being decoded, total less than
+    --inflight-bytes, so memory is bounded however many clients connect. Messages of up to
+    --inline-bytes are decoded with decode_message() in the event loop and larger ones in a
+    pool of --jobs processes. Each request is answered with a minimal IPP response: the
+    request's version and request-id, a status-code and an operation attributes group with
+    attributes-charset and attributes-natural-language.
+
+    load sends synthetic messages from ipp_synth over --concurrency keep-alive connections and
+    reports requests/s and latency percentiles.
+"""
+from __future__ import division, print_function
+import sys
+import time
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, deque
+from ipp_reader import (IPP_TAG_OPERATION, HEADER, decode_message, error_record)
+from ipp_encoder import encode_message
+
+
+HOST = '127.0.0.1'
+PORT = 8631
+QUEUE_SIZE = 256
+JOBS = 4
+INLINE_BYTES = 16 * 1024
+MAX_HEADER_BYTES = 16 * 1024     # longer HTTP request heads are rejected
+# Bodies, attributes and document data, are read into memory. decode_message() limits the
+# attribute section separately
+MAX_BODY_BYTES = 16 * 1024 * 1024
+INFLIGHT_BYTES = 256 * 1024 * 1024  # total bytes of the bodies held at once
+
+IPP_STATUS_OK = 0x0000
+IPP_STATUS_ERROR_BAD_REQUEST = 0x0400
+IPP_STATUS_ERROR_INTERNAL = 0x0500
+
+RESPONSE_ATTRIBUTES = {
+    IPP_TAG_OPERATION: {
+        'attributes-charset': 'utf-8',
+        'attributes-natural-language': 'en',
+    },
+}
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    415: 'Unsupported Media Type',
+}
+
+
+def ipp_response(text, status):
+    """Returns: minimal IPP response to request `text` with status-code `status`, echoing the
+        request's version and request-id
+    """
+    if len(text) >= HEADER.size:
+        major, minor, _, request_id = HEADER.unpack_from(text, 0)
+    else:
+        major, minor, request_id = 2, 0, 0
+    return encode_message(RESPONSE_ATTRIBUTES, (major, minor), status, request_id)
+
+
+def http_response(code, body=b'', content_type='application/ipp', keep_alive=True):
+    head = ['HTTP/1.1 %d %s' % (code, HTTP_REASONS[code]),
+            'Content-Length: %d' % len(body),
+            'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+    if body:
+        head.append('Content-Type: %s' % content_type)
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+
+def decode_request(text):
+    """Decode IPP request `text`. Runs in the event loop or in a worker process
+        Returns: header, top, error
+            error: error_record() if `text` could not be decoded, otherwise None
+    """
+    try:
+        header, top = decode_message(text)
+        return header, top, None
+    except Exception as e:
+        return None, None, error_record(e)
+
+
+class HTTPError(Exception):
+    """An HTTP request that is answered with status `code` and the connection closed"""
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class ByteBudget(object):
+    """Limit on the total size of request bodies held at once. acquire(n) waits until `n` more
+        bytes fit. Waiters are served in arrival order so large bodies aren't starved
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiters = deque()      # (n, future) of blocked acquire() calls
+
+    def __repr__(self):
+        return 'ByteBudget{used=%d,limit=%d,waiters=%d}' % (self.used, self.limit,
+                                                            len(self.waiters))
+
+    async def acquire(self, n):
+        assert n <= self.limit, (n, self.limit)
+        if not self.waiters and self.used + n <= self.limit:
+            self.used += n
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((n, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.waiters.remove((n, future))
+                self._wake()
+            else:
+                self.release(n)     # granted just as the waiter was cancelled
+            raise
+
+    def release(self, n):
+        self.used -= n
+        self._wake()
+
+    def _wake(self):
+        waiters = self.waiters
+        while waiters and self.used + waiters[0][0] <= self.limit:
+            n, future = waiters.popleft()
+            self.used += n
+            future.set_result(None)
+
+
+class IngestServer(object):
+    """Accepts application/ipp POSTs, decodes them and answers with minimal IPP responses
+        writer: ipp_segments.SegmentWriter that decoded attributes are written to, if any
+    """
+
+    def __init__(self, jobs=JOBS, queue_size=QUEUE_SIZE, inline_bytes=INLINE_BYTES,
+                 writer=None, inflight_bytes=INFLIGHT_BYTES):
+        assert inflight_bytes >= MAX_BODY_BYTES, (inflight_bytes, MAX_BODY_BYTES)
+        self.jobs = jobs
+        self.queue_size = queue_size
+        self.inline_bytes = inline_bytes
+        self.writer = writer
+        self.budget = ByteBudget(inflight_bytes)
+        self.queue = None
+        self.pool = None
+        self.counts = Counter()
+
+    def __repr__(self):
+        return 'IngestServer{jobs=%d,queue=%s,%s,counts=%s}' % (
+            self.jobs, self.queue.qsize() if self.queue else None, self.budget,
+            dict(self.counts))
+
+    async def serve(self, host=HOST, port=PORT):
+        self.queue = asyncio.Queue(self.queue_size)
+        self.pool = ProcessPoolExecutor(self.jobs) if self.jobs > 0 else None
+        # Enough consumers to keep every worker busy while others decode inline
+        consumers = [asyncio.ensure_future(self.consume())
+                     for _ in range(max(self.jobs, 1) * 2)]
+        server = await asyncio.start_server(self.handle_connection, host, port,
+                                            limit=MAX_HEADER_BYTES)
+        print('listening on http://%s:%d jobs=%d queue=%d' % (host, port, self.jobs,
+                                                              self.queue_size))
+        sys.stdout.flush()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in consumers:
+                task.cancel()
+            if self.pool is not None:
+                self.pool.shutdown()
+            if self.writer is not None:
+                self.writer.flush()
+
+    async def consume(self):
+        """Decode queued requests and resolve their futures with the IPP response"""
+        loop = asyncio.get_running_loop()
+        while True:
+            text, future = await self.queue.get()
+            try:
+                if self.pool is not None and len(text) > self.inline_bytes:
+                    header, top, error = await loop.run_in_executor(self.pool, decode_request,
+                                                                    text)
+                    self.counts['pool'] += 1
+                else:
+                    header, top, error = decode_request(text)
+                    self.counts['inline'] += 1
+                if error is None:
+                    self.counts['ok'] += 1
+                    if self.writer is not None:
+                        self.writer.write_attributes('request-%d' % header['request_id'], top)
+                    status = IPP_STATUS_OK
+                else:
+                    self.counts['bad'] += 1
+                    status = IPP_STATUS_ERROR_BAD_REQUEST
+            except Exception as e:
+                self.counts['error'] += 1
+                print('consume: %s' % error_record(e), file=sys.stderr)
+                status = IPP_STATUS_ERROR_INTERNAL
+            finally:
+                self.queue.task_done()
+            if not future.cancelled():
+                future.set_result(ipp_response(text, status))
+
+    async def read_request(self, reader):
+        """Returns: method, headers, body of the next HTTP request on `reader`, or None at EOF
+            Raises HTTPError for requests that can't be served
+            len(body) bytes of the budget are acquired and must be released by the caller
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(400)
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3:
+            raise HTTPError(400)
+        method = parts[0]
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        if method != 'POST':
+            raise HTTPError(405)
+        if 'content-length' not in headers:
+            raise HTTPError(411)    # chunked request bodies are not supported
+        try:
+            n = int(headers['content-length'])
+        except ValueError:
+            raise HTTPError(400)
+        if n < 0:
+            raise HTTPError(400)
+        if n > MAX_BODY_BYTES:
+            raise HTTPError(413)
+        content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+        await self.budget.acquire(n)    # waits while other requests hold too many bytes
+        try:
+            body = await reader.readexactly(n)
+            if content_type != 'application/ipp':
+                raise HTTPError(415)
+        except BaseException:
+            self.budget.release(n)
+            raise
+        return method, headers, body
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        self.counts['connections'] += 1
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HTTPError as e:
+                    self.counts['http_%d' % e.code] += 1
+                    writer.write(http_response(e.code, keep_alive=False))
+                    await writer.drain()
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+                if request is None:
+                    break
+                _, headers, body = request
+                self.counts['requests'] += 1
+                future = loop.create_future()
+                try:
+                    await self.queue.put((body, future))    # waits while the queue is full
+                    response = await future
+                finally:
+                    self.budget.release(len(body))
+                    body = request = None
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(http_response(200, response, keep_alive=keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def post_loop(host, port, messages, latencies, errors):
+    """Send `messages` in turn over one keep-alive connection, recording each latency"""
+    reader, writer = await asyncio.open_connection(host, port)
+    clock = time.perf_counter
+    try:
+        for text in messages:
+            head = ('POST /ipp/print HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: application/ipp'
+                    '\r\nContent-Length: %d\r\n\r\n' % (host, port, len(text)))
+            t0 = clock()
+            writer.write(head.encode('latin-1') + text)
+            await writer.drain()
+            response_head = await reader.readuntil(b'\r\n\r\n')
+            n = 0
+            for line in response_head.decode('latin-1').split('\r\n'):
+                if line.lower().startswith('content-length:'):
+                    n = int(line.split(':', 1)[1])
+            response = await reader.readexactly(n)
+            latencies.append(clock() - t0)
+            status_line = response_head.split(b'\r\n', 1)[0]
+            _, _, status, request_id = HEADER.unpack_from(response, 0)
+            if (not status_line.startswith(b'HTTP/1.1 200') or status != IPP_STATUS_OK or
+                    request_id != HEADER.unpack_from(text, 0)[3]):
+                errors.append((status_line, status, request_id))
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, messages, concurrency):
+    """Send `messages` split over `concurrency` connections
+        Returns: seconds, latencies, errors
+    """
+    latencies = []
+    errors = []
+    t0 = time.perf_counter()
+    await asyncio.gather(*[post_loop(host, port, messages[k::concurrency], latencies, errors)
+                           for k in range(concurrency)])
+    return time.perf_counter() - t0, sorted(latencies), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='IPP ingest service and load generator')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('serve', help='run the ingest service')
+    p.add_argument('-j', '--jobs', type=int, default=JOBS,
+                   help='decoder processes for large messages, 0 to decode all inline')
+    p.add_argument('--queue', type=int, default=QUEUE_SIZE, help='bounded request queue size')
+    p.add_argument('--inline-bytes', type=int, default=INLINE_BYTES,
+                   help='messages up to this size are decoded in the event loop')
+    p.add_argument('--inflight-bytes', type=int, default=INFLIGHT_BYTES,
+                   help='total bytes of request bodies held at once')
+    p.add_argument('--segments', default=None,
+                   help='write decoded attributes to segment files in this directory')
+    p = subparsers.add_parser('load', help='send synthetic requests to the service')
+    p.add_argument('--requests', type=int, default=10000)
+    p.add_argument('--concurrency', type=int, default=32, help='concurrent connections')
+    p.add_argument('--attributes', type=int, default=30, help='job attributes per message')
+    p.add_argument('--value-size', type=int, default=24, help='length of text values')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('no command')
+
+    if args.command == 'serve':
+        writer = None
+        if args.segments:
+            from ipp_segments import SegmentWriter
+            writer = SegmentWriter(args.segments)
+        server = IngestServer(args.jobs, args.queue, args.inline_bytes, writer,
+                              args.inflight_bytes)
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        print(server)
+    elif args.command == 'load':
+        from ipp_synth import make_messages
+        from ipp_bench import percentile
+        distinct = make_messages(min(args.requests, 1000), args.attributes, args.value_size)
+        messages = [distinct[k % len(distinct)] for k in range(args.requests)]
+        seconds, latencies, errors = asyncio.run(
+            run_load(args.host, args.port, messages, args.concurrency))
+        print('%d requests over %d connections in %.2f s: %.0f requests/s' % (
+              len(latencies), args.concurrency, seconds, len(latencies) / seconds))
+        print('latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % tuple(
+              x * 1000 for x in (percentile(latencies, 50), percentile(latencies, 90),
+                                 percentile(latencies, 99), latencies[-1])))
+        if errors:
+            print('%d errors, e.g. %s' % (len(errors), errors[:3]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+    Fixed memory, mergeable statistics of attribute values
+
+    ipp_reader.main summarises the values seen for each attribute name: how many distinct
+    values there are and which they are when there are only a few. Keeping a set of every value
+    grows without limit on a large corpus, so NameValStats keeps, per attribute name
+
+        HyperLogLog: distinct value count estimate in 2**p one byte registers
+        SpaceSaving: the k most frequent values with upper bounds on their counts
+
+    and a CountMin sketch of (name, value) counts shared by all names that tightens the
+    SpaceSaving bounds. While an attribute has had at most k distinct values SpaceSaving holds
+    all of them with exact counts, so the report is exact for the attributes it lists in full.
+    For attributes with more values the report only uses the parts of the sketches that don't
+    depend on the order values were added and merged in, so runs with different --jobs,
+    --chunksize or checkpoint resumes give the same report, apart from rare Count-Min
+    overestimates near the most common values threshold.
+
+    All three merge, so summaries from worker processes or from shards of a corpus combine into
+    one report
+
+        python ipp_reader.py <dir1> --fast --name-vals a.stats
+        python ipp_reader.py <dir2> --fast --name-vals b.stats
+        python ipp_sketch.py a.stats b.stats
+"""
+from __future__ import division, print_function
+import sys
+import math
+import pickle
+import hashlib
+from array import array
+
+
+HLL_P = 10          # 1024 registers, about 3% standard error
+TOP_K = 32
+CM_WIDTH = 4096
+CM_DEPTH = 4
+MAX_LISTED = 20     # attributes with up to this many distinct values are listed in full
+
+MASK64 = (1 << 64) - 1
+MIX = 0x9e3779b97f4a7c15
+
+
+def value_hash(value):
+    """Returns: 64 bit hash of `value` that is the same in every process and run, unlike hash()
+        for strings
+    """
+    digest = hashlib.blake2b(repr(value).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class HyperLogLog(object):
+    """Distinct count estimate of 64 bit hashes"""
+
+    __slots__ = ('p', 'registers')
+
+    def __init__(self, p=HLL_P):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def __repr__(self):
+        return 'HyperLogLog{p=%d,count=%d}' % (self.p, self.count())
+
+    def add(self, x):
+        p = self.p
+        j = x & ((1 << p) - 1)
+        rank = 64 - p - (x >> p).bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def merge(self, other):
+        assert other.p == self.p, (self.p, other.p)
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        registers = self.registers
+        m = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in registers)
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)     # linear counting for small cardinalities
+        return int(round(estimate))
+
+
+class CountMin(object):
+    """Count-Min sketch: upper bounds on the counts of 64 bit hashes"""
+
+    __slots__ = ('width', 'depth', 'table')
+
+    def __init__(self, width=CM_WIDTH, depth=CM_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = array('Q', bytes(8 * width * depth))
+
+    def __repr__(self):
+        return 'CountMin{width=%d,depth=%d}' % (self.width, self.depth)
+
+    def _cells(self, x):
+        h1 = x & 0xffffffff
+        h2 = (x >> 32) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def add(self, x, n=1):
+        table = self.table
+        for cell in self._cells(x):
+            table[cell] += n
+
+    def estimate(self, x):
+        table = self.table
+        return min(table[cell] for cell in self._cells(x))
+
+    def merge(self, other):
+        assert (other.width, other.depth) == (self.width, self.depth), (self, other)
+        table = self.table
+        for cell, n in enumerate(other.table):
+            if n:
+                table[cell] += n
+
+
+class SpaceSaving(object):
+    """The (up to) k most frequent values, by the Space-Saving algorithm
+        counts: {value: count}. Counts are upper bounds, exact while `exact` is True
+        errors: {value: maximum overestimate of its count}
+        exact: True until a value has been evicted to make room for another
+    """
+
+    __slots__ = ('k', 'counts', 'errors', 'exact')
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        self.exact = True
+
+    def __repr__(self):
+        return 'SpaceSaving{k=%d,values=%d,exact=%s}' % (self.k, len(self.counts), self.exact)
+
+    def add(self, value, n=1):
+        counts = self.counts
+        if value in counts:
+            counts[value] += n
+        elif len(counts) < self.k:
+            counts[value] = n
+            self.errors[value] = 0
+        else:
+            # Replace the least frequent value, which the new one may have displaced
+            victim = min(counts, key=counts.get)
+            floor = counts.pop(victim)
+            del self.errors[victim]
+            counts[value] = floor + n
+            self.errors[value] = floor
+            self.exact = False
+
+    def floor(self):
+        """Returns: upper bound on the count of any value not in `counts`"""
+        if self.exact:
+            return 0
+        return min(self.counts.values()) if len(self.counts) >= self.k else 0
+
+    def merge(self, other):
+        """Merge as in Agarwal et al., Mergeable Summaries: a value missing from one summary is
+            counted as that summary's floor()
+        """
+        floor = self.floor()
+        other_floor = other.floor()
+        counts = {}
+        errors = {}
+        for value in list(self.counts) + [v for v in other.counts if v not in self.counts]:
+            count = self.counts.get(value, floor) + other.counts.get(value, other_floor)
+            counts[value] = count
+            errors[value] = (self.errors.get(value, floor) +
+                             other.errors.get(value, other_floor))
+        self.exact = self.exact and other.exact and len(counts) <= self.k
+        if len(counts) > self.k:
+            keep = sorted(counts, key=counts.get, reverse=True)[:self.k]
+            counts = {value: counts[value] for value in keep}
+            errors = {value: errors[value] for value in keep}
+        self.counts = counts
+        self.errors = errors
+
+    def most_common(self, n=None):
+        items = sorted(self.counts.items(), key=lambda kv: -kv[1])
+        return items if n is None else items[:n]
+
+
+class NameValStats(object):
+    """Distinct value counts and most frequent values of attributes, keyed by attribute name"""
+
+    def __init__(self, p=HLL_P, k=TOP_K, width=CM_WIDTH, depth=CM_DEPTH):
+        self.p = p
+        self.k = k
+        self.distinct = {}      # name: HyperLogLog
+        self.top = {}           # name: SpaceSaving
+        self.salts = {}         # name: value_hash(name), mixed into (name, value) hashes
+        self.totals = {}        # name: number of values added
+        self.counts = CountMin(width, depth)
+
+    def __repr__(self):
+        return 'NameValStats{names=%d,p=%d,k=%d}' % (len(self.distinct), self.p, self.k)
+
+    def __len__(self):
+        return len(self.distinct)
+
+    def __iter__(self):
+        return iter(self.distinct)
+
+    def __contains__(self, name):
+        return name in self.distinct
+
+    def _add_name(self, name):
+        self.distinct[name] = HyperLogLog(self.p)
+        self.top[name] = SpaceSaving(self.k)
+        self.salts[name] = value_hash(name)
+        self.totals[name] = 0
+
+    def add(self, name, value):
+        if name not in self.distinct:
+            self._add_name(name)
+        self.top[name].add(value)    # first as it raises TypeError for unhashable values
+        x = value_hash(value)
+        self.distinct[name].add(x)
+        self.totals[name] += 1
+        self.counts.add(((x ^ self.salts[name]) * MIX) & MASK64)
+
+    def merge(self, other):
+        """Add the statistics in NameValStats `other`, e.g. from another process or shard"""
+        assert (other.p, other.k) == (self.p, self.k), (self, other)
+        for name in other.distinct:
+            if name not in self.distinct:
+                self._add_name(name)
+            self.distinct[name].merge(other.distinct[name])
+            self.top[name].merge(other.top[name])
+            self.totals[name] += other.totals[name]
+        self.counts.merge(other.counts)
+
+    def cardinality(self, name):
+        """Returns: number of distinct values of attribute `name`, exact if they all fit in its
+            SpaceSaving and estimated by its HyperLogLog otherwise
+        """
+        top = self.top[name]
+        return len(top.counts) if top.exact else self.distinct[name].count()
+
+    def values(self, name):
+        """Returns: list of the values of attribute `name`, all of them if cardinality() is
+            exact, otherwise the most frequent
+        """
+        return list(self.top[name].counts)
+
+    def estimate(self, name, value):
+        """Returns: Count-Min upper bound on the number of times attribute `name` had `value`"""
+        x = value_hash(value)
+        return self.counts.estimate(((x ^ self.salts[name]) * MIX) & MASK64)
+
+    def most_common(self, name, n=None, min_count=1):
+        """Returns: [(value, count)] of the `n` most frequent values of attribute `name` that
+            occurred at least `min_count` times
+            If the values all fit in its SpaceSaving the counts are exact. Otherwise only values
+            whose Count-Min counts, which are upper bounds, are more than 1/k of the values added
+            are returned. SpaceSaving keeps all such values whatever order values were added and
+            merged in, so the result doesn't depend on how the input was split into chunks
+            except where Count-Min overestimates push a value over that threshold
+        """
+        top = self.top[name]
+        if top.exact:
+            items = [(value, count) for value, count in top.counts.items()
+                     if count >= min_count]
+        else:
+            threshold = self.totals[name] / self.k
+            items = [(value, count)
+                     for value, count in ((v, self.estimate(name, v)) for v in top.counts)
+                     if count > threshold and count >= min_count]
+        items.sort(key=lambda kv: (-kv[1], repr(kv[0])))
+        return items if n is None else items[:n]
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def report(self, max_listed=MAX_LISTED, n_common=5):
+        """Print the attributes with 2 to `max_listed` distinct values and their values, then the
+            distinct counts of attributes with more and up to `n_common` of their most common
+            values that occurred more than once
+            Attributes with up to k distinct values are reported exactly. For the others, the
+            distinct counts are HyperLogLog estimates and the most common values are as
+            most_common() describes. Neither depends on how the input was chunked
+        """
+        cardinality = {name: self.cardinality(name) for name in self.distinct}
+        for name in sorted(cardinality, key=lambda k: (cardinality[k], k)):
+            if 1 < cardinality[name] <= max_listed:
+                print(name, sorted(self.values(name), key=lambda v: (type(v).__name__, v)))
+        many = [name for name in cardinality if cardinality[name] > max_listed]
+        if many:
+            print('attributes with more than %d distinct values (approximate):' % max_listed)
+        for name in sorted(many, key=lambda k: (-cardinality[k], k)):
+            common = self.most_common(name, n_common, min_count=2)
+            print('  %s ~%d distinct%s' % (name, cardinality[name],
+                                          ', most common %s' % common if common else ''))
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def main():
+    assert len(sys.argv) > 1, 'Usage: python %s <name vals stats>...' % sys.argv[0]
+    stats = load(sys.argv[1])
+    for path in sys.argv[2:]:
+        stats.merge(load(path))
+    print('%s from %d files' % (stats, len(sys.argv) - 1))
+    stats.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+    Incremental (push) IPP parser
+
+    PushParser accepts an IPP message in arbitrary chunks, e.g. from a socket or from a file read
+    in IPP_BUF_SIZE blocks, and returns events as soon as the parts of the message they describe
+    are complete.
+
+        parser = PushParser()
+        for chunk in chunks:
+            for event in parser.feed(chunk):
+                ...
+        parser.close()
+
+    Events are tuples whose first element is the event type
+
+        (EVENT_HEADER, header)                  header: dict like decode_header() returns
+        (EVENT_ATTRIBUTE, group_tag, name, value)
+        (EVENT_GROUP, group_tag, group)         group: dict like parse_group() returns, or None
+                                                if the parser was created with build_groups=False
+        (EVENT_END, data_offset)                data_offset: offset of the byte after the
+                                                end-of-attributes tag
+        (EVENT_DATA, data)                      document data following the end-of-attributes tag
+
+    Only the current incomplete attribute is buffered so memory use does not grow with the size
+    of the message when build_groups=False.
+
+    open_document() parses just the attributes of a message in a file object and returns the
+    document data that follows them as a DocumentStream, which can be read like a file, iterated
+    over in IPP_BUF_SIZE blocks or spooled to a file and/or callback while computing a digest
+
+        with open(path, 'rb') as f:
+            header, top, document = open_document(f)
+            with open(out_path, 'wb') as out:
+                n, digest = document.spool(out)
+"""
+from __future__ import division, print_function
+import io
+import hashlib
+import argparse
+from pprint import pprint
+from ipp_reader import (IPP_BUF_SIZE, IPP_TAG_END, IPP_TAG_BEGIN_COLLECTION,
+                        IPP_TAG_END_COLLECTION, IPP_TAG_MEMBERNAME, GROUP_TAGS, TAG_NAME,
+                        HEADER, BE2, tag_describe, decode_header, decode_value)
+
+
+EVENT_HEADER = 'header'
+EVENT_ATTRIBUTE = 'attribute'
+EVENT_GROUP = 'group'
+EVENT_END = 'end'
+EVENT_DATA = 'data'
+
+DIGEST = 'sha256'
+
+
+class Frame(object):
+    """A group or collection being assembled"""
+
+    __slots__ = ('group', 'name', 'member_name', 'parent_name')
+
+    def __init__(self, parent_name=None):
+        self.group = {}
+        self.name = None            # name of the last attribute added, for 1setOf values
+        self.member_name = None     # name from the last IPP_TAG_MEMBERNAME
+        self.parent_name = parent_name  # name of this collection in the enclosing frame
+
+    def add(self, name, value):
+        if name is not None:
+            self.name = name
+            self.group[name] = value
+        else:
+            # Additional value of a 1setOf attribute
+            values = self.group[self.name]
+            if isinstance(values, list):
+                values.append(value)
+            else:
+                self.group[self.name] = [values, value]
+
+
+class PushParser(object):
+    """Resumable IPP parser that is fed the message a chunk at a time"""
+
+    def __init__(self, build_groups=True):
+        self.build_groups = build_groups
+        self.buf = bytearray()
+        self.offset = 0         # offset in the message of self.buf[0]
+        self.header = None
+        self.group_tag = None
+        self.stack = []
+        self.done = False
+        self.data_offset = None
+
+    def __repr__(self):
+        return 'PushParser{offset=%d,buffered=%d,group=%s,depth=%d,done=%s}' % (
+            self.offset, len(self.buf), self.group_tag, len(self.stack), self.done)
+
+    def feed(self, chunk):
+        """Add `chunk` to the message
+            Returns: list of events completed by `chunk`
+        """
+        if self.done:
+            return [(EVENT_DATA, chunk)] if chunk else []
+        self.buf.extend(chunk)
+        events = []
+        i = self._parse(events)
+        del self.buf[:i]
+        self.offset += i
+        if self.done and self.buf:
+            events.append((EVENT_DATA, bytes(self.buf)))
+            self.offset += len(self.buf)
+            del self.buf[:]
+        return events
+
+    def close(self):
+        """Signal the end of the message"""
+        assert self.done, 'Truncated IPP message: %s' % self
+
+    def _parse(self, events):
+        """Parse as many complete items as there are in self.buf
+            Returns: number of bytes of self.buf consumed
+        """
+        buf = self.buf
+        size = len(buf)
+        i = 0
+        if self.header is None:
+            if size < HEADER.size:
+                return 0
+            self.header = decode_header(buf)
+            events.append((EVENT_HEADER, self.header))
+            i = HEADER.size
+
+        unpack_be2 = BE2.unpack_from
+        while i < size:
+            tag = buf[i]
+            if len(self.stack) <= 1 and (tag in GROUP_TAGS or tag == IPP_TAG_END):
+                self._end_group(events)
+                i += 1
+                if tag == IPP_TAG_END:
+                    self.done = True
+                    self.data_offset = self.offset + i
+                    events.append((EVENT_END, self.data_offset))
+                    break
+                self.group_tag = tag
+                self.stack.append(Frame())
+                continue
+
+            # Wait until the whole attribute is buffered
+            if i + 3 > size:
+                break
+            n = unpack_be2(buf, i + 1)[0]
+            j = i + 3 + n
+            if j + 2 > size:
+                break
+            v = unpack_be2(buf, j)[0]
+            if j + 2 + v > size:
+                break
+
+            assert self.stack, 'Attribute outside group: %s' % tag_describe(tag)
+            assert tag in TAG_NAME, tag
+            name = str(buf[i + 3:j], 'latin-1') if n else None
+            self._attribute(events, buf, tag, name, j + 2, v)
+            i = j + 2 + v
+        return i
+
+    def _attribute(self, events, buf, tag, name, i, v):
+        """Add the attribute with value tag `tag` and `v` byte value at `i` in `buf`"""
+        frame = self.stack[-1]
+        if tag == IPP_TAG_END_COLLECTION:
+            assert len(self.stack) > 1, 'Unmatched end of collection'
+            self.stack.pop()
+            self.stack[-1].add(frame.parent_name, frame.group)
+            return
+
+        if tag == IPP_TAG_MEMBERNAME:
+            frame.member_name = decode_value(buf, i, tag, v)
+            return
+        if name is None and frame.member_name is not None:
+            name, frame.member_name = frame.member_name, None
+
+        if name is not None and len(self.stack) == 1:
+            # A new top level attribute so the previous one is complete
+            self._end_attribute(events)
+
+        if tag == IPP_TAG_BEGIN_COLLECTION:
+            self.stack.append(Frame(name))
+            return
+        value = decode_value(buf, i, tag, v) if v > 0 else None
+        frame.add(name, value)
+
+    def _end_attribute(self, events):
+        frame = self.stack[0]
+        name = frame.name
+        if name is None:
+            return
+        events.append((EVENT_ATTRIBUTE, self.group_tag, name, frame.group[name]))
+        if not self.build_groups:
+            del frame.group[name]
+        frame.name = None
+
+    def _end_group(self, events):
+        if not self.stack:
+            return
+        assert len(self.stack) == 1, 'Unterminated collection: %s' % self
+        self._end_attribute(events)
+        frame = self.stack.pop()
+        events.append((EVENT_GROUP, self.group_tag, frame.group if self.build_groups else None))
+        self.group_tag = None
+
+
+def iter_events(f, buf_size=IPP_BUF_SIZE, build_groups=True):
+    """Generator that returns the events for the IPP message in file object `f` which is read in
+        `buf_size` blocks
+    """
+    parser = PushParser(build_groups)
+    while True:
+        chunk = f.read(buf_size)
+        if not chunk:
+            break
+        for event in parser.feed(chunk):
+            yield event
+    parser.close()
+
+
+def parse_stream(f, buf_size=IPP_BUF_SIZE):
+    """Parse the IPP message in file object `f`
+        Returns: header, top
+            header: dict of version, op_status and request_id
+            top: dict of top level groups, as parse_top() returns
+    """
+    header = None
+    top = {}
+    for event in iter_events(f, buf_size):
+        if event[0] == EVENT_HEADER:
+            header = event[1]
+        elif event[0] == EVENT_GROUP:
+            top[event[1]] = event[2]
+    return header, top
+
+
+class DocumentStream(io.RawIOBase):
+    """Read-only stream over the document data of an IPP message. `head` is the start of the
+        data, already read from file object `f` along with the attributes, and the rest is read
+        from `f` as it is needed
+    """
+
+    def __init__(self, f, head=b'', buf_size=IPP_BUF_SIZE):
+        io.RawIOBase.__init__(self)
+        self.f = f
+        self.head = memoryview(head)
+        self.buf_size = buf_size
+        self.position = 0       # bytes of document data returned so far
+
+    def __repr__(self):
+        return 'DocumentStream{position=%d,head=%d,buf_size=%d}' % (
+            self.position, len(self.head), self.buf_size)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.head:
+            n = min(len(b), len(self.head))
+            b[:n] = self.head[:n]
+            self.head = self.head[n:]
+        elif hasattr(self.f, 'readinto'):
+            n = self.f.readinto(b)
+        else:
+            chunk = self.f.read(len(b))
+            n = len(chunk)
+            b[:n] = chunk
+        self.position += n
+        return n
+
+    def blocks(self):
+        """Generator that returns the rest of the document data in blocks of up to buf_size
+            bytes
+        """
+        while True:
+            block = self.read(self.buf_size)
+            if not block:
+                break
+            yield block
+
+    def spool(self, dest=None, callback=None, digest=DIGEST):
+        """Copy the rest of the document data a block at a time to file object `dest` and/or
+            `callback`, computing its `digest` in the same pass. Only one block is held in
+            memory. `callback` is passed a memoryview that is only valid until it returns
+            Returns: number of bytes, hex digest or None if `digest` is None
+        """
+        h = hashlib.new(digest) if digest else None
+        buf = memoryview(bytearray(self.buf_size))
+        total = 0
+        while True:
+            n = self.readinto(buf)
+            if not n:
+                break
+            block = buf[:n]
+            if h is not None:
+                h.update(block)
+            if dest is not None:
+                dest.write(block)
+            if callback is not None:
+                callback(block)
+            total += n
+        return total, h.hexdigest() if h is not None else None
+
+
+def open_document(f, buf_size=IPP_BUF_SIZE):
+    """Parse the attributes of the IPP message in file object `f`, reading it in `buf_size`
+        blocks and stopping at the end-of-attributes tag
+        Returns: header, top, document
+            header: dict of version, op_status and request_id
+            top: dict of top level groups, as parse_top() returns
+            document: DocumentStream over the document data, which has not been read beyond the
+                      block containing the end-of-attributes tag
+    """
+    parser = PushParser()
+    header = None
+    top = {}
+    head = b''
+    while not parser.done:
+        chunk = f.read(buf_size)
+        if not chunk:
+            break
+        for event in parser.feed(chunk):
+            if event[0] == EVENT_HEADER:
+                header = event[1]
+            elif event[0] == EVENT_GROUP:
+                top[event[1]] = event[2]
+            elif event[0] == EVENT_DATA:
+                head = event[1]
+    parser.close()
+    return header, top, DocumentStream(f, head, buf_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the events of an IPP message')
+    parser.add_argument('path', help='control file or IPP request')
+    parser.add_argument('--data', default=None,
+                        help='print the header and attributes and spool the document data to '
+                             'this file instead of printing events')
+    parser.add_argument('--digest', default=DIGEST, help='hashlib digest of --data')
+    args = parser.parse_args()
+
+    with open(args.path, 'rb') as f:
+        if args.data is None:
+            for event in iter_events(f, build_groups=False):
+                pprint(event)
+            return
+        header, top, document = open_document(f)
+        pprint(header)
+        pprint(top)
+        with open(args.data, 'wb') as out:
+            n, digest = document.spool(out, digest=args.digest)
+        print('data: %d bytes to %s %s=%s' % (n, args.data, args.digest, digest))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    Deterministic synthetic IPP messages and control file trees
+
+    For benchmarking without private spool data. Everything is generated from a seeded
+    random.Random so the same arguments always give the same bytes.
+
+        messages = make_messages(1000, attributes=40, set_length=3, depth=2, duplicates=0.1)
+        make_tree('/tmp/spool', messages)
+
+    Knobs
+        attributes: number of attributes in the job group
+        value_size: length of generated text values, which mostly determines message size
+        set_length: number of values in each 1setOf attribute
+        depth: nesting depth of collections, 0 for no collections
+        duplicates: fraction of messages that are byte-for-byte copies of an earlier one
+
+    python ipp_synth.py <dir> [--messages N] [--attributes N] ...   # write a control file tree
+"""
+from __future__ import division, print_function
+import os
+import random
+import argparse
+from ipp_reader import IPP_TAG_OPERATION, IPP_TAG_JOB
+from ipp_encoder import IPPEncoder
+
+
+SEED = 1
+ATTRIBUTES = 30
+VALUE_SIZE = 24
+SET_LENGTH = 3
+DEPTH = 2
+DUPLICATES = 0.0
+FILES_PER_ISSUE = 50
+
+KEYWORDS = ['none', 'standard', 'one-sided', 'two-sided-long-edge', 'no-hold', 'stationery',
+            'tray-1', 'auto', 'white', 'iso_a4_210x297mm', 'na_letter_8.5x11in', 'monochrome']
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_.'
+
+# Kinds of attribute value and the attribute name suffixes that make IPPEncoder pick the
+# intended value tag
+KINDS = ['integer', 'enum', 'boolean', 'keyword', 'text', 'name', 'uri', 'date', 'range',
+         'resolution', 'textlang', 'collection', 'set']
+ENUM_NAMES = ['job-state', 'printer-state', 'finishings', 'orientation-requested',
+              'print-quality']
+
+
+def random_text(rng, n):
+    return ''.join(rng.choice(ALPHABET) for _ in range(n)).strip() or 'x'
+
+
+def random_date(rng):
+    return '%04d-%02d-%02d %02d:%02d:%02d' % (rng.randint(2000, 2030), rng.randint(1, 12),
+                                             rng.randint(1, 28), rng.randint(0, 23),
+                                             rng.randint(0, 59), rng.randint(0, 59))
+
+
+def random_value(rng, kind, value_size, set_length, depth):
+    """Returns: name suffix, value of a random attribute of `kind`"""
+    if kind == 'integer':
+        return '', rng.randint(0, 2 ** 31 - 1)
+    if kind == 'enum':
+        return '', rng.randint(3, 9)
+    if kind == 'boolean':
+        return '', rng.random() < 0.5
+    if kind == 'keyword':
+        return '', rng.choice(KEYWORDS)
+    if kind == 'text':
+        return '-text', random_text(rng, value_size)
+    if kind == 'name':
+        return '-name', random_text(rng, value_size)
+    if kind == 'uri':
+        path = random_text(rng, value_size).replace(' ', '_')
+        return '-uri', 'ipp://localhost/printers/%s' % path
+    if kind == 'date':
+        return '', random_date(rng)
+    if kind == 'range':
+        lower = rng.randint(1, 100)
+        return '', (lower, lower + rng.randint(0, 100))
+    if kind == 'resolution':
+        return '', (rng.choice([300, 600, 1200]), rng.choice([300, 600, 1200]), 3)
+    if kind == 'textlang':
+        return '', ('en-us', random_text(rng, value_size))
+    if kind == 'collection':
+        return '-col', random_collection(rng, value_size, set_length, depth)
+    if kind == 'set':
+        return '', [rng.choice(KEYWORDS) for _ in range(set_length)]
+    assert False, kind
+
+
+def random_collection(rng, value_size, set_length, depth):
+    """Returns: dict of a few members, including a nested collection if `depth` > 1"""
+    collection = {'member-%d' % k: rng.randint(0, 100000) for k in range(rng.randint(1, 3))}
+    collection['member-keyword'] = rng.choice(KEYWORDS)
+    collection['member-set'] = [rng.randint(0, 1000) for _ in range(set_length)]
+    if depth > 1:
+        collection['member-col'] = random_collection(rng, value_size, set_length, depth - 1)
+    return collection
+
+
+def random_message(rng, attributes=ATTRIBUTES, value_size=VALUE_SIZE, set_length=SET_LENGTH,
+                   depth=DEPTH):
+    """Returns: {group_tag: {name: value}} of a job with `attributes` job attributes"""
+    kinds = KINDS if depth > 0 else [k for k in KINDS if k != 'collection']
+    job = {}
+    for k in range(attributes):
+        kind = kinds[k % len(kinds)]
+        suffix, value = random_value(rng, kind, value_size, set_length, depth)
+        if kind == 'enum':
+            name = ENUM_NAMES[k // len(kinds) % len(ENUM_NAMES)]
+            if name in job:
+                name = 'x-%s-%d' % (kind, k)
+        elif kind == 'date':
+            name = 'date-time-x-%d' % k
+        else:
+            name = 'x-%s-%d%s' % (kind, k, suffix)
+        job[name] = value
+    return {
+        IPP_TAG_OPERATION: {
+            'attributes-charset': 'utf-8',
+            'attributes-natural-language': 'en-us',
+            'printer-uri': 'ipp://localhost/printers/printer-%d' % rng.randint(1, 20),
+        },
+        IPP_TAG_JOB: job,
+    }
+
+
+def make_messages(count, attributes=ATTRIBUTES, value_size=VALUE_SIZE, set_length=SET_LENGTH,
+                  depth=DEPTH, duplicates=DUPLICATES, seed=SEED):
+    """Returns: list of `count` encoded IPP messages. A fraction `duplicates` of them are copies
+        of earlier messages
+    """
+    rng = random.Random(seed)
+    encoder = IPPEncoder()
+    messages = []
+    for k in range(count):
+        if messages and rng.random() < duplicates:
+            messages.append(rng.choice(messages))
+            continue
+        top = random_message(rng, attributes, value_size, set_length, depth)
+        messages.append(bytes(encoder.encode(top, request_id=k + 1)))
+    return messages
+
+
+def make_tree(root, messages, files_per_issue=FILES_PER_ISSUE):
+    """Write `messages` as CUPS control files c<NNNNN> in issue directories
+        <root>/<NNNNNN>/spool, each with a d<NNNNN>-001 document file that control file masks
+        should skip
+        Returns: list of the control file paths
+    """
+    paths = []
+    for k, text in enumerate(messages):
+        dir_name = os.path.join(root, '%06d' % (100000 + k // files_per_issue), 'spool')
+        if k % files_per_issue == 0:
+            os.makedirs(dir_name, exist_ok=True)
+        path = os.path.join(dir_name, 'c%05d' % k)
+        with open(path, 'wb') as f:
+            f.write(text)
+        with open(os.path.join(dir_name, 'd%05d-001' % k), 'wb') as f:
+            f.write(b'%!PS-Adobe-3.0\n')
+        paths.append(path)
+    return paths
+
+
+def add_arguments(parser):
+    """Add the generator knobs to argparse `parser`"""
+    parser.add_argument('--messages', type=int, default=1000, help='number of messages')
+    parser.add_argument('--attributes', type=int, default=ATTRIBUTES,
+                        help='job attributes per message')
+    parser.add_argument('--value-size', type=int, default=VALUE_SIZE,
+                        help='length of text values')
+    parser.add_argument('--set-length', type=int, default=SET_LENGTH,
+                        help='values per 1setOf attribute')
+    parser.add_argument('--depth', type=int, default=DEPTH, help='collection nesting depth')
+    parser.add_argument('--duplicates', type=float, default=DUPLICATES,
+                        help='fraction of messages that copy an earlier one')
+    parser.add_argument('--seed', type=int, default=SEED)
+
+
+def messages_for(args):
+    """Returns: make_messages() for the arguments added by add_arguments()"""
+    return make_messages(args.messages, args.attributes, args.value_size, args.set_length,
+                         args.depth, args.duplicates, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a tree of synthetic control files')
+    parser.add_argument('path', help='directory to write')
+    add_arguments(parser)
+    parser.add_argument('--files-per-issue', type=int, default=FILES_PER_ISSUE)
+    args = parser.parse_args()
+    messages = messages_for(args)
+    paths = make_tree(args.path, messages, args.files_per_issue)
+    print('%d control files, %d bytes in %s' % (len(paths), sum(len(m) for m in messages),
+                                                 args.path))
+
+
+if __name__ == '__main__':
+    main()
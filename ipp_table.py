@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    Compact array-backed attribute tables
+
+    A dict of dicts per message costs several KB of Python objects, so holding many parsed
+    control files for cross-file analysis takes gigabytes. AttributeTable keeps the message's
+    attribute section and describes each top level value with one row of parallel arrays
+
+        value_tags: value tag
+        name_ids: id of the attribute name in a NameTable shared by all tables, or -1 for an
+                  additional value of a 1setOf attribute
+        offsets, lengths: span of the value in the message. Collection spans cover the
+                          collection's members and its end-of-collection attribute
+
+    and each group with a group tag and the row after its last value. Values are decoded when
+    they are accessed.
+
+        table = AttributeTable(text)
+        table.lookup('job-name')
+        table.to_dict()     # same as decode_message(text)[1]
+
+    python ipp_table.py <control file> <attribute name>...
+"""
+from __future__ import division, print_function
+import sys
+from array import array
+from bisect import bisect_right
+from pprint import pprint
+from ipp_reader import (IPP_TAG_END, IPP_TAG_BEGIN_COLLECTION, GROUP_TAGS, HEADER, BE2,
+                        tag_describe, decode_header, decode_value, decode_group)
+from ipp_lazy import skip_collection
+
+
+class NameTable(object):
+    """Intern table of attribute names: name <-> id"""
+
+    __slots__ = ('ids', 'names')
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __repr__(self):
+        return 'NameTable{names=%d}' % len(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        """Returns: id of `name`, which is added if it is new"""
+        k = self.ids.get(name)
+        if k is None:
+            k = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return k
+
+
+# NameTable shared by AttributeTables that aren't given one
+NAMES = NameTable()
+
+
+def decode_row(buf, tag, i, n):
+    """Returns: value of type `tag` whose `n` bytes start at offset `i` in memoryview `buf`"""
+    if tag == IPP_TAG_BEGIN_COLLECTION:
+        return decode_group(buf, i, 1)[0]
+    return decode_value(buf, i, tag, n) if n else None
+
+
+class AttributeTable(object):
+    """Attributes of the IPP message in bytes-like `text` as parallel arrays of value spans
+        Only the attribute section of `text` is kept. It is not copied if `text` is a bytes
+        object with no document data.
+    """
+
+    __slots__ = ('buf', 'header', 'names', 'group_tags', 'group_ends', 'value_tags', 'name_ids',
+                 'offsets', 'lengths')
+
+    def __init__(self, text, names=None):
+        buf = memoryview(text)
+        self.names = names if names is not None else NAMES
+        self.header = decode_header(buf)
+        self.group_tags = array('B')
+        self.group_ends = array('I')    # row after the last value of each group
+        self.value_tags = array('B')
+        self.name_ids = array('i')
+        self.offsets = array('I')
+        self.lengths = array('I')
+
+        size = len(buf)
+        i = HEADER.size
+        while i < size:
+            tag = buf[i]
+            if tag == IPP_TAG_END:
+                break
+            assert tag in GROUP_TAGS, tag_describe(tag)
+            i = self._index_group(buf, i + 1)
+            self.group_tags.append(tag)
+            self.group_ends.append(len(self.value_tags))
+
+        end = min(i + 1, size)
+        if isinstance(text, bytes) and end == size:
+            self.buf = text
+        else:
+            self.buf = bytes(buf[:end])
+
+    def _index_group(self, buf, i):
+        """Add rows for the values of the group starting at offset `i` in `buf`
+            Returns: offset of the next group tag or end-of-attributes tag
+        """
+        unpack_be2 = BE2.unpack_from
+        intern = self.names.intern
+        value_tags = self.value_tags
+        name_ids = self.name_ids
+        offsets = self.offsets
+        lengths = self.lengths
+        size = len(buf)
+        first = len(value_tags)
+        while i < size:
+            tag = buf[i]
+            if tag in GROUP_TAGS or tag == IPP_TAG_END:
+                break
+            assert i + 3 <= size, 'Truncated attribute at %d' % i
+            n = unpack_be2(buf, i + 1)[0]
+            assert i + 3 + n + 2 <= size, 'Truncated attribute name at %d' % i
+            if n:
+                name_ids.append(intern(str(buf[i + 3:i + 3 + n], 'latin-1')))
+            else:
+                assert len(name_ids) > first, 'Additional value with no attribute at %d' % i
+                name_ids.append(-1)
+            i += 3 + n
+            v = unpack_be2(buf, i)[0]
+            i += 2 + v
+            assert i <= size, 'Truncated attribute value at %d' % (i - v)
+            if tag == IPP_TAG_BEGIN_COLLECTION:
+                start = i
+                i = skip_collection(buf, i)
+                offsets.append(start)
+                lengths.append(i - start)
+            else:
+                offsets.append(i - v)
+                lengths.append(v)
+            value_tags.append(tag)
+        return i
+
+    def __repr__(self):
+        return 'AttributeTable{len=%d,groups=%s,rows=%d}' % (len(self.buf), list(self.group_tags),
+                                                             len(self.value_tags))
+
+    def __len__(self):
+        return len(self.value_tags)
+
+    def group_tag(self, k):
+        """Returns: tag of the group that row `k` is in"""
+        return self.group_tags[bisect_right(self.group_ends, k)]
+
+    def name(self, k):
+        """Returns: attribute name of row `k`, or None for an additional value"""
+        name_id = self.name_ids[k]
+        return self.names.names[name_id] if name_id >= 0 else None
+
+    def value(self, k):
+        """Returns: decoded value of row `k`"""
+        return decode_row(memoryview(self.buf), self.value_tags[k], self.offsets[k],
+                          self.lengths[k])
+
+    def lookup(self, name, default=None):
+        """Returns: value of attribute `name` in the first group that has it"""
+        name_id = self.names.ids.get(name)
+        if name_id is None:
+            return default
+        name_ids = self.name_ids
+        try:
+            k = name_ids.index(name_id)
+        except ValueError:
+            return default
+        end = self.group_ends[bisect_right(self.group_ends, k)]
+        values = [self.value(k)]
+        k += 1
+        while k < end and name_ids[k] < 0:
+            values.append(self.value(k))
+            k += 1
+        return values[0] if len(values) == 1 else values
+
+    def to_dict(self):
+        """Returns: dict of top level groups, as parse_top() returns"""
+        buf = memoryview(self.buf)
+        names = self.names.names
+        value_tags = self.value_tags
+        name_ids = self.name_ids
+        offsets = self.offsets
+        lengths = self.lengths
+        top = {}
+        k = 0
+        for group_tag, end in zip(self.group_tags, self.group_ends):
+            group = {}
+            name = None
+            while k < end:
+                value = decode_row(buf, value_tags[k], offsets[k], lengths[k])
+                name_id = name_ids[k]
+                k += 1
+                if name_id >= 0:
+                    name = names[name_id]
+                    group[name] = value
+                else:
+                    # Additional value of a 1setOf attribute
+                    values = group[name]
+                    if isinstance(values, list):
+                        values.append(value)
+                    else:
+                        group[name] = [values, value]
+            top[group_tag] = group
+        return top
+
+
+def load(path, names=None):
+    with open(path, 'rb') as f:
+        return AttributeTable(f.read(), names)
+
+
+def main():
+    assert len(sys.argv) > 2, 'Usage: python %s <control file> <attribute name>...' % sys.argv[0]
+    table = load(sys.argv[1])
+    print(table)
+    pprint({name: table.lookup(name) for name in sys.argv[2:]})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    SQLite warehouse of decoded control file attributes
+
+    Bulk loads every attribute value of every control file into a local SQLite database so the
+    "distinct values per attribute" report at the end of ipp_reader.main(), and ad-hoc questions,
+    are SQL queries rather than re-parses of the corpus.
+
+        python ipp_warehouse.py load <dir>        # only new or changed files are (re)loaded
+        python ipp_warehouse.py report
+        python ipp_warehouse.py sql "SELECT path FROM files JOIN attributes ON id = file_id
+                                     WHERE name = 'job-state' AND value = 9"
+
+    Tables
+        files(id, path, size, mtime_ns, version, op_status, request_id, error)
+        attributes(file_id, group_tag, name, seq, value_type, value)
+            seq: index of the value in a 1setOf attribute, 0 for single values
+            value_type: Python type of the decoded value. Collections are stored as JSON,
+                        ranges, resolutions and text-with-language values as JSON arrays and
+                        extension values as 'extension' [type tag, hex octets] JSON arrays.
+                        Booleans are stored as 0 and 1 and None as NULL, so queries that must
+                        tell values of different types apart use value_type as well as value
+"""
+from __future__ import division, print_function
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from ipp_reader import recursive_glob, decode_message
+
+
+WAREHOUSE = 'ipp.sqlite'
+BATCH_ROWS = 20000              # rows per executemany()
+TRANSACTION_ROWS = 500000       # rows per transaction
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    version TEXT,
+    op_status INTEGER,
+    request_id INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS attributes (
+    file_id INTEGER NOT NULL,
+    group_tag INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    value_type TEXT NOT NULL,
+    value
+);
+'''
+
+# Created after bulk loads, which are faster without them
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS attributes_name_value ON attributes (name, value);
+CREATE INDEX IF NOT EXISTS attributes_group_name ON attributes (group_tag, name);
+CREATE INDEX IF NOT EXISTS attributes_value ON attributes (value);
+CREATE INDEX IF NOT EXISTS attributes_file ON attributes (file_id);
+'''
+
+
+def sql_value(value):
+    """Returns: value_type, value to store for decoded attribute value `value`"""
+    if value is None or isinstance(value, (bool, int, str, bytes)):
+        return type(value).__name__, value
+    if isinstance(value, tuple):
+        if len(value) == 2 and isinstance(value[1], bytes):
+            return 'extension', json.dumps([value[0], value[1].hex()])
+        return 'tuple', json.dumps(list(value))
+    if isinstance(value, dict):
+        return 'collection', json.dumps(value, sort_keys=True, default=repr)
+    return type(value).__name__, repr(value)
+
+
+def python_value(value_type, value):
+    """Returns: the decoded value that sql_value() stored as `value_type`, `value`. Values stored
+        with repr() are returned as that string
+    """
+    if value_type == 'bool':
+        return bool(value)
+    if value_type == 'tuple':
+        return tuple(json.loads(value))
+    if value_type == 'extension':
+        tag, octets = json.loads(value)
+        return tag, bytes.fromhex(octets)
+    return value
+
+
+def attribute_rows(file_id, attribute_dict):
+    """Generator that returns an attributes row for each value in `attribute_dict`"""
+    for group_tag, attributes in attribute_dict.items():
+        for name, value in attributes.items():
+            values = value if isinstance(value, list) else [value]
+            for seq, val in enumerate(values):
+                value_type, val = sql_value(val)
+                yield file_id, group_tag, name, seq, value_type, val
+
+
+def connect(db_path=WAREHOUSE):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def load(conn, dir_name, batch_rows=BATCH_ROWS, transaction_rows=TRANSACTION_ROWS):
+    """Load the control files in `dir_name` that are new, or whose size or mtime has changed,
+        into warehouse `conn`. Rows are inserted with executemany() in batches of `batch_rows`
+        and committed every `transaction_rows` rows
+        Returns: dict of counts of files loaded, unchanged and bad and of rows inserted
+    """
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    known = {path: (file_id, size, mtime_ns) for file_id, path, size, mtime_ns in
+             conn.execute('SELECT id, path, size, mtime_ns FROM files')}
+    counts = dict.fromkeys(['loaded', 'unchanged', 'bad', 'rows'], 0)
+    rows = []
+    uncommitted = 0
+
+    def insert_rows():
+        conn.executemany('INSERT INTO attributes VALUES (?, ?, ?, ?, ?, ?)', rows)
+        counts['rows'] += len(rows)
+        del rows[:]
+
+    conn.execute('BEGIN')
+    for path in recursive_glob(dir_name):
+        st = os.stat(path)
+        old = known.get(path)
+        if old is not None:
+            if old[1:] == (st.st_size, st.st_mtime_ns):
+                counts['unchanged'] += 1
+                continue
+            conn.execute('DELETE FROM attributes WHERE file_id = ?', (old[0],))
+            conn.execute('DELETE FROM files WHERE id = ?', (old[0],))
+
+        try:
+            with open(path, 'rb') as f:
+                header, attribute_dict = decode_message(f.read())
+            error = None
+        except Exception as e:
+            header, attribute_dict = None, {}
+            error = '%s: %s' % (type(e).__name__, e)
+            counts['bad'] += 1
+        cursor = conn.execute(
+            'INSERT INTO files (path, size, mtime_ns, version, op_status, request_id, error) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, st.st_size, st.st_mtime_ns,
+             '%d.%d' % header['version'] if header else None,
+             header['op_status'] if header else None,
+             header['request_id'] if header else None,
+             error))
+        counts['loaded'] += 1
+
+        n = len(rows)
+        rows.extend(attribute_rows(cursor.lastrowid, attribute_dict))
+        uncommitted += len(rows) - n
+        if len(rows) >= batch_rows:
+            insert_rows()
+        if uncommitted >= transaction_rows:
+            insert_rows()
+            conn.execute('COMMIT')
+            conn.execute('BEGIN')
+            uncommitted = 0
+
+    insert_rows()
+    conn.execute('COMMIT')
+    conn.executescript(INDEXES)
+    conn.execute('ANALYZE')
+    return counts
+
+
+def distinct_values(conn, min_count=2, max_count=20, max_len=20):
+    """The report at the end of ipp_reader.main() as SQL: attributes with `min_count` to
+        `max_count` distinct values, ignoring collections and strings longer than `max_len`
+        Values are distinct as in ipp_reader's Python sets: None (NULL) is a value, values of
+        different types differ except that False and True are the same values as 0 and 1, and
+        the first one loaded is reported
+        Returns: list of (name, [values]) sorted by number of values then name, with the values
+            sorted as ipp_reader sorts them
+    """
+    scalar = "value_type != 'collection' AND (value_type != 'str' OR length(value) <= ?)"
+    kind = "CASE value_type WHEN 'bool' THEN 'int' ELSE value_type END"
+    names = conn.execute(
+        'SELECT name, COUNT(*) AS n FROM (SELECT DISTINCT name, %s, value FROM attributes '
+        'WHERE %s) GROUP BY name HAVING n BETWEEN ? AND ? ORDER BY n, name' % (kind, scalar),
+        (max_len, min_count, max_count)).fetchall()
+    results = []
+    for name, _ in names:
+        # SQLite takes bare columns from the row that MIN() picks: the first loaded
+        values = [python_value(value_type, value) for value_type, value, _ in conn.execute(
+            'SELECT value_type, value, MIN(rowid) FROM attributes WHERE name = ? AND %s '
+            'GROUP BY %s, value' % (scalar, kind), (name, max_len))]
+        results.append((name, sorted(values, key=lambda v: (type(v).__name__, v))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite warehouse of control file attributes')
+    parser.add_argument('--db', default=WAREHOUSE, help='SQLite database')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('load', help='load new and changed files in a directory')
+    p.add_argument('path')
+    p.add_argument('--batch-rows', type=int, default=BATCH_ROWS)
+    p.add_argument('--transaction-rows', type=int, default=TRANSACTION_ROWS)
+    subparsers.add_parser('report', help='distinct values per attribute')
+    p = subparsers.add_parser('sql', help='run a query')
+    p.add_argument('query')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('no command')
+
+    conn = connect(args.db)
+    t0 = time.time()
+    if args.command == 'load':
+        counts = load(conn, args.path, args.batch_rows, args.transaction_rows)
+        print(counts)
+    elif args.command == 'report':
+        for name, values in distinct_values(conn):
+            print(name, values)
+    elif args.command == 'sql':
+        cursor = conn.execute(args.query)
+        if cursor.description:
+            print('\t'.join(d[0] for d in cursor.description))
+        for row in cursor:
+            print('\t'.join(str(v) for v in row))
+    print('%s: %.1f ms' % (args.command, (time.time() - t0) * 1000), file=sys.stderr)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+    The modules are flat files in the repository root. `messages` are the encoded messages that
+    the decoders are compared on
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DATA = b'%PDF-1.4 fake document data\n' * 1000
+
+
+@pytest.fixture(scope='session')
+def messages():
+    """Returns: list of (text, data) of encoded messages and their document data: synthetic
+        jobs with nested collections and 1setOfs, and ipp_bench's sample job, which has
+        extension values, with and without document data
+    """
+    from ipp_synth import make_messages
+    from ipp_bench import SAMPLE_MESSAGE
+    from ipp_encoder import encode_message
+    texts = make_messages(20, depth=2, duplicates=0)
+    return ([(text, b'') for text in texts] +
+            [(encode_message(SAMPLE_MESSAGE), b''),
+             (encode_message(SAMPLE_MESSAGE, request_id=2, data=DATA), DATA)])
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests of control_files copying
+"""
+from __future__ import division, print_function
+import os
+import control_files
+from control_files import copy_file
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_copy_over_hardlink_keeps_source(tmp_path):
+    src = str(tmp_path / 'src')
+    dst = str(tmp_path / 'dst')
+    write(src, b'hello world')
+    assert copy_file(src, dst, 11, 'hardlink') == 'hardlink'
+    assert os.path.samefile(src, dst)
+    for mode in ('copy', 'reflink', 'hardlink', 'copy'):
+        copy_file(src, dst, 11, mode)
+        assert read(src) == b'hello world', mode
+        assert read(dst) == b'hello world', mode
+    assert not os.path.samefile(src, dst)
+    assert sorted(os.listdir(str(tmp_path))) == ['dst', 'src']
+
+
+def make_tree(root, files):
+    """Write `files` {relative path: contents} under directory `root`"""
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write(path, data)
+
+
+def test_incremental_over_hardlinks(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    make_tree('src', {'123456/c00001': b'first', '123456/c00002': b'second',
+                      '654321/c00001': b'first'})
+    control_files.update_control_files('src', mode='hardlink')
+    dest = control_files.dest_path_for('123456', 'c00001', 0)
+    assert os.path.samefile(dest, 'src/123456/c00001')
+
+    # Changing a source in place also changes its hard-linked copy
+    write('src/123456/c00001', b'first, changed')
+    control_files.update_control_files('src', mode='copy')
+    assert read('src/123456/c00001') == b'first, changed'
+    assert read(dest) == b'first, changed'
+    assert not os.path.samefile(dest, 'src/123456/c00001')
+
+    # The unchanged duplicate is promoted in place of the changed original
+    dest2 = control_files.dest_path_for('654321', 'c00001', 0)
+    assert read(dest2) == b'first'
+    for name, data in [('123456/c00002', b'second'), ('654321/c00001', b'first')]:
+        assert read(os.path.join('src', name)) == data
+
+
+def test_duplicate_finder(tmp_path, monkeypatch):
+    monkeypatch.setattr(control_files, 'PARTIAL_SIZE', 4)
+    contents = [b'abc', b'abd', b'abc', b'abcdefgh', b'abcdefgi', b'abcdxxxx', b'abcdefgh',
+                b'abcdefgi', b'xyz']
+    finder = control_files.DuplicateFinder()
+    originals = []
+    for k, data in enumerate(contents):
+        path = str(tmp_path / ('f%d' % k))
+        write(path, data)
+        original = finder.original(path, len(data))
+        originals.append(None if original is None else int(os.path.basename(original)[1:]))
+    assert originals == [None, None, 0, None, None, None, 3, 4, None]
+
+
+def test_recursive_glob_issue(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    make_tree('src', {'123456/spool/c00001': b'a', 'other/c00002': b'b'})
+    found = {filename: issue for _, issue, filename in
+             control_files.recursive_glob('src/123456', control_files.CONTROL_MASK)}
+    assert found == {'c00001': '123456'}
+
+    # Without an issue directory the directory name is used where get_issue() doesn't assert
+    monkeypatch.setattr(control_files, 'get_issue', lambda parts: None)
+    found = {filename: issue for _, issue, filename in
+             control_files.recursive_glob('src', control_files.CONTROL_MASK)}
+    assert found == {'c00001': 'spool', 'c00002': 'other'}
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests of the parse cache
+"""
+from __future__ import division, print_function
+from ipp_cache import ParseCache, content_key
+
+
+def test_variants_have_different_keys():
+    text = b'\x02\x00\x00\x02\x00\x00\x00\x01\x03'
+    assert content_key(text, 'fast.1') == content_key(text, 'fast.1')
+    assert content_key(text, 'fast.1') != content_key(text, 'slow.1')
+    assert content_key(text, 'fast.1') != content_key(text, 'fast.2')
+
+
+def test_get_returns_copies(tmp_path):
+    value = {1: {'job-name': 'a', 'finishings': [3, 4]}}
+    for cache_dir in (None, str(tmp_path)):
+        cache = ParseCache(cache_dir)
+        cache.put('k', value)
+        value[1]['finishings'].append(5)
+        got = cache.get('k')
+        assert got == {1: {'job-name': 'a', 'finishings': [3, 4]}}
+        got[1]['job-name'] = 'changed'
+        assert cache.get('k')[1]['job-name'] == 'a'
+        value[1]['finishings'].pop()
+
+    # Disk tier only
+    cache = ParseCache(str(tmp_path), memory_entries=0)
+    assert cache.get('k') == {1: {'job-name': 'a', 'finishings': [3, 4]}}
+    assert cache.counts['disk_hits'] == 1
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests that ipp_encoder's output decodes to what it was given
+"""
+from __future__ import division, print_function
+import pytest
+from ipp_reader import IPP_TAG_OPERATION, IPP_TAG_JOB, decode_message
+from ipp_encoder import encode_message
+from ipp_bench import SAMPLE_MESSAGE
+
+
+def test_round_trip(messages):
+    for text, data in messages:
+        header, top = decode_message(text)
+        assert encode_message(top, header['version'], header['op_status'], header['request_id'],
+                              data) == text
+
+
+def test_values():
+    top = {IPP_TAG_OPERATION: {'attributes-charset': 'utf-8', 'x-none': None},
+           IPP_TAG_JOB: {'copies': 0, 'x-flag': False, 'x-octets': b'\x00\xff',
+                         'x-vendor': (0x40000001, b''), 'page-ranges': [(1, 2), (5, 9)],
+                         'printer-resolution': (600, 300, 3),
+                         'x-cols': [{'x-vendor': (0x40000002, b'\x01')}, {'copies': [1, 2]}]}}
+    assert decode_message(encode_message(top))[1] == top
+    assert decode_message(encode_message(SAMPLE_MESSAGE))[1] == SAMPLE_MESSAGE
+
+
+def test_empty_list_is_rejected():
+    with pytest.raises(AssertionError, match='empty 1setOf'):
+        encode_message({IPP_TAG_JOB: {'finishings': []}})
+    with pytest.raises(AssertionError, match='empty 1setOf'):
+        encode_message({IPP_TAG_JOB: {'media-col': {'x-list': []}}})
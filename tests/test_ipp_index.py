@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests of the attribute index
+"""
+from __future__ import division, print_function
+import os
+from ipp_reader import IPP_TAG_OPERATION, IPP_TAG_JOB
+from ipp_encoder import encode_message
+from ipp_index import AttributeIndex, parse_literal
+
+
+def write_message(path, job):
+    with open(path, 'wb') as f:
+        f.write(encode_message({IPP_TAG_OPERATION: {'attributes-charset': 'utf-8'},
+                                IPP_TAG_JOB: job}))
+
+
+def postings(index_path, names):
+    index = AttributeIndex(index_path)
+    return {name: index.name_postings(name) for name in names}
+
+
+def test_queries_and_incremental_update(tmp_path):
+    spool = str(tmp_path / 'spool')
+    os.mkdir(spool)
+    paths = [os.path.join(spool, 'c%05d' % k) for k in range(3)]
+    write_message(paths[0], {'job-name': '123', 'job-state': 9,
+                             'media-col': {'media-type': 'plain', 'media-size': {'x': 1}}})
+    write_message(paths[1], {'job-name': 'report', 'job-state': 9, 'copies': [1, 2]})
+    write_message(paths[2], {'job-name': 'other', 'job-state': 7})
+    index_path = str(tmp_path / 'ipp.index')
+    index = AttributeIndex(index_path)
+    assert index.update(spool)['added'] == 3
+    index.save()
+
+    index = AttributeIndex(index_path)
+    assert index.files_where('job-state', 9) == paths[:2]
+    assert index.files_where('job-name', parse_literal("'123'")) == paths[:1]
+    assert index.files_where('copies', 2, IPP_TAG_JOB) == paths[1:2]
+    assert index.files_where('copies', 2, IPP_TAG_OPERATION) == []
+    assert index.files_where('media-col', ('media-size', 'media-type')) == paths[:1]
+    assert index.distinct('job-state') == [7, 9]
+    assert index.files is None      # queries only read the postings of their attribute
+
+    # Incremental updates leave the same postings as building from scratch
+    write_message(paths[1], {'job-name': 'report', 'job-state': 8})
+    os.remove(paths[2])
+    index = AttributeIndex(index_path)
+    counts = index.update(spool)
+    assert (counts['updated'], counts['removed']) == (1, 1), counts
+    index.save()
+    names = ['job-name', 'job-state', 'copies', 'media-col', 'attributes-charset']
+    fresh_path = str(tmp_path / 'fresh.index')
+    fresh = AttributeIndex(fresh_path)
+    fresh.update(spool)
+    fresh.save()
+    assert postings(index_path, names) == postings(fresh_path, names)
+    assert AttributeIndex(index_path).files_with('copies') == []
+
+
+def test_parse_literal():
+    assert parse_literal('9') == 9
+    assert parse_literal('-5') == -5
+    assert parse_literal('None') is None
+    assert parse_literal('(1, 5)') == (1, 5)
+    assert parse_literal('(1,5)') == (1, 5)
+    assert parse_literal("'123'") == '123'
+    assert parse_literal('"123"') == '123'
+    for text in ('abc', '1e3', '0x10', '1_000', 'two words'):
+        assert parse_literal(text) == text
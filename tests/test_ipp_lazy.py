@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests that lazily decoded messages have the same contents as decode_message()'s
+"""
+from __future__ import division, print_function
+from ipp_reader import decode_message
+from ipp_lazy import IPPMessage
+
+
+def test_lazy_matches_decode_message(messages):
+    for text, _ in messages:
+        _, top = decode_message(text)
+        msg = IPPMessage(text)
+        assert msg.to_dict() == top
+        assert sorted(msg) == sorted(top)
+        for group_tag, group in top.items():
+            assert dict(msg[group_tag]) == group
+            for name, value in group.items():
+                if all(name not in top[g] for g in top if g < group_tag):
+                    assert msg.lookup(name) == value
+        assert msg.lookup('no-such-attribute', 'default') == 'default'
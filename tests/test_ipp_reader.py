@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests of ipp_reader's decoders
+"""
+from __future__ import division, print_function
+import pytest
+import ipp_reader
+from ipp_reader import IPP, IPP_TAG_OPERATION, IPP_TAG_JOB, HEADER, parse_top
+from ipp_encoder import encode_message
+
+
+def slow_top(text, **kwargs):
+    """Returns: parse_top() of message `text` on the slow path"""
+    ipp = IPP([int(c) for c in text])
+    ipp.read(HEADER.size)
+    return parse_top(ipp, **kwargs)
+
+
+def test_slow_path_size_limit_bounds_work(monkeypatch):
+    job = {'x-attr-%04d' % k: 'v' * 100 for k in range(2000)}
+    text = encode_message({IPP_TAG_OPERATION: {'attributes-charset': 'utf-8'},
+                           IPP_TAG_JOB: job})
+    assert slow_top(text, max_size=len(text))[IPP_TAG_JOB] == job
+
+    decoded = []
+    parse_value = ipp_reader.parse_value
+    monkeypatch.setattr(ipp_reader, 'parse_value',
+                        lambda *args: decoded.append(1) or parse_value(*args))
+    with pytest.raises(AssertionError, match='Limit is 10000'):
+        slow_top(text, max_size=10000)
+    # The limit is hit inside the first big group, not after decoding all of it
+    assert len(decoded) < 10000 // 100
+
+
+def test_decoders_agree(messages, tmp_path):
+    path = str(tmp_path / 'c00001')
+    for text, data in messages:
+        header, top = ipp_reader.decode_message(text)
+        if not data:
+            # The slow path reads control files, which have no document data
+            assert slow_top(text) == top
+        with open(path, 'wb') as f:
+            f.write(text)
+        with ipp_reader.MappedMessage(path) as message:
+            assert (message.header, message.top) == (header, top)
+            assert message.data_offset + message.data_length == len(text)
+            assert bytes(message.data) == data
+
+
+def test_truncated_values_are_rejected(messages):
+    text, _ = messages[-2]
+    _, top = ipp_reader.decode_message(text)
+    for k in range(HEADER.size, len(text)):
+        try:
+            _, partial = ipp_reader.decode_message(text[:k])
+        except AssertionError:
+            continue
+        # A message cut at an attribute boundary decodes to the attributes before the cut
+        for group_tag, group in partial.items():
+            for name, value in group.items():
+                full = top[group_tag][name]
+                if isinstance(full, list) and not isinstance(value, list):
+                    value = [value]
+                assert value == full or value == full[:len(value)], (k, name)
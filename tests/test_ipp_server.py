@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests of the ingest server's body memory budget
+"""
+from __future__ import division, print_function
+import asyncio
+from ipp_server import ByteBudget
+
+
+def test_byte_budget():
+    async def run():
+        budget = ByteBudget(10)
+        await budget.acquire(6)
+        large = asyncio.ensure_future(budget.acquire(6))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(budget.acquire(1))
+        await asyncio.sleep(0)
+        # `small` would fit but waits behind `large`
+        assert not large.done() and not small.done()
+        budget.release(6)
+        await asyncio.gather(large, small)
+        assert budget.used == 7
+
+        cancelled = asyncio.ensure_future(budget.acquire(10))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert cancelled.cancelled()
+        assert budget.used == 7 and not budget.waiters
+        budget.release(7)
+        assert budget.used == 0
+
+    asyncio.run(run())
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests of the name_vals sketches
+"""
+from __future__ import division, print_function
+import random
+from collections import defaultdict, Counter
+from ipp_reader import decode_message, add_name_vals
+from ipp_sketch import NameValStats, SpaceSaving
+
+
+def set_report(attribute_dicts, max_listed=20):
+    """Returns: [(name, set of values)] that the report listed when name_vals was a dict of
+        sets, in the order it listed them
+    """
+    name_vals = defaultdict(set)
+    for attribute_dict in attribute_dicts:
+        for attributes in attribute_dict.values():
+            for name, value in attributes.items():
+                for val in value if isinstance(value, list) else [value]:
+                    if isinstance(val, str) and len(val) > 20:
+                        continue
+                    if not isinstance(val, (dict, list)):
+                        name_vals[name].add(val)
+    return [(name, name_vals[name])
+            for name in sorted(name_vals, key=lambda k: (len(name_vals[k]), k))
+            if 1 < len(name_vals[name]) <= max_listed]
+
+
+def stats_report(stats, max_listed=20):
+    return [(name, set(stats.values(name)))
+            for name in sorted(stats, key=lambda k: (stats.cardinality(k), k))
+            if 1 < stats.cardinality(name) <= max_listed]
+
+
+def test_report_matches_sets(messages):
+    attribute_dicts = [decode_message(text)[1] for text, _ in messages] * 2
+    expected = set_report(attribute_dicts)
+    assert expected
+
+    stats = NameValStats()
+    for attribute_dict in attribute_dicts:
+        add_name_vals(stats, attribute_dict)
+    assert stats_report(stats) == expected
+
+    merged = NameValStats()
+    for k in range(0, len(attribute_dicts), 3):
+        chunk = NameValStats()
+        for attribute_dict in attribute_dicts[k:k + 3]:
+            add_name_vals(chunk, attribute_dict)
+        merged.merge(chunk)
+    assert stats_report(merged) == expected
+
+
+def skewed_values(n, seed=1):
+    rng = random.Random(seed)
+    return [int(rng.paretovariate(1.1)) for _ in range(n)]
+
+
+def test_report_is_independent_of_chunking():
+    values = skewed_values(50000)
+    counts = Counter(values)
+    results = set()
+    for chunk_size in (500, 3333, 50000):
+        stats = NameValStats()
+        for k in range(0, len(values), chunk_size):
+            chunk = NameValStats()
+            for value in values[k:k + chunk_size]:
+                chunk.add('x', value)
+            stats.merge(chunk)
+        common = stats.most_common('x', 5, min_count=2)
+        results.add((repr(common), stats.cardinality('x')))
+        # Values that occur more than 1/k of the time are always reported, with upper bounds
+        heavy = [v for v, c in counts.items() if c > len(values) / stats.k]
+        assert sorted(heavy) == sorted(v for v, _ in stats.most_common('x'))
+        assert all(c >= counts[v] for v, c in common)
+    assert len(results) == 1, results
+
+
+def test_floor_is_zero_while_exact():
+    top = SpaceSaving(4)
+    for value in 'aabcd':
+        top.add(value)
+    assert top.exact and top.floor() == 0
+    other = SpaceSaving(4)
+    other.add('a')
+    top.merge(other)
+    assert top.exact and top.floor() == 0 and top.counts['a'] == 3
+    top.add('e')
+    assert not top.exact and top.floor() > 0
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests that the push parser decodes messages the way decode_message() does
+"""
+from __future__ import division, print_function
+import io
+import hashlib
+from ipp_reader import decode_message
+from ipp_stream import parse_stream, open_document
+
+
+def test_parse_stream_matches_decode_message(messages):
+    for text, _ in messages:
+        expected = decode_message(text)
+        for buf_size in (1, 7, 4096):
+            assert parse_stream(io.BytesIO(text), buf_size) == expected, buf_size
+
+
+def test_open_document(messages):
+    for text, data in messages:
+        header, top = decode_message(text)
+        for buf_size in (5, 4096):
+            got_header, got_top, document = open_document(io.BytesIO(text), buf_size)
+            assert (got_header, got_top) == (header, top)
+            assert document.read() == data
+
+        _, _, document = open_document(io.BytesIO(text), 64)
+        out = io.BytesIO()
+        assert document.spool(out) == (len(data), hashlib.sha256(data).hexdigest())
+        assert out.getvalue() == data
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests that attribute tables have the same contents as decode_message()'s
+"""
+from __future__ import division, print_function
+from ipp_reader import decode_message
+from ipp_table import AttributeTable, NameTable
+
+
+def test_table_matches_decode_message(messages):
+    names = NameTable()
+    for text, _ in messages:
+        header, top = decode_message(text)
+        table = AttributeTable(text, names)
+        assert table.header == header
+        assert table.to_dict() == top
+        for group_tag, group in top.items():
+            for name, value in group.items():
+                if all(name not in top[g] for g in top if g < group_tag):
+                    assert table.lookup(name) == value
+        for k in range(len(table)):
+            assert table.group_tag(k) in top
+            name = table.name(k)
+            assert name is None or name in top[table.group_tag(k)]
+    assert len(names) < sum(len(group) for text, _ in messages
+                            for group in decode_message(text)[1].values())
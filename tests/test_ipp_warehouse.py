@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests that the warehouse report matches ipp_reader's
+"""
+from __future__ import division, print_function
+import os
+import ipp_reader
+import ipp_warehouse
+from ipp_reader import IPP_TAG_OPERATION, IPP_TAG_JOB
+from ipp_encoder import encode_message
+from ipp_bench import SAMPLE_MESSAGE
+
+MESSAGES = [
+    SAMPLE_MESSAGE,
+    {IPP_TAG_OPERATION: {'x-mixed': None, 'x-bool': True, 'x-text': 'a' * 21},
+     IPP_TAG_JOB: {'copies': 1, 'x-pair': (1, 2), 'sides': 'one-sided'}},
+    {IPP_TAG_OPERATION: {'x-mixed': False, 'x-bool': 1, 'x-text': 'short'},
+     IPP_TAG_JOB: {'copies': 2, 'x-pair': (3, 4), 'x-octets': b'\x00\x01'}},
+    {IPP_TAG_OPERATION: {'x-mixed': 0, 'x-bool': False, 'x-text': ['short', 'other']},
+     IPP_TAG_JOB: {'copies': [3, 4], 'x-pair': (1, 2), 'x-octets': b'\x02',
+                   'x-vendor-data': (0x40000001, b'')}},
+    {IPP_TAG_OPERATION: {'x-mixed': 'none'},
+     IPP_TAG_JOB: {'x-vendor-data': (0x40000001, b'\x07'), 'job-state': 9}},
+]
+
+
+def reader_report(capsys, paths, fast):
+    """Returns: lines of the listed section of ipp_reader's name_vals report"""
+    _, name_vals = ipp_reader.run_serial(paths, fast)
+    capsys.readouterr()
+    name_vals.report()
+    lines = capsys.readouterr().out.splitlines()
+    return [line for line in lines if not line.startswith(('attributes with', ' '))]
+
+
+def test_distinct_values_match_ipp_reader(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(str(tmp_path))
+    os.mkdir('spool')
+    for k, message in enumerate(MESSAGES):
+        with open(os.path.join('spool', 'c%05d' % k), 'wb') as f:
+            f.write(encode_message(message, request_id=k + 1))
+    paths = list(ipp_reader.recursive_glob('spool'))
+
+    conn = ipp_warehouse.connect(':memory:')
+    counts = ipp_warehouse.load(conn, 'spool')
+    assert counts['bad'] == 0 and counts['loaded'] == len(MESSAGES), counts
+    warehouse = ['%s %s' % (name, values) for name, values in ipp_warehouse.distinct_values(conn)]
+
+    for fast in (False, True):
+        assert reader_report(capsys, paths, fast) == warehouse, fast
+    assert any(line.startswith('x-mixed ') for line in warehouse)